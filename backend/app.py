@@ -5,7 +5,14 @@ from config import Config
 from database import db, migrate
 import os
 
-def create_app():
+def create_app(network_workers=True):
+    """Build the app and start its background workers.
+    
+    network_workers=False leaves out the workers that probe the WANs or
+    change the host's firewall, routing and state files (access control,
+    reconciler, ISP and throughput samplers), for one-shot tools and
+    benchmarks; the M-PESA workers still follow their own settings.
+    """
     app = Flask(__name__)
     app.config.from_object(Config)
     
@@ -16,7 +23,7 @@ def create_app():
     jwt = JWTManager(app)
     
     # Import models to ensure they're registered
-    from models import user, voucher, session, plan
+    from models import user, voucher, session, plan, transaction, reconciliation
     
     # Import route blueprints after app context is established
     from routes.auth import auth_bp
@@ -25,6 +32,7 @@ def create_app():
     from routes.sessions import sessions_bp
     from routes.isp import isp_bp
     from routes.dashboard import dashboard_bp
+    from routes.mpesa import mpesa_bp
     
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -33,6 +41,22 @@ def create_app():
     app.register_blueprint(sessions_bp, url_prefix='/api/sessions')
     app.register_blueprint(isp_bp, url_prefix='/api/isp')
     app.register_blueprint(dashboard_bp, url_prefix='/api/dashboard')
+    app.register_blueprint(mpesa_bp, url_prefix='/api/mpesa')
+    
+    # Start background workers
+    from utils.payments import init_mpesa_callbacks
+    from utils.payment_poller import init_payment_poller
+    from utils.access_control import init_access_control
+    from utils.reconcile import init_reconciler
+    from utils.isp_sampler import init_isp_sampler
+    from utils.throughput import init_throughput_sampler
+    if network_workers:
+        init_access_control(app)
+        init_reconciler(app)
+        init_isp_sampler(app)
+        init_throughput_sampler(app)
+    init_mpesa_callbacks(app)
+    init_payment_poller(app)
     
     @app.route('/api/health')
     def health_check():
@@ -1,6 +1,13 @@
 import os
 from datetime import timedelta
 
+def wan_registry(interfaces: str, names: str) -> dict:
+    """wanN -> interface, policy routing table (100 + N), connection mark (N) and ISP name"""
+    names = [name.strip() for name in names.split(',')]
+    return {f'wan{index}': {'interface': interface.strip(), 'table': 100 + index, 'fwmark': index,
+                            'name': names[index - 1] if index <= len(names) else f'ISP {index}'}
+            for index, interface in enumerate(interfaces.split(','), start=1)}
+
 class Config:
     # Flask Settings
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'bytebill-secret-key-change-in-production'
@@ -25,24 +32,169 @@ class Config:
     MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY')
     MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE')
     MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL') or 'http://hotspot.local/api/mpesa/callback'
+    MPESA_API_BASE_URL = os.environ.get('MPESA_API_BASE_URL') or 'https://sandbox.safaricom.co.ke'
+    MPESA_API_TIMEOUT = 15  # seconds
+    MPESA_API_RATE_LIMIT = 10  # requests per second across all Daraja calls
+    MPESA_API_BURST = 20
+    
+    # M-PESA Callback Processing
+    MPESA_INBOX_DIR = os.environ.get('MPESA_INBOX_DIR') or '/var/lib/bytebill/mpesa_inbox'
+    MPESA_INBOX_FSYNC = True  # fdatasync every callback before acknowledging
+    MPESA_CALLBACK_CONSUMER_ENABLED = True
+    MPESA_CALLBACK_BATCH_SIZE = 200
+    MPESA_CALLBACK_POLL_INTERVAL = 0.5  # seconds
+    MPESA_CALLBACK_RETRY_WINDOW = 600  # seconds to retry callbacks that beat their transaction
+    
+    # Pending Payment Reconciliation (STK Query)
+    MPESA_QUERY_ENABLED = True
+    MPESA_QUERY_INTERVAL = 10  # seconds between scans
+    MPESA_QUERY_MIN_AGE = 45  # seconds before a pending payment is queried
+    MPESA_QUERY_MAX_AGE = 86400  # stop querying after a day; left for statement reconciliation
+    MPESA_QUERY_CONCURRENCY = 8
+    MPESA_QUERY_BATCH_SIZE = 500
+    # (age in seconds, re-query interval in seconds), youngest first
+    MPESA_QUERY_BACKOFF = [(120, 15), (600, 60), (3600, 300), (86400, 1800)]
     
     # Network Settings
     LAN_INTERFACE = 'eth0'
-    WAN1_INTERFACE = 'enx1'
-    WAN2_INTERFACE = 'enx2'
+    # WAN uplinks in priority order; policy routing, NAT, balancing, probing, metrics and the API
+    # all follow this registry, so another USB uplink is one more interface in WAN_INTERFACES
+    WANS = wan_registry(os.environ.get('WAN_INTERFACES') or 'enx1,enx2',
+                        os.environ.get('WAN_NAMES') or 'ISP 1 (Unlimited),ISP 2 (FUP)')
     LAN_SUBNET = '192.168.88.0/24'
     GATEWAY_IP = '192.168.88.1'
     
+    # Client Access Control
+    FIREWALL_BACKEND = os.environ.get('FIREWALL_BACKEND') or 'iptables'  # iptables or nftables
+    # Push session authorizations into the firewall's authorized-client ipset
+    ACCESS_CONTROL_ENABLED = (os.environ.get('ACCESS_CONTROL_ENABLED') or 'false').lower() == 'true'
+    
+    # WAN Load Balancing
+    # route: multipath default route; connmark: new connections are marked per WAN and keep it
+    BALANCE_MODE = os.environ.get('BALANCE_MODE') or 'route'
+    FWMARK_MASK = 0xff  # room for a mark per WAN
+    SPEEDTEST_RESULTS_FILE = '/var/lib/bytebill/speedtest_results.json'  # latest isp_speedtest.sh run
+    LOADBALANCER_STATE_FILE = '/run/bytebill/loadbalancer.state'  # live balancer state shared with the API
+    
+    # Per-client WAN Policy
+    # Pin each session's new connections to a WAN by traffic class; ISP2 is the FUP-capped link
+    WAN_POLICY_ENABLED = (os.environ.get('WAN_POLICY_ENABLED') or 'false').lower() == 'true'
+    WAN_POLICY_HEAVY_BYTES = 2147483648  # sessions past 2GB downloaded count as heavy
+    WAN_POLICY_LARGE_PLAN_BYTES = 5368709120  # plans above 5GB, or uncapped, count as heavy
+    WAN_POLICY_PREMIUM_KBPS = 6144  # plans at least this fast count as premium
+    # Traffic class -> a WAN name from WANS, 'fastest' (by measured capacity) or None for the balancer
+    WAN_POLICY_CLASSES = {'heavy': 'wan1', 'premium': 'fastest', 'standard': None}
+    
+    # State Reconciliation
+    # Periodically diff sysctls, firewall, authorized set and policy routes against the desired state
+    RECONCILE_ENABLED = (os.environ.get('RECONCILE_ENABLED') or 'false').lower() == 'true'
+    RECONCILE_INTERVAL = 60  # seconds between drift checks
+    RECONCILE_LOCK_FILE = '/var/lib/bytebill/reconciler.lock'  # one reconciler across workers
+    
+    # Traffic Shaping
+    # Per-client HTB classes from each plan's download/upload rates
+    SHAPING_ENABLED = (os.environ.get('SHAPING_ENABLED') or 'false').lower() == 'true'
+    SHAPING_IFB_INTERFACE = 'ifb0'  # upload traffic is redirected here to be shaped
+    SHAPING_DOWNLOAD_KBPS = 100000  # total downstream capacity shared by all clients
+    SHAPING_UPLOAD_KBPS = 40000
+    SHAPING_LEAF_QDISC = 'fq_codel'  # fq_codel or cake
+    
     # Hotspot Settings
     CAPTIVE_PORTAL_URL = 'http://hotspot.local'
     DEFAULT_SESSION_TIMEOUT = 3600  # 1 hour in seconds
     DEFAULT_DATA_LIMIT = 1048576000  # 1GB in bytes
     
     # ISP Settings
-    ISP1_NAME = 'ISP 1 (Unlimited)'
-    ISP2_NAME = 'ISP 2 (FUP)'
     SPEED_TEST_INTERVAL = 300  # 5 minutes
     
+    # WAN Health Probing
+    PROBE_HOSTS = ['8.8.8.8', '1.1.1.1', '208.67.222.222']
+    PROBE_COUNT = 3  # echoes per host per round
+    PROBE_SPARSE_COUNT = 1  # echoes per host per round while a WAN is stable
+    PROBE_TIMEOUT = 2.0  # seconds; deadline of every probe, so of the whole round
+    PROBE_MIN_CONNECTIVITY = 50  # percent of hosts that must answer for a WAN to count as online
+    PROBE_METHOD = os.environ.get('PROBE_METHOD') or 'icmp'  # icmp, tcp or dns
+    PROBE_TCP_PORT = 53  # the probe hosts are public resolvers, which all accept TCP on 53
+    PROBE_DNS_NAME = 'example.com'
+    
+    # WAN Scoring
+    # The load balancer scores each WAN from EWMAs of its probe rounds; hysteresis keeps one
+    # bad round from moving traffic
+    WAN_SCORE_ALPHA = 0.3  # weight of the newest round in latency, jitter and loss averages
+    WAN_SCORE_HISTORY = 120  # probe rounds and service changes kept per WAN
+    WAN_SCORE_JITTER_WEIGHT = 0.5  # points off the score per ms of jitter
+    WAN_SCORE_JITTER_CAP = 30
+    WAN_DOWN_ROUNDS = 2  # failed rounds in a row that take a WAN out of service
+    WAN_UP_ROUNDS = 3  # good rounds in a row before it comes back
+    WAN_SCORE_DOWN = 20  # out of service below this score
+    WAN_SCORE_UP = 40  # and back only at or above this one
+    WAN_HOLD_DOWN = 120  # seconds a WAN stays out of service at least
+    WAN_RECOVERY_PROBE_INTERVAL = 2  # seconds between probes of a WAN with carrier waiting to return
+    WAN_PREFERENCE_MARGIN = 15  # points another WAN must lead by to become preferred
+    WAN_PREFERENCE_SUSTAIN = 300  # seconds it must keep that lead
+    WAN_FLAP_WINDOW = 3600  # seconds over which recent flaps are counted
+    
+    # WAN Probe Scheduling
+    # Stable WANs are probed sparsely; failed rounds, passive signals and link events make it dense
+    WAN_PROBE_MIN_INTERVAL = 5  # seconds between dense rounds of a suspect WAN
+    WAN_PROBE_MAX_INTERVAL = 120  # sparse rounds of a stable WAN back off up to this
+    WAN_PROBE_BACKOFF = 2  # interval multiplier per clean sparse round
+    WAN_PROBE_DENSE_ROUNDS = 3  # clean dense rounds before a suspect WAN goes back to sparse
+    WAN_PASSIVE_INTERVAL = 5  # seconds between reads of interface, conntrack and TCP counters
+    WAN_SUSPECT_MIN_PACKETS = 50  # packets sent in an interval before a silent link is suspect
+    WAN_SUSPECT_RX_SHARE = 0.05  # fewer packets back than this share of those sent is silent
+    WAN_SUSPECT_MIN_UNREPLIED = 20  # unreplied connections of a WAN's mark before it is suspect
+    WAN_SUSPECT_UNREPLIED_SHARE = 0.5  # and at least this share of its connections
+    WAN_SUSPECT_MIN_SEGMENTS = 100  # router TCP segments sent before retransmits count
+    WAN_SUSPECT_RETRANS_RATIO = 0.1
+    
+    # ISP Status Sampling
+    # One worker samples ISP health in the background; /api/isp/status serves the latest snapshot
+    ISP_SAMPLER_ENABLED = True
+    ISP_SAMPLE_INTERVAL = 10  # seconds between samples
+    ISP_STATUS_FILE = '/var/lib/bytebill/isp_status.json'  # shared by all workers
+    ISP_SAMPLER_LOCK_FILE = '/var/lib/bytebill/isp_sampler.lock'  # one sampler across workers
+    
+    # Interface Throughput Sampling
+    THROUGHPUT_SAMPLER_ENABLED = True
+    THROUGHPUT_SAMPLE_INTERVAL = 1.0  # seconds between /proc/net/dev reads
+    THROUGHPUT_HISTORY = 3600  # seconds of per-sample deltas kept in memory per interface
+    
+    # ISP Metrics History
+    # Probe results, WAN throughput and speed tests, recorded by the ISP sampler
+    METRICS_DIR = '/var/lib/bytebill/metrics'
+    # Seconds each tier is kept: raw samples, minute and hour rollups
+    METRICS_RETENTION = {'raw': 7 * 86400, 'minute': 90 * 86400, 'hour': 3 * 365 * 86400}
+    ISP_LATENCY_WARNING_MS = 200  # minute averages above this are logged
+    
+    # WAN Capacity Estimation
+    # Capacity is inferred from client traffic peaks while probe RTT is inflated; a speed
+    # test only runs when an estimate is stale and its link idle, since each one burns ISP2's FUP
+    CAPACITY_FILE = '/var/lib/bytebill/capacity.json'  # latest estimates, read by the load balancer
+    CAPACITY_RTT_INFLATION_MS = 30  # RTT this far above the baseline means the link is queueing
+    CAPACITY_BASELINE_WINDOW = 3600  # seconds over which the lowest RTT is taken as unloaded
+    CAPACITY_SATURATION_SHARE = 0.5  # queueing with traffic below this share of the estimate is not ours
+    CAPACITY_MIN_SAMPLE_BPS = 1000000  # peaks below 1 Mbps say nothing about capacity
+    CAPACITY_SMOOTHING = 0.25  # weight of each saturated peak in the estimate
+    CAPACITY_STALE_AFTER = 86400  # seconds without saturation or a test before an estimate is stale
+    CAPACITY_IDLE_BPS = 2000000  # both directions below this for CAPACITY_IDLE_SECONDS is idle
+    CAPACITY_IDLE_SECONDS = 120
+    CAPACITY_ACTIVE_TESTS_ENABLED = True
+    CAPACITY_MIN_TEST_INTERVAL = 21600  # at most one speed test per WAN every 6 hours
+    
+    # ISP2 Fair Usage Policy
+    # WAN2's traffic is counted against its allowance per billing cycle; as usage projected to
+    # the end of the cycle nears the allowance, new connections shift to ISP1
+    FUP_WAN = 'wan2'
+    FUP_QUOTA_BYTES = int(os.environ.get('FUP_QUOTA_BYTES') or 536870912000)  # 500GB per cycle
+    FUP_CYCLE_DAY = int(os.environ.get('FUP_CYCLE_DAY') or 1)  # day of the month a cycle starts
+    FUP_STATE_FILE = '/var/lib/bytebill/fup_quota.json'  # cycle usage, read by the load balancer
+    FUP_BURN_WINDOW = 86400  # seconds of usage the burn rate is averaged over
+    FUP_STEERING_ENABLED = True
+    # (projected cycle usage as a share of the allowance, share of WAN2's weight kept), ascending
+    FUP_STEERING = [(0.9, 0.75), (1.0, 0.5), (1.1, 0.25), (1.25, 0.0)]
+    FUP_STEERING_HYSTERESIS = 0.05  # projection must fall this far below a threshold to step back
+    
 class DevelopmentConfig(Config):
     DEBUG = True
     
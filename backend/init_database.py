@@ -73,6 +73,8 @@ def create_tables():
                 type ENUM('hourly', 'daily', 'weekly', 'monthly', 'unlimited') NOT NULL,
                 duration INT NOT NULL COMMENT 'Duration in seconds',
                 data_limit BIGINT NULL COMMENT 'Data limit in bytes, NULL for unlimited',
+                download_kbps INT NULL COMMENT 'Per-client download rate limit, NULL for unshaped',
+                upload_kbps INT NULL COMMENT 'Per-client upload rate limit, NULL for unshaped',
                 price DECIMAL(10, 2) NOT NULL,
                 description TEXT,
                 is_active BOOLEAN DEFAULT TRUE,
@@ -176,13 +178,55 @@ def create_tables():
                 result_desc TEXT,
                 plan_id INT,
                 session_id INT,
+                query_attempts INT DEFAULT 0 COMMENT 'STK Query calls made while pending',
+                last_queried_at TIMESTAMP NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                 FOREIGN KEY (plan_id) REFERENCES plans(id) ON DELETE SET NULL,
                 FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE SET NULL,
                 INDEX idx_checkout_request (checkout_request_id),
                 INDEX idx_phone_number (phone_number),
-                INDEX idx_status (status)
+                INDEX idx_receipt_number (mpesa_receipt_number),
+                INDEX idx_status_created (status, created_at)
+            )
+        """)
+        
+        # M-PESA callback ledger (one row per CheckoutRequestID)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS mpesa_callbacks (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                checkout_request_id VARCHAR(100) NOT NULL,
+                result_code INT,
+                payload TEXT NOT NULL COMMENT 'Raw callback body',
+                received_at TIMESTAMP NOT NULL,
+                applied_at TIMESTAMP NULL,
+                UNIQUE INDEX uq_checkout_request (checkout_request_id),
+                INDEX idx_applied_at (applied_at)
+            )
+        """)
+        
+        # Statement reconciliation runs
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reconciliation_runs (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                statement_file VARCHAR(255) NOT NULL,
+                report_file VARCHAR(255) COMMENT 'CSV of every discrepancy',
+                period_start TIMESTAMP NULL,
+                period_end TIMESTAMP NULL,
+                status VARCHAR(20) DEFAULT 'running',
+                statement_rows INT DEFAULT 0,
+                db_rows INT DEFAULT 0,
+                matched INT DEFAULT 0,
+                missing_in_db INT DEFAULT 0,
+                missing_in_statement INT DEFAULT 0,
+                duplicates INT DEFAULT 0,
+                amount_mismatches INT DEFAULT 0,
+                statement_total DECIMAL(12, 2) DEFAULT 0.00,
+                db_total DECIMAL(12, 2) DEFAULT 0.00,
+                error TEXT,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP NULL,
+                INDEX idx_started_at (started_at)
             )
         """)
         
@@ -216,6 +260,60 @@ def create_tables():
     
     return True
 
+# Columns and indexes added to existing tables since their CREATE TABLE first
+# shipped; CREATE TABLE IF NOT EXISTS leaves an older table as it was
+COLUMN_UPGRADES = [
+    ('plans', 'download_kbps', "INT NULL COMMENT 'Per-client download rate limit, NULL for unshaped' AFTER data_limit"),
+    ('plans', 'upload_kbps', "INT NULL COMMENT 'Per-client upload rate limit, NULL for unshaped' AFTER download_kbps"),
+    ('mpesa_transactions', 'query_attempts', "INT DEFAULT 0 COMMENT 'STK Query calls made while pending' AFTER session_id"),
+    ('mpesa_transactions', 'last_queried_at', "TIMESTAMP NULL AFTER query_attempts"),
+]
+
+INDEX_UPGRADES = [
+    ('mpesa_transactions', 'idx_receipt_number', '(mpesa_receipt_number)'),
+    ('mpesa_transactions', 'idx_status_created', '(status, created_at)'),
+]
+
+def upgrade_tables():
+    """Add columns and indexes missing from tables created by an older version"""
+    try:
+        connection = mysql.connector.connect(**BYTEBILL_DB_CONFIG)
+        cursor = connection.cursor()
+        
+        print("Upgrading existing tables...")
+        database = BYTEBILL_DB_CONFIG['database']
+        
+        for table, column, definition in COLUMN_UPGRADES:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s AND column_name = %s
+            """, (database, table, column))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                print(f"  Added {table}.{column}")
+        
+        for table, index, columns in INDEX_UPGRADES:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.statistics
+                WHERE table_schema = %s AND table_name = %s AND index_name = %s
+            """, (database, table, index))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"ALTER TABLE {table} ADD INDEX {index} {columns}")
+                print(f"  Added index {table}.{index}")
+        
+        connection.commit()
+        print("Tables up to date!")
+        
+    except Error as e:
+        print(f"Error upgrading tables: {e}")
+        return False
+    finally:
+        if connection.is_connected():
+            cursor.close()
+            connection.close()
+    
+    return True
+
 def insert_default_data():
     """Insert default plans and admin user"""
     try:
@@ -226,18 +324,18 @@ def insert_default_data():
         
         # Insert default plans
         plans = [
-            ('1 Hour Basic', 'hourly', 3600, 524288000, 50.00, '1 hour internet access with 500MB data'),
-            ('Daily Standard', 'daily', 86400, 1073741824, 150.00, '24 hours internet access with 1GB data'),
-            ('Daily Premium', 'daily', 86400, 2147483648, 250.00, '24 hours internet access with 2GB data'),
-            ('Weekly Basic', 'weekly', 604800, 5368709120, 500.00, '7 days internet access with 5GB data'),
-            ('Weekly Premium', 'weekly', 604800, 10737418240, 800.00, '7 days internet access with 10GB data'),
-            ('Monthly Unlimited', 'monthly', 2592000, None, 2000.00, '30 days unlimited internet access')
+            ('1 Hour Basic', 'hourly', 3600, 524288000, 2048, 512, 50.00, '1 hour internet access with 500MB data'),
+            ('Daily Standard', 'daily', 86400, 1073741824, 3072, 1024, 150.00, '24 hours internet access with 1GB data'),
+            ('Daily Premium', 'daily', 86400, 2147483648, 6144, 2048, 250.00, '24 hours internet access with 2GB data'),
+            ('Weekly Basic', 'weekly', 604800, 5368709120, 3072, 1024, 500.00, '7 days internet access with 5GB data'),
+            ('Weekly Premium', 'weekly', 604800, 10737418240, 6144, 2048, 800.00, '7 days internet access with 10GB data'),
+            ('Monthly Unlimited', 'monthly', 2592000, None, 10240, 4096, 2000.00, '30 days unlimited internet access')
         ]
         
         for plan in plans:
             cursor.execute("""
-                INSERT IGNORE INTO plans (name, type, duration, data_limit, price, description)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT IGNORE INTO plans (name, type, duration, data_limit, download_kbps, upload_kbps, price, description)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
             """, plan)
         
         # Generate some sample vouchers for testing
@@ -313,6 +411,10 @@ def main():
     if not create_tables():
         return False
     
+    # Bring tables from an older install up to the current schema
+    if not upgrade_tables():
+        return False
+    
     # Insert default data
     if not insert_default_data():
         return False
@@ -341,6 +443,7 @@ if __name__ == '__main__':
         print("- Create the 'bytebill' database")
         print("- Create the 'bytebill' MySQL user")
         print("- Create all necessary tables")
+        print("- Add columns and indexes missing from an older install")
         print("- Insert default plans and sample vouchers")
         sys.exit(0)
     
@@ -3,5 +3,7 @@ from .user import User
 from .plan import Plan
 from .voucher import Voucher
 from .session import Session
+from .transaction import MpesaTransaction, MpesaCallback
+from .reconciliation import ReconciliationRun
 
-__all__ = ['User', 'Plan', 'Voucher', 'Session']
+__all__ = ['User', 'Plan', 'Voucher', 'Session', 'MpesaTransaction', 'MpesaCallback', 'ReconciliationRun']
@@ -19,6 +19,8 @@ class Plan(db.Model):
     type = db.Column(Enum(PlanType), nullable=False)
     duration = db.Column(db.Integer, nullable=False)  # Duration in seconds
     data_limit = db.Column(db.BigInteger, nullable=True)  # Data limit in bytes, NULL for unlimited
+    download_kbps = db.Column(db.Integer, nullable=True)  # Per-client rate limits, NULL for unshaped
+    upload_kbps = db.Column(db.Integer, nullable=True)
     price = db.Column(db.Numeric(10, 2), nullable=False)
     description = db.Column(db.Text, nullable=True)
     is_active = db.Column(db.Boolean, default=True)
@@ -36,6 +38,8 @@ class Plan(db.Model):
             'type': self.type.value,
             'duration': self.duration,
             'data_limit': self.data_limit,
+            'download_kbps': self.download_kbps,
+            'upload_kbps': self.upload_kbps,
             'price': float(self.price),
             'description': self.description,
             'is_active': self.is_active,
@@ -0,0 +1,55 @@
+from database import db
+from datetime import datetime
+
+class ReconciliationRun(db.Model):
+    """Summary of one M-PESA statement reconciliation"""
+    __tablename__ = 'reconciliation_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    statement_file = db.Column(db.String(255), nullable=False)
+    report_file = db.Column(db.String(255), nullable=True)  # CSV of every discrepancy
+    period_start = db.Column(db.DateTime, nullable=True)
+    period_end = db.Column(db.DateTime, nullable=True)
+    status = db.Column(db.String(20), default='running')  # running, completed, failed
+
+    # Counts
+    statement_rows = db.Column(db.Integer, default=0)
+    db_rows = db.Column(db.Integer, default=0)
+    matched = db.Column(db.Integer, default=0)
+    missing_in_db = db.Column(db.Integer, default=0)
+    missing_in_statement = db.Column(db.Integer, default=0)
+    duplicates = db.Column(db.Integer, default=0)
+    amount_mismatches = db.Column(db.Integer, default=0)
+
+    # Totals
+    statement_total = db.Column(db.Numeric(12, 2), default=0)
+    db_total = db.Column(db.Numeric(12, 2), default=0)
+
+    error = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'statement_file': self.statement_file,
+            'report_file': self.report_file,
+            'period_start': self.period_start.isoformat() if self.period_start else None,
+            'period_end': self.period_end.isoformat() if self.period_end else None,
+            'status': self.status,
+            'statement_rows': self.statement_rows,
+            'db_rows': self.db_rows,
+            'matched': self.matched,
+            'missing_in_db': self.missing_in_db,
+            'missing_in_statement': self.missing_in_statement,
+            'duplicates': self.duplicates,
+            'amount_mismatches': self.amount_mismatches,
+            'statement_total': float(self.statement_total or 0),
+            'db_total': float(self.db_total or 0),
+            'error': self.error,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<ReconciliationRun {self.id} {self.status}>'
@@ -0,0 +1,72 @@
+from database import db
+from datetime import datetime
+from sqlalchemy import Enum
+import enum
+
+class TransactionStatus(enum.Enum):
+    PENDING = "pending"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+class MpesaTransaction(db.Model):
+    __tablename__ = 'mpesa_transactions'
+    __table_args__ = (
+        # Serves the pending-payment scan: status = 'pending' AND created_at < cutoff
+        db.Index('idx_status_created', 'status', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    checkout_request_id = db.Column(db.String(100), unique=True, index=True)
+    merchant_request_id = db.Column(db.String(100), nullable=True)
+    phone_number = db.Column(db.String(15), nullable=False)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    mpesa_receipt_number = db.Column(db.String(100), nullable=True, index=True)
+    transaction_date = db.Column(db.DateTime, nullable=True)
+    status = db.Column(Enum(TransactionStatus), default=TransactionStatus.PENDING)
+    result_code = db.Column(db.Integer, nullable=True)
+    result_desc = db.Column(db.Text, nullable=True)
+    plan_id = db.Column(db.Integer, db.ForeignKey('plans.id'), nullable=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=True)
+    query_attempts = db.Column(db.Integer, default=0)  # STK Query calls made while pending
+    last_queried_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'checkout_request_id': self.checkout_request_id,
+            'merchant_request_id': self.merchant_request_id,
+            'phone_number': self.phone_number,
+            'amount': float(self.amount),
+            'mpesa_receipt_number': self.mpesa_receipt_number,
+            'transaction_date': self.transaction_date.isoformat() if self.transaction_date else None,
+            'status': self.status.value,
+            'result_code': self.result_code,
+            'result_desc': self.result_desc,
+            'plan_id': self.plan_id,
+            'session_id': self.session_id,
+            'query_attempts': self.query_attempts,
+            'last_queried_at': self.last_queried_at.isoformat() if self.last_queried_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+    def __repr__(self):
+        return f'<MpesaTransaction {self.checkout_request_id}>'
+
+class MpesaCallback(db.Model):
+    """Ledger of processed STK callbacks, one row per CheckoutRequestID"""
+    __tablename__ = 'mpesa_callbacks'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # The unique index is what makes Safaricom's retries idempotent
+    checkout_request_id = db.Column(db.String(100), nullable=False, unique=True)
+    result_code = db.Column(db.Integer, nullable=True)
+    payload = db.Column(db.Text, nullable=False)  # Raw callback body
+    received_at = db.Column(db.DateTime, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=True, index=True)  # NULL until matched to a transaction
+
+    def __repr__(self):
+        return f'<MpesaCallback {self.checkout_request_id}>'
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+ByteBill M-PESA Statement Reconciliation
+Matches a Safaricom statement export against mpesa_transactions and the
+amount paid on each session, then records a reconciliation run summary.
+
+Both sides are streamed in receipt order and merge-joined, so statements
+with hundreds of thousands of lines reconcile in constant memory.
+"""
+
+import argparse
+import sys
+from datetime import datetime
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile an M-PESA statement CSV against the database')
+    parser.add_argument('statement', help='statement CSV exported from the M-PESA org portal')
+    parser.add_argument('--report', help='discrepancy report CSV (default: <statement>.reconciliation.csv)')
+    parser.add_argument('--from', dest='period_start', type=parse_date,
+                        help='first day to compare (YYYY-MM-DD, default: earliest statement row)')
+    parser.add_argument('--to', dest='period_end', type=parse_date,
+                        help='last day to compare (YYYY-MM-DD, default: latest statement row)')
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help='rows held in memory per sorted run when the statement is unordered')
+    args = parser.parse_args()
+
+    from config import Config
+    Config.MPESA_CALLBACK_CONSUMER_ENABLED = False
+    Config.MPESA_QUERY_ENABLED = False
+
+    from app import create_app
+    from utils.statement_reconciliation import StatementReconciler
+
+    period_end = args.period_end.replace(hour=23, minute=59, second=59) if args.period_end else None
+
+    app = create_app(network_workers=False)
+    with app.app_context():
+        reconciler = StatementReconciler(
+            args.statement,
+            args.report or f"{args.statement}.reconciliation.csv",
+            period_start=args.period_start,
+            period_end=period_end,
+            chunk_size=args.chunk_size
+        )
+        run = reconciler.run()
+
+    summary = run.to_dict()
+    print("M-PESA Statement Reconciliation")
+    print("=" * 40)
+    for field in ['status', 'period_start', 'period_end', 'statement_rows', 'db_rows', 'matched',
+                  'missing_in_db', 'missing_in_statement', 'duplicates', 'amount_mismatches',
+                  'statement_total', 'db_total', 'report_file', 'error']:
+        if summary[field] is not None:
+            print(f"  {field.replace('_', ' ').capitalize():<22} {summary[field]}")
+
+    return run.status == 'completed'
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
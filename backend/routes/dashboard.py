@@ -5,6 +5,7 @@ from models.session import Session, SessionStatus
 from models.voucher import Voucher, VoucherStatus
 from models.user import User
 from models.plan import Plan
+from utils.access_control import revoke_sessions
 from datetime import datetime, timedelta
 from sqlalchemy import func
 
@@ -20,16 +21,18 @@ def get_dashboard_overview():
     active_sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).count()
     
     # Update expired sessions before counting
-    expired_sessions_updated = 0
+    expired_sessions = []
     active_session_objects = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
     for session in active_session_objects:
         if session.is_expired():
             session.status = SessionStatus.EXPIRED
             session.end_time = datetime.utcnow()
-            expired_sessions_updated += 1
+            expired_sessions.append(session)
     
-    if expired_sessions_updated > 0:
+    if expired_sessions:
         db.session.commit()
+        # A session out of data still has time left on its kernel timeout
+        revoke_sessions(expired_sessions)
         active_sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).count()
     
     # Voucher statistics
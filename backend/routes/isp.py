@@ -1,130 +1,50 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
-import psutil
-import subprocess
 import time
 from datetime import datetime
 
-isp_bp = Blueprint('isp', __name__)
-
-def ping_host(host, count=3):
-    """Ping a host and return average response time"""
-    try:
-        result = subprocess.run(
-            ['ping', '-c', str(count), host],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode == 0:
-            lines = result.stdout.split('\n')
-            for line in lines:
-                if 'avg' in line:
-                    # Extract average time from ping output
-                    parts = line.split('/')
-                    if len(parts) >= 5:
-                        return float(parts[4])
-            return 0.0
-        else:
-            return None
-    except Exception as e:
-        print(f"Ping error: {e}")
-        return None
+from config import Config
+from utils.fup import load_quota_state
+from utils.isp_sampler import isp_events, latest_snapshot, load_balancer_state, with_routing_state
+from utils.timeseries import TimeSeriesStore
 
-def get_interface_stats(interface):
-    """Get network interface statistics"""
-    try:
-        stats = psutil.net_io_counters(pernic=True)
-        if interface in stats:
-            return {
-                'bytes_sent': stats[interface].bytes_sent,
-                'bytes_recv': stats[interface].bytes_recv,
-                'packets_sent': stats[interface].packets_sent,
-                'packets_recv': stats[interface].packets_recv,
-                'errin': stats[interface].errin,
-                'errout': stats[interface].errout,
-                'dropin': stats[interface].dropin,
-                'dropout': stats[interface].dropout
-            }
-        return None
-    except Exception as e:
-        print(f"Interface stats error: {e}")
-        return None
+isp_bp = Blueprint('isp', __name__)
 
-def check_interface_status(interface):
-    """Check if network interface is up"""
-    try:
-        addrs = psutil.net_if_addrs()
-        stats = psutil.net_if_stats()
-        
-        if interface in addrs and interface in stats:
-            return {
-                'is_up': stats[interface].isup,
-                'speed': stats[interface].speed,
-                'mtu': stats[interface].mtu,
-                'ip_addresses': [addr.address for addr in addrs[interface] 
-                               if addr.family == 2]  # IPv4 addresses
-            }
-        return None
-    except Exception as e:
-        print(f"Interface status error: {e}")
+def get_interface_stats(sampler, interface):
+    """Get network interface statistics from the sampler's last read"""
+    counters = sampler.counters(interface)
+    if counters is None:
         return None
+    return {
+        'bytes_sent': counters['tx_bytes'],
+        'bytes_recv': counters['rx_bytes'],
+        'packets_sent': counters['tx_packets'],
+        'packets_recv': counters['rx_packets'],
+        'errin': counters['rx_errors'],
+        'errout': counters['tx_errors'],
+        'dropin': counters['rx_drops'],
+        'dropout': counters['tx_drops']
+    }
 
 @isp_bp.route('/status', methods=['GET'])
 @jwt_required()
 def get_isp_status():
-    """Get ISP connection status"""
+    """Get ISP connection status from the latest background sample, with live routing state"""
+    status = latest_snapshot()
+    if status is None:
+        return jsonify({'error': 'ISP status has not been sampled yet'}), 503
     
-    # Test connectivity to common DNS servers
-    test_hosts = ['8.8.8.8', '1.1.1.1', '208.67.222.222']
-    
-    wan1_interface = 'enx1'  # USB-to-Ethernet adapter 1
-    wan2_interface = 'enx2'  # USB-to-Ethernet adapter 2
-    
-    # Check WAN1 status
-    wan1_status = check_interface_status(wan1_interface)
-    wan1_stats = get_interface_stats(wan1_interface)
-    wan1_ping = None
-    if wan1_status and wan1_status['is_up']:
-        wan1_ping = ping_host(test_hosts[0])
-    
-    # Check WAN2 status
-    wan2_status = check_interface_status(wan2_interface)
-    wan2_stats = get_interface_stats(wan2_interface)
-    wan2_ping = None
-    if wan2_status and wan2_status['is_up']:
-        wan2_ping = ping_host(test_hosts[1])
-    
-    # Determine which ISP is primary based on routing table or current config
-    primary_isp = 'wan1'  # Default or based on load balancing logic
-    
-    status = {
-        'timestamp': datetime.now().isoformat(),
-        'wan1': {
-            'name': 'ISP 1 (Unlimited)',
-            'interface': wan1_interface,
-            'status': wan1_status,
-            'stats': wan1_stats,
-            'ping_ms': wan1_ping,
-            'is_connected': wan1_ping is not None,
-            'is_primary': primary_isp == 'wan1'
-        },
-        'wan2': {
-            'name': 'ISP 2 (FUP)',
-            'interface': wan2_interface,
-            'status': wan2_status,
-            'stats': wan2_stats,
-            'ping_ms': wan2_ping,
-            'is_connected': wan2_ping is not None,
-            'is_primary': primary_isp == 'wan2'
-        },
-        'primary_isp': primary_isp,
-        'load_balancing_active': True,  # Based on actual config
-        'failover_active': wan1_ping is None or wan2_ping is None
-    }
+    return jsonify(with_routing_state(status, load_balancer_state()))
+
+@isp_bp.route('/loadbalancer', methods=['GET'])
+@jwt_required()
+def get_load_balancer_state():
+    """Get the load balancer's live routing state, WAN scores, probe schedule and recent probe rounds"""
+    state = load_balancer_state()
+    if state is None:
+        return jsonify({'error': 'The load balancer is not running'}), 503
     
-    return jsonify(status)
+    return jsonify(state)
 
 @isp_bp.route('/speedtest', methods=['POST'])
 @jwt_required()
@@ -165,9 +85,9 @@ def run_speedtest():
 def switch_primary_isp():
     """Switch primary ISP for load balancing"""
     data = request.get_json()
-    new_primary = data.get('primary_isp')  # 'wan1' or 'wan2'
+    new_primary = data.get('primary_isp')  # a WAN name, e.g. 'wan1'
     
-    if new_primary not in ['wan1', 'wan2']:
+    if new_primary not in Config.WANS:
         return jsonify({'error': 'Invalid ISP specified'}), 400
     
     # TODO: Implement actual routing table updates
@@ -183,61 +103,86 @@ def switch_primary_isp():
 @jwt_required()
 def get_bandwidth_usage():
     """Get bandwidth usage statistics"""
+    sampler = current_app.extensions.get('throughput_sampler')
+    if sampler is None:
+        return jsonify({'error': 'Throughput sampling is disabled'}), 503
     
-    wan1_stats = get_interface_stats('enx1')
-    wan2_stats = get_interface_stats('enx2')
-    lan_stats = get_interface_stats('eth0')
+    interfaces = {wan: spec['interface'] for wan, spec in Config.WANS.items()}
+    interfaces['lan'] = Config.LAN_INTERFACE
+    stats = {name: get_interface_stats(sampler, interface) for name, interface in interfaces.items()}
     
-    # Calculate total usage (you might want to store historical data)
+    # Totals are since boot, over every WAN; rates come from the sampler's per-second history
     total_download = 0
     total_upload = 0
     
-    if wan1_stats:
-        total_download += wan1_stats['bytes_recv']
-        total_upload += wan1_stats['bytes_sent']
-    
-    if wan2_stats:
-        total_download += wan2_stats['bytes_recv']
-        total_upload += wan2_stats['bytes_sent']
+    for wan in Config.WANS:
+        if stats[wan]:
+            total_download += stats[wan]['bytes_recv']
+            total_upload += stats[wan]['bytes_sent']
     
     usage = {
         'total_download_bytes': total_download,
         'total_upload_bytes': total_upload,
         'total_download_mb': round(total_download / (1024 * 1024), 2),
         'total_upload_mb': round(total_upload / (1024 * 1024), 2),
-        'wan1_stats': wan1_stats,
-        'wan2_stats': wan2_stats,
-        'lan_stats': lan_stats,
+        'rates': {name: sampler.rates(interface) for name, interface in interfaces.items()},
         'timestamp': datetime.now().isoformat()
     }
+    for name in interfaces:
+        usage[f'{name}_stats'] = stats[name]
     
     return jsonify(usage)
 
+@isp_bp.route('/quota', methods=['GET'])
+@jwt_required()
+def get_fup_quota():
+    """Get the FUP WAN's usage this billing cycle, its projection and how far traffic is steered away"""
+    quota = load_quota_state()
+    if not quota:
+        return jsonify({'error': 'FUP usage has not been sampled yet'}), 503
+    
+    quota['name'] = Config.WANS[quota['wan']]['name'] if quota['wan'] in Config.WANS else quota['wan']
+    quota['steering_enabled'] = Config.FUP_STEERING_ENABLED
+    quota['age_seconds'] = round(max(0.0, time.time() - quota['updated_at']), 3)
+    # The sampler's last counter reading is bookkeeping, not usage
+    quota.pop('counters', None)
+    # Hourly usage over the burn window, for charts
+    quota['hourly'] = [{'hour': datetime.fromtimestamp(hour).isoformat(), 'bytes': used} for hour, used in quota['hourly']]
+    for key in ('cycle_start', 'cycle_end', 'projected_exhaustion'):
+        quota[f'{key}_at'] = datetime.fromtimestamp(quota[key]).isoformat() if quota[key] else None
+    
+    return jsonify(quota)
+
 @isp_bp.route('/logs', methods=['GET'])
 @jwt_required()
 def get_isp_logs():
-    """Get ISP monitoring logs"""
-    # TODO: Implement actual log reading from system logs or database
-    
-    mock_logs = [
-        {
-            'timestamp': '2024-01-01T10:00:00',
-            'level': 'INFO',
-            'message': 'WAN1 connection stable - 15.2 Mbps',
-            'interface': 'wan1'
-        },
-        {
-            'timestamp': '2024-01-01T10:05:00',
-            'level': 'WARNING',
-            'message': 'WAN2 latency increased to 150ms',
-            'interface': 'wan2'
-        },
-        {
-            'timestamp': '2024-01-01T10:10:00',
-            'level': 'INFO',
-            'message': 'Load balancing switched to WAN1',
-            'interface': 'system'
-        }
-    ]
+    """Get ISP monitoring logs derived from the metrics history"""
+    hours = request.args.get('hours', 24, type=float)
+    limit = request.args.get('limit', 100, type=int)
     
-    return jsonify({'logs': mock_logs})
+    end = time.time()
+    logs = isp_events(TimeSeriesStore(), end - hours * 3600, end)
+    
+    return jsonify({'logs': logs[-limit:] if limit > 0 else []})
+
+@isp_bp.route('/history', methods=['GET'])
+@jwt_required()
+def get_isp_history():
+    """Get ISP metric series for charts, e.g. ?series=wan1.rtt_ms&series=wan2.rtt_ms&hours=24"""
+    series = request.args.getlist('series')
+    if not series:
+        return jsonify({'error': 'At least one series is required'}), 400
+    
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - request.args.get('hours', 24, type=float) * 3600, type=float)
+    points = request.args.get('points', 500, type=int)
+    tier = request.args.get('tier')
+    if tier is not None and tier not in Config.METRICS_RETENTION:
+        return jsonify({'error': f'Unknown tier {tier}'}), 400
+    
+    store = TimeSeriesStore()
+    return jsonify({
+        'start': start,
+        'end': end,
+        'series': [store.query(name, start, end, tier=tier, max_points=max(1, points)) for name in series]
+    })
@@ -0,0 +1,77 @@
+from flask import Blueprint, request, jsonify, current_app
+from database import db
+from models.plan import Plan
+from models.session import Session
+from models.transaction import MpesaTransaction
+from utils.mpesa import MPESAError
+from utils.payments import start_mpesa_purchase
+import logging
+
+logger = logging.getLogger(__name__)
+
+mpesa_bp = Blueprint('mpesa', __name__)
+
+@mpesa_bp.route('/callback', methods=['POST'])
+def mpesa_callback():
+    """Receive an STK Push callback from Safaricom.
+
+    The raw body is appended to the durable inbox and acknowledged straight
+    away; parsing, deduplication and session activation happen in the
+    background consumer.
+    """
+    payload = request.get_data(cache=False)
+    if not payload:
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Empty payload'}), 400
+
+    try:
+        current_app.extensions['mpesa_inbox'].append(payload)
+    except OSError as e:
+        # Not acknowledging makes Safaricom retry the callback later
+        logger.error(f"Failed to persist M-PESA callback: {e}")
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Temporarily unavailable'}), 503
+
+    consumer = current_app.extensions.get('mpesa_consumer')
+    if consumer:
+        consumer.notify()
+
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+@mpesa_bp.route('/purchase', methods=['POST'])
+def purchase_plan():
+    """Start an M-PESA purchase from the captive portal"""
+    data = request.get_json() or {}
+    phone_number = data.get('phone_number')
+    mac_address = data.get('mac_address')
+    ip_address = data.get('ip_address')
+
+    if not all([data.get('plan_id'), phone_number, mac_address, ip_address]):
+        return jsonify({'error': 'plan_id, phone_number, mac_address and ip_address required'}), 400
+
+    plan = Plan.query.get(data['plan_id'])
+    if not plan or not plan.is_active:
+        return jsonify({'error': 'Plan not found'}), 404
+
+    try:
+        result = start_mpesa_purchase(plan, phone_number, mac_address, ip_address)
+    except MPESAError as e:
+        db.session.rollback()
+        logger.error(f"M-PESA purchase failed: {e}")
+        return jsonify({'error': 'Payment request failed, please try again'}), 502
+
+    if not result['success']:
+        return jsonify({'error': result.get('error', 'Payment request rejected')}), 400
+
+    return jsonify(result), 201
+
+@mpesa_bp.route('/purchase/<checkout_request_id>', methods=['GET'])
+def get_purchase_status(checkout_request_id):
+    """Poll the state of a purchase (public endpoint for the captive portal)"""
+    txn = MpesaTransaction.query.filter_by(checkout_request_id=checkout_request_id).first_or_404()
+    session = Session.query.get(txn.session_id) if txn.session_id else None
+
+    return jsonify({
+        'checkout_request_id': txn.checkout_request_id,
+        'status': txn.status.value,
+        'result_desc': txn.result_desc,
+        'session': session.to_dict() if session else None
+    })
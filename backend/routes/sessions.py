@@ -3,6 +3,7 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from database import db
 from models.session import Session, SessionStatus
 from models.user import User
+from utils.access_control import revoke_sessions
 from datetime import datetime
 
 sessions_bp = Blueprint('sessions', __name__)
@@ -52,15 +53,17 @@ def get_active_sessions():
     sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
     
     # Update expired sessions
-    expired_count = 0
+    expired = []
     for session in sessions:
         if session.is_expired():
             session.status = SessionStatus.EXPIRED
             session.end_time = datetime.utcnow()
-            expired_count += 1
+            expired.append(session)
     
-    if expired_count > 0:
+    if expired:
         db.session.commit()
+        # A session out of data still has time left on its kernel timeout
+        revoke_sessions(expired)
         # Re-fetch active sessions
         sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
     
@@ -85,9 +88,7 @@ def terminate_session(session_id):
     if session.status == SessionStatus.ACTIVE:
         session.terminate("admin_terminated")
         db.session.commit()
-        
-        # TODO: Implement actual network disconnection logic here
-        # This would involve iptables rules or CoovaChilli commands
+        revoke_sessions([session])
         
         return jsonify({
             'message': f'Session {session_id} terminated successfully',
@@ -102,14 +103,17 @@ def terminate_expired_sessions():
     """Terminate all expired sessions"""
     active_sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
     
-    terminated_count = 0
+    terminated = []
     for session in active_sessions:
         if session.is_expired():
             session.terminate("expired")
-            terminated_count += 1
+            terminated.append(session)
+    terminated_count = len(terminated)
     
     if terminated_count > 0:
         db.session.commit()
+        # Time-expired clients already timed out of the set; data-capped ones have not
+        revoke_sessions(terminated)
     
     return jsonify({
         'message': f'{terminated_count} expired sessions terminated',
@@ -0,0 +1,83 @@
+import logging
+from typing import Iterable
+
+from config import Config
+from models.session import Session, SessionStatus
+from utils.nftables import NftablesManager
+from utils.router import RouterManager
+from utils.shaping import TrafficShaper
+from utils.wan_policy import pin_sessions, unpin_sessions
+
+logger = logging.getLogger(__name__)
+
+def get_firewall():
+    """The access-control backend selected by FIREWALL_BACKEND"""
+    if Config.FIREWALL_BACKEND == 'nftables':
+        return NftablesManager()
+    return RouterManager()
+
+def shaped_clients(sessions: Iterable[Session]):
+    """(ip, download_kbps, upload_kbps) of sessions whose plan has a rate limit"""
+    return [(s.ip_address, s.plan.download_kbps, s.plan.upload_kbps) for s in sessions
+            if s.plan and (s.plan.download_kbps or s.plan.upload_kbps)]
+
+def authorize_sessions(sessions: Iterable[Session]) -> bool:
+    """Admit active sessions' clients until their time runs out.
+
+    Each client is added to the authorized-client ipset with a kernel timeout
+    of the session's `time_remaining`, so access ends at expiry even if the
+    backend is down. With shaping enabled, the client also gets its plan's
+    rate limits, and with the WAN policy enabled, its WAN.
+    """
+    sessions = [s for s in sessions if s.status == SessionStatus.ACTIVE]
+    if not sessions:
+        return True
+
+    success = True
+    if Config.ACCESS_CONTROL_ENABLED:
+        clients = [(s.ip_address, s.mac_address, s.time_remaining) for s in sessions]
+        success = get_firewall().authorize_clients(clients)
+    if Config.SHAPING_ENABLED:
+        success = TrafficShaper().add_clients(shaped_clients(sessions)) and success
+    return pin_sessions(sessions) and success
+
+def revoke_sessions(sessions: Iterable[Session]) -> bool:
+    """Cut off the clients of ended sessions"""
+    sessions = list(sessions)
+    if not sessions:
+        return True
+
+    success = True
+    if Config.ACCESS_CONTROL_ENABLED:
+        success = get_firewall().revoke_clients([(s.ip_address, s.mac_address) for s in sessions])
+    if Config.SHAPING_ENABLED:
+        TrafficShaper().remove_clients([s.ip_address for s in sessions])
+    return unpin_sessions(sessions) and success
+
+def sync_authorized_clients() -> bool:
+    """Rebuild the authorized-client set from the active sessions in the database"""
+    sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
+    clients = [(s.ip_address, s.mac_address, s.time_remaining) for s in sessions]
+    return get_firewall().replace_authorized_clients(clients)
+
+def sync_shaping() -> bool:
+    """Rebuild the shaping hierarchy for the active sessions in the database"""
+    sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
+    return TrafficShaper().setup(shaped_clients(sessions))
+
+def init_access_control(app):
+    """Resync the firewall and traffic shaping with the database on startup"""
+    with app.app_context():
+        if Config.ACCESS_CONTROL_ENABLED:
+            try:
+                if sync_authorized_clients():
+                    logger.info("Authorized-client set synchronized with active sessions")
+            except Exception as e:
+                logger.error(f"Failed to synchronize authorized-client set: {e}")
+
+        if Config.SHAPING_ENABLED:
+            try:
+                if sync_shaping():
+                    logger.info("Traffic shaping synchronized with active sessions")
+            except Exception as e:
+                logger.error(f"Failed to synchronize traffic shaping: {e}")
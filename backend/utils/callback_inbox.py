@@ -0,0 +1,157 @@
+import os
+import time
+import struct
+import zlib
+import threading
+import logging
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Record frame: payload length, CRC32 of payload, receive time (unix seconds)
+RECORD_HEADER = struct.Struct('<IId')
+SEGMENT_PREFIX = 'inbox-'
+SEGMENT_SUFFIX = '.log'
+OFFSET_FILE = 'consumer.offset'
+
+class InboxRecord:
+    __slots__ = ('segment', 'offset', 'end_offset', 'received_at', 'payload')
+
+    def __init__(self, segment, offset, end_offset, received_at, payload):
+        self.segment = segment
+        self.offset = offset
+        self.end_offset = end_offset
+        self.received_at = received_at
+        self.payload = payload
+
+class CallbackInbox:
+    """Append-only, length-prefixed journal of raw callback bodies.
+
+    One segment file per UTC day. Writers only ever append a single framed
+    record with one write() on an O_APPEND descriptor, so concurrent workers
+    never interleave and the request can be acknowledged as soon as the bytes
+    are on disk.
+    """
+
+    def __init__(self, directory: str, fsync: bool = True):
+        self.directory = directory
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._segment = None
+        self._fd = None
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_name(self, timestamp: float) -> str:
+        return f"{SEGMENT_PREFIX}{datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d')}{SEGMENT_SUFFIX}"
+
+    def append(self, payload: bytes) -> None:
+        """Durably append one raw payload"""
+        now = time.time()
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload), now) + payload
+        segment = self.segment_name(now)
+
+        with self._lock:
+            if segment != self._segment:
+                if self._fd is not None:
+                    os.close(self._fd)
+                self._fd = os.open(
+                    os.path.join(self.directory, segment),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o640
+                )
+                self._segment = segment
+
+            os.write(self._fd, record)
+            if self.fsync:
+                os.fdatasync(self._fd)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+                self._segment = None
+
+    def segments(self) -> List[str]:
+        """List segment files in write order"""
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def read_from(self, segment: str, offset: int, limit: int) -> List[InboxRecord]:
+        """Read up to `limit` complete records starting at a segment offset.
+
+        A torn record at the tail (a writer still mid-append) is left for the
+        next read; a corrupt record is skipped with a warning.
+        """
+        records = []
+        path = os.path.join(self.directory, segment)
+
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while len(records) < limit:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+
+                    length, crc, received_at = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        break
+
+                    end_offset = offset + RECORD_HEADER.size + length
+                    if zlib.crc32(payload) != crc:
+                        logger.warning(f"Skipping corrupt inbox record at {segment}:{offset}")
+                    else:
+                        records.append(InboxRecord(segment, offset, end_offset, received_at, payload))
+                    offset = end_offset
+        except FileNotFoundError:
+            pass
+
+        return records
+
+    def iter_pending(self, position: Tuple[str, int], limit: int) -> Iterator[List[InboxRecord]]:
+        """Yield batches of records after a (segment, offset) position"""
+        segment, offset = position
+        for name in self.segments():
+            if segment and name < segment:
+                continue
+            start = offset if name == segment else 0
+            while True:
+                batch = self.read_from(name, start, limit)
+                if not batch:
+                    break
+                yield batch
+                start = batch[-1].end_offset
+
+    def load_position(self) -> Tuple[Optional[str], int]:
+        """Load the consumer's committed (segment, offset)"""
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                segment, offset = f.read().split()
+                return segment, int(offset)
+        except (FileNotFoundError, ValueError):
+            return None, 0
+
+    def save_position(self, segment: str, offset: int) -> None:
+        """Atomically commit the consumer's (segment, offset)"""
+        path = os.path.join(self.directory, OFFSET_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(f"{segment} {offset}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def prune(self, segment: str, grace_seconds: int = 300) -> int:
+        """Delete fully consumed segments older than the current one"""
+        current = self.segment_name(time.time() - grace_seconds)
+        removed = 0
+        for name in self.segments():
+            if name < segment and name < current:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+        return removed
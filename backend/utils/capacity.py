@@ -0,0 +1,146 @@
+import os
+import json
+import logging
+from collections import deque
+from typing import Dict, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+DIRECTIONS = ('download', 'upload')
+
+class WanCapacity:
+    """Achievable throughput of one WAN, inferred from its own traffic.
+
+    While probe RTT sits well above its unloaded baseline the link is
+    queueing, so the traffic peak at that moment is what it can carry; those
+    peaks are smoothed into the estimate. Peaks without queueing only prove
+    a lower bound: they raise an estimate they exceed, and before the first
+    estimate they are kept apart as the floor, which weights nothing. A speed
+    test result replaces the estimate outright.
+    """
+
+    def __init__(self, state: Optional[Dict] = None):
+        state = state or {}
+        self.source = state.get('source')
+        self.bps = {direction: state.get(f'{direction}_bps') if self.source else None for direction in DIRECTIONS}
+        # Without a source a saved figure is a lower bound from an older release
+        self.floor = {direction: state.get(f'{direction}_floor_bps') or (None if self.source else state.get(f'{direction}_bps'))
+                      for direction in DIRECTIONS}
+        self.updated_at = state.get('updated_at')
+        self.last_test = state.get('last_test')
+        # (timestamp, rtt) over the baseline window; (timestamp, bps) over the idle window
+        self.rtts = deque()
+        self.traffic = deque()
+
+    def baseline(self) -> Optional[float]:
+        return min((rtt for _, rtt in self.rtts), default=None)
+
+    def observe(self, timestamp: float, rtt_ms: Optional[float], rx_peak_bps: Optional[float],
+                tx_peak_bps: Optional[float], average_bps: Optional[float]) -> bool:
+        """Fold in one sample; returns whether an estimate changed"""
+        baseline = self.baseline()
+        inflated = (rtt_ms is not None and baseline is not None
+                    and rtt_ms - baseline >= Config.CAPACITY_RTT_INFLATION_MS)
+
+        changed = False
+        for direction, peak in zip(DIRECTIONS, (rx_peak_bps, tx_peak_bps)):
+            if peak is None or peak < Config.CAPACITY_MIN_SAMPLE_BPS:
+                continue
+            current = self.bps[direction]
+            known = current if current is not None else self.floor[direction]
+            # Queueing with this direction well below its known capacity is the other direction's doing
+            if inflated and (known is None or peak >= known * Config.CAPACITY_SATURATION_SHARE):
+                # The first estimate is never below what the link was already seen carrying
+                self.bps[direction] = max(peak, known or 0) if current is None else current + Config.CAPACITY_SMOOTHING * (peak - current)
+                self.updated_at, self.source = timestamp, 'passive'
+                changed = True
+            elif current is not None and peak > current:
+                self.bps[direction] = peak
+                changed = True
+            elif current is None and (known is None or peak > known):
+                self.floor[direction] = peak
+
+        if rtt_ms is not None:
+            self.rtts.append((timestamp, rtt_ms))
+        while self.rtts and self.rtts[0][0] < timestamp - Config.CAPACITY_BASELINE_WINDOW:
+            self.rtts.popleft()
+        if average_bps is not None:
+            self.traffic.append((timestamp, average_bps))
+        while self.traffic and self.traffic[0][0] < timestamp - Config.CAPACITY_IDLE_SECONDS:
+            self.traffic.popleft()
+        return changed
+
+    def measured(self, timestamp: float, download_bps: Optional[float], upload_bps: Optional[float]):
+        """Take a speed test result as the estimate"""
+        for direction, bps in zip(DIRECTIONS, (download_bps, upload_bps)):
+            if bps:
+                self.bps[direction] = bps
+        self.updated_at, self.source = timestamp, 'active'
+
+    def is_stale(self, now: float) -> bool:
+        return self.updated_at is None or now - self.updated_at > Config.CAPACITY_STALE_AFTER
+
+    def is_idle(self, now: float) -> bool:
+        """Light traffic for the whole idle window"""
+        if not self.traffic or self.traffic[0][0] > now - Config.CAPACITY_IDLE_SECONDS + Config.ISP_SAMPLE_INTERVAL:
+            return False
+        return all(bps < Config.CAPACITY_IDLE_BPS for _, bps in self.traffic)
+
+    def needs_test(self, now: float) -> bool:
+        """A speed test costs quota and saturates the link, so only a stale estimate on an idle link gets one"""
+        if self.last_test is not None and now - self.last_test < Config.CAPACITY_MIN_TEST_INTERVAL:
+            return False
+        return self.is_stale(now) and self.is_idle(now)
+
+    def state(self, now: Optional[float] = None) -> Dict:
+        state = {
+            'download_bps': self.bps['download'],
+            'upload_bps': self.bps['upload'],
+            'download_floor_bps': self.floor['download'],
+            'upload_floor_bps': self.floor['upload'],
+            'updated_at': self.updated_at,
+            'source': self.source,
+            'last_test': self.last_test
+        }
+        if now is not None:
+            state['baseline_rtt_ms'] = self.baseline()
+            state['is_stale'] = self.is_stale(now)
+        return state
+
+class CapacityEstimator:
+    """Capacity estimates of every WAN, kept in `CAPACITY_FILE` so they survive
+    restarts and the load balancer can weight links by them"""
+
+    def __init__(self, wans):
+        self.path = Config.CAPACITY_FILE
+        saved = self.load()
+        self.wans = {wan: WanCapacity(saved.get(wan)) for wan in wans}
+
+    def __getitem__(self, wan: str) -> WanCapacity:
+        return self.wans[wan]
+
+    def load(self) -> Dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring capacity estimates in {self.path}: {e}")
+            return {}
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({wan: capacity.state() for wan, capacity in self.wans.items()}, f)
+        os.replace(temp_path, self.path)
+
+def load_capacity_estimates() -> Dict[str, Dict]:
+    """The saved estimates per WAN key; empty before the first estimate"""
+    try:
+        with open(Config.CAPACITY_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
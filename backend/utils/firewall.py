@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Order iptables-restore expects tables in
+TABLE_ORDER = ['raw', 'mangle', 'nat', 'filter']
+
+# Largest timeout ipset accepts (about 24.8 days); longer sessions are refreshed by the reconciler
+IPSET_MAX_TIMEOUT = 2147483
+
+class RuleBatch:
+    """An iptables change set applied in one `iptables-restore --noflush` call.
+
+    Rules are grouped per table and each table is committed as a unit: a
+    rejected table is left untouched, but tables committed before it in
+    the same batch stay applied. Hundreds of rules cost a single process
+    spawn.
+    """
+
+    def __init__(self):
+        self.tables = OrderedDict()
+
+    def _lines(self, table: str) -> List[str]:
+        return self.tables.setdefault(table, [])
+
+    def chain(self, table: str, chain: str):
+        """Declare a user chain; with --noflush this creates it or empties it"""
+        self._lines(table).append(f":{chain} - [0:0]")
+        return self
+
+    def flush(self, table: str, chain: Optional[str] = None):
+        self._lines(table).append(f"-F {chain}" if chain else "-F")
+        return self
+
+    def append(self, table: str, chain: str, rule: List[str]):
+        self._lines(table).append(f"-A {chain} {format_rule(rule)}")
+        return self
+
+    def insert(self, table: str, chain: str, rule: List[str], position: int = 1):
+        self._lines(table).append(f"-I {chain} {position} {format_rule(rule)}")
+        return self
+
+    def delete(self, table: str, chain: str, rule: List[str]):
+        self._lines(table).append(f"-D {chain} {format_rule(rule)}")
+        return self
+
+    def extend(self, other: 'RuleBatch'):
+        for table, lines in other.tables.items():
+            self._lines(table).extend(lines)
+        return self
+
+    def is_empty(self) -> bool:
+        return not any(self.tables.values())
+
+    def __len__(self):
+        return sum(len(lines) for lines in self.tables.values())
+
+    def render(self) -> str:
+        """Render the batch in iptables-restore format"""
+        output = []
+        tables = sorted(self.tables, key=lambda t: TABLE_ORDER.index(t) if t in TABLE_ORDER else len(TABLE_ORDER))
+        for table in tables:
+            lines = self.tables[table]
+            if not lines:
+                continue
+            output.append(f"*{table}")
+            # Chain declarations must precede the rules that reference them
+            output.extend(line for line in lines if line.startswith(':'))
+            output.extend(line for line in lines if not line.startswith(':'))
+            output.append("COMMIT")
+        return '\n'.join(output) + '\n'
+
+def format_arg(arg: str) -> str:
+    """Quote an argument the way iptables-save does: double quotes, and only when needed"""
+    if arg and not any(c.isspace() or c in '"\'' for c in arg):
+        return arg
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def format_rule(rule: List[str]) -> str:
+    return ' '.join(format_arg(arg) for arg in rule)
+
+def parse_saved_chains(saved: str) -> Dict[str, Dict[str, List[str]]]:
+    """Rules of every chain in iptables-save output, in order: {table: {chain: [rule, ...]}}
+
+    Each rule is the text after '-A CHAIN ', so it compares equal to
+    format_rule() of a rule written the way iptables-save prints it.
+    """
+    tables = OrderedDict()
+    chains = None
+    for line in (saved or '').splitlines():
+        if line.startswith('*'):
+            chains = tables.setdefault(line[1:], OrderedDict())
+        elif chains is None:
+            continue
+        elif line.startswith(':'):
+            chains.setdefault(line[1:].split(' ', 1)[0], [])
+        elif line.startswith('-A '):
+            chain, _, rule = line[3:].partition(' ')
+            chains.setdefault(chain, []).append(rule)
+    return tables
+
+class SetBatch:
+    """ipset commands applied in one `ipset restore -exist` call.
+
+    -exist makes creating an existing set or deleting a missing member a
+    no-op, and re-adding a member refreshes its timeout.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def create(self, name: str, set_type: str, **options):
+        args = ' '.join(f"{key} {value}" for key, value in options.items())
+        self.lines.append(f"create {name} {set_type} {args}".strip())
+        return self
+
+    def add(self, name: str, member: str, timeout: Optional[int] = None):
+        # A larger timeout fails the restore from that line on
+        if timeout is not None:
+            timeout = min(int(timeout), IPSET_MAX_TIMEOUT)
+        self.lines.append(f"add {name} {member}" + (f" timeout {timeout}" if timeout is not None else ''))
+        return self
+
+    def delete(self, name: str, member: str):
+        self.lines.append(f"del {name} {member}")
+        return self
+
+    def flush(self, name: str):
+        self.lines.append(f"flush {name}")
+        return self
+
+    def swap(self, name: str, other: str):
+        self.lines.append(f"swap {name} {other}")
+        return self
+
+    def destroy(self, name: str):
+        self.lines.append(f"destroy {name}")
+        return self
+
+    def is_empty(self) -> bool:
+        return not self.lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def render(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+def client_member(ip_address: str, mac_address: str) -> str:
+    """A hash:ip,mac set member"""
+    return f"{ip_address},{mac_address.lower()}"
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import calendar
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+def cycle_bounds(now: float) -> Tuple[float, float]:
+    """Start and end of the billing cycle containing `now`, in local time"""
+    today = datetime.fromtimestamp(now)
+
+    def cycle_day(year, month):
+        # A cycle day past the end of a short month falls on its last day
+        return datetime(year, month, min(Config.FUP_CYCLE_DAY, calendar.monthrange(year, month)[1]))
+
+    start = cycle_day(today.year, today.month)
+    if today < start:
+        year, month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+        start = cycle_day(year, month)
+    year, month = (start.year, start.month + 1) if start.month < 12 else (start.year + 1, 1)
+    return start.timestamp(), cycle_day(year, month).timestamp()
+
+class QuotaTracker:
+    """Bytes used of the FUP WAN's allowance in the current billing cycle.
+
+    The ISP sampler passes the WAN's byte counters every round. The total,
+    an hourly history and the last counters with the boot they were read in
+    are kept in `FUP_STATE_FILE`, so traffic between the last sample before a
+    restart or sampler handover and the first one after it is still counted;
+    after a reboot, or an adapter replug that resets the counters, everything
+    the new counters show is added. The
+    burn rate over `FUP_BURN_WINDOW` projects usage to the end of the cycle,
+    and that projection sets how much of the FUP WAN's balancing weight new
+    connections still get.
+    """
+
+    def __init__(self):
+        self.path = Config.FUP_STATE_FILE
+        self.quota = Config.FUP_QUOTA_BYTES
+        state = load_quota_state()
+        self.cycle_start = state.get('cycle_start')
+        self.used = state.get('used_bytes', 0)
+        # [hour start, bytes] for the burn rate window
+        self.hourly = [list(entry) for entry in state.get('hourly', [])]
+        self.steering_factor = state.get('steering_factor', 1.0)
+        # {'boot_id', 'interface', 'bytes'} of the last counter reading
+        self.counters = state.get('counters')
+
+    def add_counters(self, interface: str, total_bytes: int, timestamp: float):
+        """Count the traffic since the last reading of the WAN's rx + tx byte counters"""
+        boot_id = read_boot_id()
+        previous = self.counters
+        if previous and previous.get('interface') == interface:
+            if previous.get('boot_id') == boot_id and total_bytes >= previous['bytes']:
+                self.add(total_bytes - previous['bytes'], timestamp)
+            else:
+                # The counters restarted from zero since the last reading
+                self.add(total_bytes, timestamp)
+        self.counters = {'boot_id': boot_id, 'interface': interface, 'bytes': total_bytes}
+
+    def add(self, used_bytes: int, timestamp: float):
+        start, _ = cycle_bounds(timestamp)
+        if self.cycle_start != start:
+            if self.cycle_start is not None:
+                logger.info(f"New FUP billing cycle; {self.used / 1e9:.2f} GB used in the last one")
+            self.cycle_start, self.used = start, 0
+        self.used += used_bytes
+
+        hour = timestamp - timestamp % 3600
+        if self.hourly and self.hourly[-1][0] == hour:
+            self.hourly[-1][1] += used_bytes
+        else:
+            self.hourly.append([hour, used_bytes])
+        self.hourly = [entry for entry in self.hourly if entry[0] > timestamp - Config.FUP_BURN_WINDOW - 3600]
+
+    def burn_rate(self, now: float) -> Optional[float]:
+        """Bytes per second over the burn window, or None with too little history"""
+        if not self.hourly:
+            return None
+        since = max(self.hourly[0][0], now - Config.FUP_BURN_WINDOW)
+        if now - since < 600:
+            return None
+        return sum(used for hour, used in self.hourly if hour + 3600 > since) / (now - since)
+
+    def projection(self, now: float) -> Dict:
+        _, cycle_end = cycle_bounds(now)
+        rate = self.burn_rate(now)
+        projected = self.used + rate * (cycle_end - now) if rate is not None else None
+        exhaustion = None
+        if self.used >= self.quota:
+            exhaustion = now
+        elif rate:
+            exhaustion = now + (self.quota - self.used) / rate
+            exhaustion = exhaustion if exhaustion < cycle_end else None
+        return {'cycle_end': cycle_end, 'burn_rate_bps': rate * 8 if rate is not None else None,
+                'projected_bytes': projected, 'projected_exhaustion': exhaustion}
+
+    def update_steering(self, projected_bytes: Optional[float]) -> float:
+        """Share of its weight the FUP WAN keeps, from the deepest `FUP_STEERING` threshold the
+        projection has crossed; stepping back up needs `FUP_STEERING_HYSTERESIS` of margin"""
+        if projected_bytes is None:
+            return self.steering_factor
+        share = projected_bytes / self.quota
+        factor = 1.0
+        for threshold, weight_share in Config.FUP_STEERING:
+            if share >= threshold:
+                factor = weight_share
+        if factor > self.steering_factor:
+            relaxed = 1.0
+            for threshold, weight_share in Config.FUP_STEERING:
+                if share >= threshold - Config.FUP_STEERING_HYSTERESIS:
+                    relaxed = weight_share
+            factor = max(relaxed, self.steering_factor)
+        if factor != self.steering_factor:
+            logger.info(f"FUP projection at {share:.0%} of the allowance; WAN weight share now {factor:.0%}")
+            self.steering_factor = factor
+        return factor
+
+    def state(self, now: Optional[float] = None) -> Dict:
+        now = now or time.time()
+        projection = self.projection(now)
+        self.update_steering(projection['projected_bytes'])
+        return dict({
+            'wan': Config.FUP_WAN,
+            'quota_bytes': self.quota,
+            'used_bytes': self.used,
+            'used_percent': round(self.used / self.quota * 100, 2),
+            'cycle_start': self.cycle_start,
+            'steering_factor': self.steering_factor,
+            'counters': self.counters,
+            'updated_at': now,
+            'hourly': self.hourly
+        }, **projection)
+
+    def save(self, now: Optional[float] = None) -> Dict:
+        state = self.state(now)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+        return state
+
+def read_boot_id() -> Optional[str]:
+    """Kernel boot id; interface counters start over when it changes"""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def load_quota_state() -> Dict:
+    """The last saved quota state; empty before the first sample"""
+    try:
+        with open(Config.FUP_STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def steering_factor() -> float:
+    """Share of its balancing weight the FUP WAN keeps for new connections"""
+    if not Config.FUP_STEERING_ENABLED:
+        return 1.0
+    return load_quota_state().get('steering_factor', 1.0)
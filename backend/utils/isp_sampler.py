@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config import Config
+from utils.capacity import CapacityEstimator
+from utils.fup import QuotaTracker
+from utils.monitor import NetworkMonitor
+from utils.payments import try_lock
+from utils.prober import WanProber
+from utils.shared_state import read_shared
+from utils.timeseries import TimeSeriesStore
+
+logger = logging.getLogger(__name__)
+
+class IspSampler:
+    """Collects ISP health on a fixed cadence for /api/isp/status.
+
+    One process across workers holds the lock and samples: interface state
+    and counters, then one probe round of every host over every WAN, each
+    bound to its interface. Each snapshot is written atomically to
+    `ISP_STATUS_FILE`, which every worker serves from, so a status request
+    never probes and probe traffic does not grow with dashboard viewers.
+
+    The sampler is also the only writer of the metrics store: every sample's
+    probe results and WAN throughput, and each new speed test result. The
+    same samples feed the passive capacity estimates, and the sampler runs a
+    speed test itself only for a WAN whose estimate is stale while it is idle.
+    The FUP WAN's byte counts go to its quota tracker.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.interval = Config.ISP_SAMPLE_INTERVAL
+        self.monitor = NetworkMonitor()
+        self.prober = WanProber()
+        self.store = TimeSeriesStore()
+        self.wans = {wan: (spec['interface'], spec['name']) for wan, spec in Config.WANS.items()}
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+        # wan -> (time, counters) of the previous sample, for throughput
+        self._previous = {}
+        self._speedtest_mtime = None
+        self.capacity = CapacityEstimator(self.wans)
+        # (wan, timestamp, result) of finished speed tests, and whether one is running
+        self._test_results = deque()
+        self._testing = False
+        self.quota = QuotaTracker()
+
+    def sample(self) -> Dict:
+        sampled_at = time.time()
+        states = {wan: (self.monitor.get_interface_status(interface), self.monitor.get_interface_stats(interface))
+                  for wan, (interface, _) in self.wans.items()}
+        ready = [self.wans[wan][0] for wan, (status, _) in states.items() if status and status['is_up']]
+        summaries = self.prober.run(ready) if ready else {}
+
+        snapshot = {
+            'timestamp': datetime.fromtimestamp(sampled_at).isoformat(),
+            'sampled_at': sampled_at
+        }
+        for wan, (interface, name) in self.wans.items():
+            status, stats = states[wan]
+            summary = summaries.get(interface)
+            snapshot[wan] = {
+                'name': name,
+                'interface': interface,
+                'status': status,
+                'stats': stats,
+                'ping_ms': summary['latency'] if summary else None,
+                'jitter_ms': summary['jitter'] if summary else None,
+                'packet_loss': summary['packet_loss'] if summary else None,
+                'is_connected': bool(summary and summary['online'])
+            }
+        return with_routing_state(snapshot, load_balancer_state())
+
+    def write(self, snapshot: Dict):
+        temp_path = f"{Config.ISP_STATUS_FILE}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, Config.ISP_STATUS_FILE)
+
+    def record(self, snapshot: Dict) -> Dict[str, tuple]:
+        """Append a snapshot's probe results and WAN throughput to the metrics store;
+        returns the average (rx, tx) bps per WAN since the previous sample"""
+        timestamp = snapshot['sampled_at']
+        throughput = {}
+        for wan in self.wans:
+            state = snapshot[wan]
+            self.store.append(f'{wan}.online', 1 if state['is_connected'] else 0, timestamp)
+            for metric, key in (('rtt_ms', 'ping_ms'), ('jitter_ms', 'jitter_ms'), ('loss_pct', 'packet_loss')):
+                if state[key] is not None:
+                    self.store.append(f'{wan}.{metric}', state[key], timestamp)
+
+            stats, previous = state['stats'], self._previous.get(wan)
+            if stats and previous:
+                elapsed = timestamp - previous[0]
+                received = stats['bytes_recv'] - previous[1]['bytes_recv']
+                sent = stats['bytes_sent'] - previous[1]['bytes_sent']
+                # Counters go backwards when the adapter is replugged
+                if elapsed > 0 and received >= 0 and sent >= 0:
+                    throughput[wan] = (received * 8 / elapsed, sent * 8 / elapsed)
+                    self.store.append(f'{wan}.rx_bps', throughput[wan][0], timestamp)
+                    self.store.append(f'{wan}.tx_bps', throughput[wan][1], timestamp)
+            if stats and wan == Config.FUP_WAN:
+                # Diffed against the counters saved with the quota, which survive restarts
+                self.quota.add_counters(state['interface'], stats['bytes_recv'] + stats['bytes_sent'], timestamp)
+            self._previous[wan] = (timestamp, stats) if stats else None
+        return throughput
+
+    def record_test(self, wan: str, timestamp: float, result: Dict):
+        """Append one speed test result and take it as the WAN's capacity estimate"""
+        succeeded = result.get('status') == 'success'
+        # A result already in the store, e.g. from before a restart, is refused here
+        if not self.store.append(f'{wan}.speedtest_ok', 1 if succeeded else 0, timestamp):
+            return
+        if not succeeded:
+            return
+        for metric, key in (('download_mbps', 'download_mbps'), ('upload_mbps', 'upload_mbps'),
+                            ('speedtest_ping_ms', 'ping_ms')):
+            if result.get(key) is not None:
+                self.store.append(f'{wan}.{metric}', result[key], timestamp)
+        self.capacity[wan].measured(timestamp, (result.get('download_mbps') or 0) * 1000000,
+                                    (result.get('upload_mbps') or 0) * 1000000)
+
+    def record_speedtest(self):
+        """Append the latest isp_speedtest.sh results once"""
+        try:
+            mtime = os.stat(Config.SPEEDTEST_RESULTS_FILE).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._speedtest_mtime:
+            return
+        with open(Config.SPEEDTEST_RESULTS_FILE) as f:
+            results = json.load(f)
+        self._speedtest_mtime = mtime
+
+        for wan in self.wans:
+            result = results.get(wan) or {}
+            if result.get('timestamp'):
+                self.record_test(wan, datetime.fromisoformat(result['timestamp']).timestamp(), result)
+
+    def estimate(self, snapshot: Dict, throughput: Dict[str, tuple]):
+        """Feed the sample into the capacity estimates"""
+        sampler = self.app.extensions.get('throughput_sampler') if self.app else None
+        for wan, (interface, _) in self.wans.items():
+            if wan not in throughput:
+                continue
+            # Per-second peaks show saturation that a 10 second average smooths away
+            peak = sampler.peak(interface, self.interval) if sampler else None
+            rx_peak, tx_peak = (peak['rx_bps'], peak['tx_bps']) if peak else throughput[wan]
+            self.capacity[wan].observe(snapshot['sampled_at'], snapshot[wan]['ping_ms'],
+                                       rx_peak, tx_peak, sum(throughput[wan]))
+
+    def schedule_test(self, snapshot: Dict):
+        """Start a speed test in the background for at most one WAN that needs one"""
+        if not Config.CAPACITY_ACTIVE_TESTS_ENABLED or self._testing:
+            return
+        now = snapshot['sampled_at']
+        for wan, (interface, name) in self.wans.items():
+            if snapshot[wan]['is_connected'] and self.capacity[wan].needs_test(now):
+                logger.info(f"Capacity estimate of {name} is stale and the link is idle; running a speed test")
+                self.capacity[wan].last_test = now
+                self._testing = True
+                threading.Thread(target=self.speed_test, args=(wan, interface), name='speed-test', daemon=True).start()
+                return
+
+    def speed_test(self, wan: str, interface: str):
+        try:
+            result = self.monitor.run_speed_test(interface)
+            self._test_results.append((wan, time.time(), dict(result, status='success') if result else {'status': 'failed'}))
+        finally:
+            self._testing = False
+
+    def run_once(self):
+        try:
+            snapshot = self.sample()
+        except Exception as e:
+            logger.error(f"ISP sampling failed: {e}")
+            return
+        try:
+            while self._test_results:
+                self.record_test(*self._test_results.popleft())
+            self.record_speedtest()
+            self.estimate(snapshot, self.record(snapshot))
+            self.capacity.save()
+        except Exception as e:
+            logger.error(f"Recording ISP metrics failed: {e}")
+        for wan in self.wans:
+            snapshot[wan]['capacity'] = self.capacity[wan].state(snapshot['sampled_at'])
+        try:
+            quota = self.quota.save(snapshot['sampled_at'])
+            snapshot[Config.FUP_WAN]['quota'] = {key: value for key, value in quota.items()
+                                                  if key not in ('hourly', 'counters')}
+        except Exception as e:
+            logger.error(f"Saving FUP quota failed: {e}")
+        try:
+            self.write(snapshot)
+        except Exception as e:
+            logger.error(f"Writing ISP status failed: {e}")
+        self.schedule_test(snapshot)
+
+    def run(self):
+        """Sample on start, then every `ISP_SAMPLE_INTERVAL` seconds"""
+        while True:
+            if self._lock_fd is None:
+                self._lock_fd = try_lock(Config.ISP_SAMPLER_LOCK_FILE)
+                if self._lock_fd is not None:
+                    # Taking over from another worker; pick up what it saved
+                    self.capacity = CapacityEstimator(self.wans)
+                    self.quota = QuotaTracker()
+            if self._lock_fd is not None:
+                self.run_once()
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        os.makedirs(os.path.dirname(Config.ISP_SAMPLER_LOCK_FILE), exist_ok=True)
+        os.makedirs(Config.METRICS_DIR, exist_ok=True)
+        self._thread = threading.Thread(target=self.run, name='isp-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+# (mtime_ns, snapshot) of the last status file read by this process
+_latest = (None, None)
+
+def latest_snapshot() -> Optional[Dict]:
+    """The last written snapshot with its age, re-read only when the file changes"""
+    global _latest
+    try:
+        mtime = os.stat(Config.ISP_STATUS_FILE).st_mtime_ns
+        if mtime != _latest[0]:
+            with open(Config.ISP_STATUS_FILE) as f:
+                _latest = (mtime, json.load(f))
+    except (OSError, ValueError) as e:
+        if _latest[1] is None:
+            logger.debug(f"No ISP status snapshot: {e}")
+            return None
+
+    snapshot = dict(_latest[1])
+    snapshot['age_seconds'] = round(max(0.0, time.time() - snapshot['sampled_at']), 3)
+    # A snapshot several intervals old means no process is sampling
+    snapshot['is_stale'] = snapshot['age_seconds'] > 3 * Config.ISP_SAMPLE_INTERVAL
+    return snapshot
+
+def load_balancer_state() -> Optional[Dict]:
+    """Live state published by the load balancer daemon, with the WAN it prefers and its age"""
+    state = read_shared(Config.LOADBALANCER_STATE_FILE)
+    if state is None:
+        return None
+    state['age_seconds'] = round(max(0.0, time.time() - state['updated_at']), 3)
+    # The daemon publishes after every probe round, and stable WANs are probed this rarely
+    state['is_stale'] = state['age_seconds'] > 3 * Config.WAN_PROBE_MAX_INTERVAL
+    wans = {interface: wan for wan, interface in state['wans'].items()}
+    state['load_balancing_active'] = state['current_primary'] == 'load_balanced'
+    primary = state['preferred_interface'] if state['load_balancing_active'] else state['current_primary']
+    state['primary_isp'] = wans.get(primary)
+    return state
+
+def with_routing_state(snapshot: Dict, balancer: Optional[Dict]) -> Dict:
+    """Snapshot with which WAN carries traffic, from the load balancer while it is running"""
+    live = balancer is not None and not balancer['is_stale']
+    snapshot['primary_isp'] = balancer['primary_isp'] if live else None
+    snapshot['load_balancing_active'] = balancer['load_balancing_active'] if live else None
+    in_service = []
+    for wan in Config.WANS:
+        if wan not in snapshot:
+            continue
+        interface = balancer['wans'].get(wan) if live else None
+        health = balancer['scores']['wans'].get(interface) if interface else None
+        # A copy, since cached snapshots are shared between requests
+        snapshot[wan] = dict(snapshot[wan], is_primary=live and snapshot['primary_isp'] == wan,
+                             in_service=health['in_service'] if health else None,
+                             score=health['score'] if health else None)
+        # Some WAN's share of traffic has failed over to the others
+        in_service.append(health['in_service'] if live and health else snapshot[wan]['is_connected'])
+    snapshot['failover_active'] = not all(in_service)
+    return snapshot
+
+def isp_events(store: TimeSeriesStore, start: float, end: float) -> List[Dict]:
+    """Log entries derived from the metrics store: WANs going offline and
+    back, latency crossing `ISP_LATENCY_WARNING_MS`, and speed test results"""
+    events = []
+
+    def add(timestamp, level, message, interface):
+        events.append((timestamp, {'timestamp': datetime.fromtimestamp(timestamp).isoformat(), 'level': level,
+                                   'message': message, 'interface': interface}))
+
+    for wan, name in ((wan, spec['name']) for wan, spec in Config.WANS.items()):
+        # As fine as the retained tiers allow
+        online = store.query(f'{wan}.online', start, end, max_points=100000)
+        previous = None
+        for timestamp, value in zip(online['t'], online['avg']):
+            up = value >= 0.5
+            if previous is not None and up != previous:
+                add(timestamp, 'INFO' if up else 'WARNING',
+                    f"{name} is back online" if up else f"{name} went offline", wan)
+            previous = up
+
+        latency = store.query(f'{wan}.rtt_ms', start, end, tier='minute')
+        high = False
+        for timestamp, value in zip(latency['t'], latency['avg']):
+            if (value > Config.ISP_LATENCY_WARNING_MS) != high:
+                high = not high
+                add(timestamp, 'WARNING' if high else 'INFO',
+                    f"{name} latency {'increased' if high else 'back'} to {value:.0f}ms", wan)
+
+        tests = store.query(f'{wan}.speedtest_ok', start, end, tier='raw')
+        downloads = store.query(f'{wan}.download_mbps', start, end, tier='raw')
+        uploads = store.query(f'{wan}.upload_mbps', start, end, tier='raw')
+        downloads = dict(zip(downloads['t'], downloads['avg']))
+        uploads = dict(zip(uploads['t'], uploads['avg']))
+        for timestamp, succeeded in zip(tests['t'], tests['avg']):
+            if succeeded and timestamp in downloads:
+                add(timestamp, 'INFO', f"{name} speed test - {downloads[timestamp]:.1f} Mbps down, "
+                                       f"{uploads.get(timestamp, 0):.1f} Mbps up", wan)
+            elif not succeeded:
+                add(timestamp, 'ERROR', f"{name} speed test failed", wan)
+
+    events.sort(key=lambda event: event[0])
+    return [event for _, event in events]
+
+def init_isp_sampler(app):
+    """Start background ISP health sampling for this app"""
+    if Config.ISP_SAMPLER_ENABLED:
+        sampler = IspSampler(app)
+        sampler.start()
+        app.extensions['isp_sampler'] = sampler
@@ -4,79 +4,51 @@ import psutil
 import logging
 from datetime import datetime
 
+from config import Config
+from utils.prober import WanProber
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class NetworkMonitor:
     def __init__(self):
-        self.wan1_interface = 'enx1'
-        self.wan2_interface = 'enx2'
+        # WAN name -> interface
+        self.wan_interfaces = {name: wan['interface'] for name, wan in Config.WANS.items()}
         self.lan_interface = 'eth0'
-        self.test_hosts = ['8.8.8.8', '1.1.1.1', '208.67.222.222']
+        self.test_hosts = Config.PROBE_HOSTS
         
     def ping_host(self, host, interface=None, count=3, timeout=10):
         """Ping a host through specific interface"""
-        try:
-            cmd = ['ping', '-c', str(count), '-W', str(timeout)]
-            
-            # Add interface binding if specified
-            if interface:
-                cmd.extend(['-I', interface])
-            
-            cmd.append(host)
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=timeout + 5
-            )
-            
-            if result.returncode == 0:
-                # Extract average ping time
-                lines = result.stdout.split('\n')
-                for line in lines:
-                    if 'rtt min/avg/max/mdev' in line or 'round-trip' in line:
-                        parts = line.split('/')
-                        if len(parts) >= 5:
-                            return float(parts[4])  # avg time
-                return 0.0  # Connected but couldn't parse time
-            else:
-                return None  # Host unreachable
-                
-        except Exception as e:
-            logger.error(f"Ping error for {host}: {e}")
-            return None
+        prober = WanProber(hosts=[host], count=count, timeout=timeout)
+        return prober.run([interface])[interface]['latency']
     
-    def check_interface_connectivity(self, interface):
-        """Check connectivity through specific interface"""
-        connectivity_results = []
-        
-        for host in self.test_hosts:
-            ping_result = self.ping_host(host, interface)
-            connectivity_results.append({
-                'host': host,
-                'ping_ms': ping_result,
-                'is_reachable': ping_result is not None
-            })
-        
-        # Calculate connectivity score
-        reachable_count = sum(1 for result in connectivity_results if result['is_reachable'])
-        connectivity_score = (reachable_count / len(self.test_hosts)) * 100
-        
-        # Calculate average ping time for reachable hosts
-        reachable_pings = [r['ping_ms'] for r in connectivity_results if r['is_reachable']]
-        avg_ping = sum(reachable_pings) / len(reachable_pings) if reachable_pings else None
-        
+    def connectivity(self, summary):
+        """Connectivity report from a prober summary"""
         return {
-            'interface': interface,
-            'connectivity_score': connectivity_score,
-            'avg_ping_ms': avg_ping,
-            'test_results': connectivity_results,
-            'is_online': connectivity_score > 0
+            'interface': summary['interface'],
+            'connectivity_score': summary['connectivity_score'],
+            'avg_ping_ms': summary['latency'],
+            'jitter_ms': summary['jitter'],
+            'packet_loss': summary['packet_loss'],
+            'test_results': [{
+                'host': result['host'],
+                'ping_ms': result['latency'],
+                'rtts_ms': result['rtts'],
+                'is_reachable': result['success']
+            } for result in summary['results']],
+            'is_online': summary['connectivity_score'] > 0
         }
     
+    def check_connectivity(self, interfaces):
+        """Check connectivity of several interfaces in one concurrent round"""
+        summaries = WanProber(hosts=self.test_hosts).run(interfaces)
+        return {interface: self.connectivity(summary) for interface, summary in summaries.items()}
+    
+    def check_interface_connectivity(self, interface):
+        """Check connectivity through specific interface"""
+        return self.check_connectivity([interface])[interface]
+    
     def get_interface_stats(self, interface):
         """Get network interface statistics"""
         try:
@@ -127,52 +99,60 @@ class NetworkMonitor:
         timestamp = datetime.now()
         
         # Monitor WAN interfaces
-        wan1_status = self.get_interface_status(self.wan1_interface)
-        wan1_stats = self.get_interface_stats(self.wan1_interface)
-        wan1_connectivity = None
-        
-        if wan1_status and wan1_status['is_up'] and wan1_status['has_ip']:
-            wan1_connectivity = self.check_interface_connectivity(self.wan1_interface)
+        statuses = {interface: self.get_interface_status(interface) for interface in self.wan_interfaces.values()}
         
-        wan2_status = self.get_interface_status(self.wan2_interface)
-        wan2_stats = self.get_interface_stats(self.wan2_interface)
-        wan2_connectivity = None
+        # All WANs are probed in the same round
+        ready = [interface for interface, status in statuses.items()
+                 if status and status['is_up'] and status['has_ip']]
+        connectivity = self.check_connectivity(ready) if ready else {}
         
-        if wan2_status and wan2_status['is_up'] and wan2_status['has_ip']:
-            wan2_connectivity = self.check_interface_connectivity(self.wan2_interface)
+        status = {'timestamp': timestamp.isoformat()}
+        for name, interface in self.wan_interfaces.items():
+            wan_connectivity = connectivity.get(interface)
+            status[name] = {
+                'interface': interface,
+                'status': statuses[interface],
+                'stats': self.get_interface_stats(interface),
+                'connectivity': wan_connectivity,
+                'is_online': wan_connectivity['is_online'] if wan_connectivity else False
+            }
         
         # Monitor LAN interface
-        lan_status = self.get_interface_status(self.lan_interface)
-        lan_stats = self.get_interface_stats(self.lan_interface)
-        
-        return {
-            'timestamp': timestamp.isoformat(),
-            'wan1': {
-                'interface': self.wan1_interface,
-                'status': wan1_status,
-                'stats': wan1_stats,
-                'connectivity': wan1_connectivity,
-                'is_online': wan1_connectivity['is_online'] if wan1_connectivity else False
-            },
-            'wan2': {
-                'interface': self.wan2_interface,
-                'status': wan2_status,
-                'stats': wan2_stats,
-                'connectivity': wan2_connectivity,
-                'is_online': wan2_connectivity['is_online'] if wan2_connectivity else False
-            },
-            'lan': {
-                'interface': self.lan_interface,
-                'status': lan_status,
-                'stats': lan_stats
-            }
+        status['lan'] = {
+            'interface': self.lan_interface,
+            'status': self.get_interface_status(self.lan_interface),
+            'stats': self.get_interface_stats(self.lan_interface)
         }
+        return status
+    
+    def route_interface(self, destination, source):
+        """Interface the kernel routes `source` -> `destination` traffic out of"""
+        try:
+            result = subprocess.run(['ip', '-o', 'route', 'get', destination, 'from', source],
+                                    capture_output=True, text=True, timeout=5)
+            fields = result.stdout.split()
+            return fields[fields.index('dev') + 1] if 'dev' in fields else None
+        except Exception as e:
+            logger.error(f"Error looking up the route from {source}: {e}")
+            return None
     
     def run_speed_test(self, interface):
         """Run speed test on specific interface"""
         try:
-            # Bind speedtest to specific interface using --interface flag
-            cmd = ['speedtest-cli', '--simple', '--interface', interface]
+            # speedtest-cli has no interface option, only a source address to bind
+            status = self.get_interface_status(interface)
+            if not status or not status['ip_addresses']:
+                logger.error(f"Speed test skipped: {interface} has no IPv4 address")
+                return None
+            source = status['ip_addresses'][0]
+            
+            # The address only leaves by its WAN through the policy routing source
+            # rules; without them the result would be another WAN's throughput
+            route = self.route_interface(self.test_hosts[0], source)
+            if route != interface:
+                logger.error(f"Speed test skipped: traffic from {source} leaves by {route}, not {interface}")
+                return None
+            cmd = ['speedtest-cli', '--simple', '--source', source]
             
             result = subprocess.run(
                 cmd,
@@ -216,11 +196,11 @@ def get_network_status():
 def check_wan_connectivity():
     """Quick check of WAN connectivity"""
     monitor = NetworkMonitor()
-    wan1_conn = monitor.check_interface_connectivity('enx1')
-    wan2_conn = monitor.check_interface_connectivity('enx2')
+    connectivity = monitor.check_connectivity(list(monitor.wan_interfaces.values()))
     
-    return {
-        'wan1_online': wan1_conn['is_online'] if wan1_conn else False,
-        'wan2_online': wan2_conn['is_online'] if wan2_conn else False,
-        'timestamp': datetime.now().isoformat()
-    }
+    status = {}
+    for name, interface in monitor.wan_interfaces.items():
+        conn = connectivity[interface]
+        status[f'{name}_online'] = conn['is_online'] if conn else False
+    status['timestamp'] = datetime.now().isoformat()
+    return status
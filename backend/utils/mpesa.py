@@ -1,12 +1,48 @@
 import requests
 import json
 import base64
+import threading
+import time
 from datetime import datetime
 from config import Config
 
 class MPESAError(Exception):
     pass
 
+class RateLimiter:
+    """Thread-safe token bucket shared by every Daraja call in the process"""
+    
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Daraja enforces per-app rate limits, so all callers draw from one bucket
+daraja_limiter = RateLimiter(Config.MPESA_API_RATE_LIMIT, Config.MPESA_API_BURST)
+
+# Access tokens are valid for an hour; share them instead of one OAuth call per request
+_token_cache = {'token': None, 'expires_at': 0.0}
+_token_lock = threading.Lock()
+
+# Returned by STK Query while the customer has not yet answered the prompt
+MPESA_ERROR_PROCESSING = '500.001.1001'
+
 class MPESA:
     def __init__(self):
         self.consumer_key = Config.MPESA_CONSUMER_KEY
@@ -15,33 +51,46 @@ class MPESA:
         self.shortcode = Config.MPESA_SHORTCODE
         self.callback_url = Config.MPESA_CALLBACK_URL
         
-        # Sandbox URLs (change to production for live)
-        self.auth_url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-        self.stk_url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
+        # Sandbox by default (set MPESA_API_BASE_URL for live)
+        base_url = Config.MPESA_API_BASE_URL.rstrip('/')
+        self.auth_url = f"{base_url}/oauth/v1/generate?grant_type=client_credentials"
+        self.stk_url = f"{base_url}/mpesa/stkpush/v1/processrequest"
+        self.query_url = f"{base_url}/mpesa/stkpushquery/v1/query"
+        self.timeout = Config.MPESA_API_TIMEOUT
         
     def get_access_token(self):
         """Get M-PESA access token"""
         if not self.consumer_key or not self.consumer_secret:
             raise MPESAError("M-PESA credentials not configured")
-            
-        credentials = base64.b64encode(
-            f"{self.consumer_key}:{self.consumer_secret}".encode()
-        ).decode()
-        
-        headers = {
-            'Authorization': f'Basic {credentials}',
-            'Content-Type': 'application/json'
-        }
         
-        try:
-            response = requests.get(self.auth_url, headers=headers)
-            response.raise_for_status()
+        with _token_lock:
+            if _token_cache['token'] and time.time() < _token_cache['expires_at']:
+                return _token_cache['token']
             
-            data = response.json()
-            return data.get('access_token')
+            credentials = base64.b64encode(
+                f"{self.consumer_key}:{self.consumer_secret}".encode()
+            ).decode()
             
-        except requests.exceptions.RequestException as e:
-            raise MPESAError(f"Failed to get access token: {str(e)}")
+            headers = {
+                'Authorization': f'Basic {credentials}',
+                'Content-Type': 'application/json'
+            }
+            
+            try:
+                daraja_limiter.acquire()
+                response = requests.get(self.auth_url, headers=headers, timeout=self.timeout)
+                response.raise_for_status()
+                
+                data = response.json()
+                
+                # Refresh a minute early so in-flight requests never carry an expired token
+                expires_in = int(data.get('expires_in', 3599))
+                _token_cache['token'] = data.get('access_token')
+                _token_cache['expires_at'] = time.time() + max(0, expires_in - 60)
+                return _token_cache['token']
+                
+            except requests.exceptions.RequestException as e:
+                raise MPESAError(f"Failed to get access token: {str(e)}")
     
     def generate_password(self):
         """Generate M-PESA password"""
@@ -82,7 +131,8 @@ class MPESA:
         }
         
         try:
-            response = requests.post(self.stk_url, json=payload, headers=headers)
+            daraja_limiter.acquire()
+            response = requests.post(self.stk_url, json=payload, headers=headers, timeout=self.timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -107,10 +157,52 @@ class MPESA:
             raise MPESAError(f"STK Push failed: {str(e)}")
     
     def query_transaction_status(self, checkout_request_id):
-        """Query the status of a transaction"""
-        # TODO: Implement transaction status query
-        # This would use the STK Push Query API
-        pass
+        """Query the status of a transaction via the STK Push Query API
+        
+        Returns a dict in the same shape as `validate_callback`, with
+        `pending=True` while the customer has not completed the prompt.
+        """
+        access_token = self.get_access_token()
+        password, timestamp = self.generate_password()
+        
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+        
+        try:
+            daraja_limiter.acquire()
+            response = requests.post(self.query_url, json=payload, headers=headers, timeout=self.timeout)
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise MPESAError(f"STK Query failed: {str(e)}")
+        
+        # Daraja answers with an errorCode while the prompt is still open
+        if 'errorCode' in data or response.status_code >= 400:
+            if response.status_code == 429 or data.get('errorCode') == MPESA_ERROR_PROCESSING:
+                return {
+                    'success': False,
+                    'pending': True,
+                    'checkout_request_id': checkout_request_id,
+                    'result_desc': data.get('errorMessage')
+                }
+            raise MPESAError(f"STK Query failed: {data.get('errorMessage', response.status_code)}")
+        
+        result_code = int(data.get('ResultCode', -1))
+        return {
+            'success': result_code == 0,
+            'pending': False,
+            'checkout_request_id': checkout_request_id,
+            'result_code': result_code,
+            'result_desc': data.get('ResultDesc')
+        }
     
     def validate_callback(self, callback_data):
         """Validate and process M-PESA callback data"""
@@ -133,6 +225,8 @@ class MPESA:
                 return {
                     'success': True,
                     'checkout_request_id': checkout_request_id,
+                    'result_code': result_code,
+                    'result_desc': result_desc,
                     'amount': payment_data.get('Amount'),
                     'mpesa_receipt_number': payment_data.get('MpesaReceiptNumber'),
                     'transaction_date': payment_data.get('TransactionDate'),
@@ -0,0 +1,552 @@
+import errno
+import ipaddress
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Netlink message types and flags (linux/netlink.h, linux/rtnetlink.h)
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+RTM_GETRULE = 34
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# Multicast groups for bind()
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+# Route attributes
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_PREFSRC = 7
+RTA_MULTIPATH = 9
+RTA_TABLE = 15
+
+# Address attributes
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+# Rule attributes
+FRA_SRC = 2
+FRA_PRIORITY = 6
+FRA_FWMARK = 10
+FRA_TABLE = 15
+FRA_FWMASK = 16
+FR_ACT_TO_TBL = 1
+
+# Link attributes
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+IFF_LOWER_UP = 0x10000
+
+RT_TABLE_DEFAULT = 253
+RT_TABLE_MAIN = 254
+RT_TABLE_LOCAL = 255
+RTPROT_STATIC = 4
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+
+NLMSG_HEADER = struct.Struct('=LHHLL')   # len, type, flags, seq, pid
+RTMSG = struct.Struct('=BBBBBBBBI')      # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+IFINFOMSG = struct.Struct('=BxHiII')     # family, type, index, flags, change
+IFADDRMSG = struct.Struct('=BBBBI')      # family, prefixlen, flags, scope, index
+RTATTR = struct.Struct('=HH')            # len, type
+RTNEXTHOP = struct.Struct('=HBBi')       # len, flags, hops, ifindex
+
+class NetlinkError(Exception):
+    def __init__(self, code: int, message: str = None):
+        self.code = code
+        super().__init__(message or os.strerror(code))
+
+def align(length: int) -> int:
+    return (length + 3) & ~3
+
+def pack_attr(attr_type: int, data: bytes) -> bytes:
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attr_type) + data + b'\0' * (align(length) - length)
+
+def pack_u32(attr_type: int, value: int) -> bytes:
+    return pack_attr(attr_type, struct.pack('=I', value))
+
+def pack_ipv4(attr_type: int, address: str) -> bytes:
+    return pack_attr(attr_type, socket.inet_aton(address))
+
+def parse_attrs(data: bytes, offset: int = 0) -> Dict[int, bytes]:
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type & 0x3fff] = data[offset + RTATTR.size:offset + length]
+        offset += align(length)
+    return attrs
+
+def attr_u32(attrs: Dict[int, bytes], attr_type: int) -> Optional[int]:
+    value = attrs.get(attr_type)
+    return struct.unpack('=I', value[:4])[0] if value else None
+
+def attr_ipv4(attrs: Dict[int, bytes], attr_type: int) -> Optional[str]:
+    value = attrs.get(attr_type)
+    return socket.inet_ntoa(value[:4]) if value else None
+
+class RouteSocket:
+    """A minimal rtnetlink client for IPv4 routes, rules and links.
+
+    Requests go straight to the kernel over one NETLINK_ROUTE socket, so a
+    route change is a single syscall round trip instead of an `ip` process,
+    and NLM_F_REPLACE swaps a route in place with no window without one.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, msg_type: int, flags: int, payload: bytes) -> List[Tuple[int, bytes]]:
+        """Send one message and collect the replies until ACK or end of dump"""
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            self.sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), msg_type,
+                                             flags | NLM_F_REQUEST, seq, 0) + payload)
+            replies = []
+            while True:
+                data = self.sock.recv(65536)
+                offset = 0
+                while offset + NLMSG_HEADER.size <= len(data):
+                    length, reply_type, reply_flags, reply_seq, _ = NLMSG_HEADER.unpack_from(data, offset)
+                    body = data[offset + NLMSG_HEADER.size:offset + length]
+                    offset += align(length)
+                    if reply_seq != seq:
+                        continue
+                    if reply_type == NLMSG_ERROR:
+                        code = -struct.unpack_from('=i', body)[0]
+                        if code:
+                            raise NetlinkError(code)
+                        return replies
+                    if reply_type == NLMSG_DONE:
+                        return replies
+                    replies.append((reply_type, body))
+                    if not reply_flags & NLM_F_MULTI and not flags & NLM_F_ACK:
+                        return replies
+
+    # Links
+
+    def get_links(self) -> List[Dict]:
+        links = []
+        for _, body in self.request(RTM_GETLINK, NLM_F_DUMP, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+            links.append(parse_link(body))
+        return links
+
+    # Addresses
+
+    def get_addresses(self) -> List[Dict]:
+        """IPv4 addresses of every link"""
+        addresses = []
+        for _, body in self.request(RTM_GETADDR, NLM_F_DUMP, IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)):
+            addresses.append(parse_address(body))
+        return addresses
+
+    # Routes
+
+    def get_routes(self, table: Optional[int] = None) -> List[Dict]:
+        """IPv4 unicast routes, optionally from one table"""
+        routes = []
+        for _, body in self.request(RTM_GETROUTE, NLM_F_DUMP, RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)):
+            route = parse_route(body)
+            if route['type'] != RTN_UNICAST:
+                continue
+            if table is not None and route['table'] != table:
+                continue
+            routes.append(route)
+        return routes
+
+    def route_message(self, destination: str, table: int, priority: Optional[int] = None,
+                      gateway: Optional[str] = None, oif: Optional[int] = None,
+                      nexthops: Optional[List[Tuple[str, int, int]]] = None,
+                      scope: int = RT_SCOPE_UNIVERSE, protocol: int = RTPROT_STATIC) -> bytes:
+        network = ipaddress.ip_network(destination)
+        header = RTMSG.pack(socket.AF_INET, network.prefixlen, 0, 0, table if table < 256 else 252,
+                            protocol, scope, RTN_UNICAST, 0)
+        attrs = pack_u32(RTA_TABLE, table)
+        if network.prefixlen:
+            attrs += pack_ipv4(RTA_DST, str(network.network_address))
+        if priority is not None:
+            attrs += pack_u32(RTA_PRIORITY, priority)
+        if gateway:
+            attrs += pack_ipv4(RTA_GATEWAY, gateway)
+        if oif:
+            attrs += pack_u32(RTA_OIF, oif)
+        if nexthops:
+            hops = b''
+            for hop_gateway, hop_oif, weight in nexthops:
+                hop_attrs = pack_ipv4(RTA_GATEWAY, hop_gateway)
+                hops += RTNEXTHOP.pack(RTNEXTHOP.size + len(hop_attrs), 0, min(256, max(1, weight)) - 1, hop_oif) + hop_attrs
+            attrs += pack_attr(RTA_MULTIPATH, hops)
+        return header + attrs
+
+    def replace_route(self, destination: str, table: int = RT_TABLE_MAIN, **kwargs):
+        """Create or atomically replace a route"""
+        self.request(RTM_NEWROUTE, NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE,
+                     self.route_message(destination, table, **kwargs))
+
+    def delete_route(self, destination: str, table: int = RT_TABLE_MAIN, **kwargs):
+        # Protocol 0 matches routes whoever installed them
+        kwargs.setdefault('protocol', 0)
+        self.request(RTM_DELROUTE, NLM_F_ACK, self.route_message(destination, table, **kwargs))
+
+    def flush_table(self, table: int) -> int:
+        """Delete every route in a table"""
+        deleted = 0
+        for route in self.get_routes(table):
+            try:
+                self.delete_route(f"{route['dst']}/{route['dst_len']}", table,
+                                  priority=route['priority'], scope=route['scope'])
+                deleted += 1
+            except NetlinkError as e:
+                if e.code != errno.ESRCH:
+                    raise
+        return deleted
+
+    # Policy routing rules
+
+    def get_rules(self) -> List[Dict]:
+        rules = []
+        for _, body in self.request(RTM_GETRULE, NLM_F_DUMP, RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)):
+            rules.append(parse_rule(body))
+        return rules
+
+    def rule_message(self, table: int, priority: int, fwmark: Optional[int] = None,
+                     fwmask: Optional[int] = None, src: Optional[str] = None) -> bytes:
+        # fib_rule_hdr has the same layout as rtmsg; the action sits where rtmsg keeps its type
+        source = ipaddress.ip_network(src) if src else None
+        header = RTMSG.pack(socket.AF_INET, 0, source.prefixlen if source else 0, 0, table if table < 256 else 252,
+                            0, 0, FR_ACT_TO_TBL, 0)
+        attrs = pack_u32(FRA_TABLE, table) + pack_u32(FRA_PRIORITY, priority)
+        if fwmark is not None:
+            attrs += pack_u32(FRA_FWMARK, fwmark)
+            attrs += pack_u32(FRA_FWMASK, fwmask if fwmask is not None else 0xffffffff)
+        if source:
+            attrs += pack_ipv4(FRA_SRC, str(source.network_address))
+        return header + attrs
+
+    def add_rule(self, table: int, priority: int, fwmark: Optional[int] = None, fwmask: Optional[int] = None,
+                 src: Optional[str] = None):
+        """Add a lookup rule; an identical existing rule is left alone"""
+        # The kernel's own duplicate check also compares the rule protocol, so check here
+        for rule in self.get_rules():
+            if (rule['table'], rule['priority'], rule['fwmark'], rule['src']) == (table, priority, fwmark, src) and \
+                    (fwmark is None or rule['fwmask'] == (fwmask if fwmask is not None else 0xffffffff)):
+                return
+        kwargs = {'fwmark': fwmark, 'fwmask': fwmask, 'src': src}
+        try:
+            self.request(RTM_NEWRULE, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL,
+                         self.rule_message(table, priority, **kwargs))
+        except NetlinkError as e:
+            if e.code != errno.EEXIST:
+                raise
+
+    def delete_rule(self, table: int, priority: int, **kwargs):
+        self.request(RTM_DELRULE, NLM_F_ACK, self.rule_message(table, priority, **kwargs))
+
+    def flush_rules(self) -> int:
+        """Delete every IPv4 rule except the local table lookup, like `ip rule flush`"""
+        deleted = 0
+        for rule in self.get_rules():
+            if rule['priority'] == 0:
+                continue
+            try:
+                self.delete_rule(rule['table'], rule['priority'], fwmark=rule['fwmark'], fwmask=rule['fwmask'],
+                                 src=rule['src'])
+                deleted += 1
+            except NetlinkError as e:
+                if e.code != errno.ENOENT:
+                    raise
+        return deleted
+
+def parse_link(body: bytes) -> Dict:
+    _, _, index, flags, _ = IFINFOMSG.unpack_from(body)
+    attrs = parse_attrs(body, IFINFOMSG.size)
+    name = attrs.get(IFLA_IFNAME, b'').rstrip(b'\0').decode()
+    return {
+        'index': index,
+        'name': name,
+        'up': bool(flags & IFF_UP),
+        'running': bool(flags & IFF_RUNNING),
+        'lower_up': bool(flags & IFF_LOWER_UP),
+        'operstate': attrs[IFLA_OPERSTATE][0] if IFLA_OPERSTATE in attrs else None
+    }
+
+def parse_address(body: bytes) -> Dict:
+    _, prefixlen, _, scope, index = IFADDRMSG.unpack_from(body)
+    attrs = parse_attrs(body, IFADDRMSG.size)
+    return {
+        'index': index,
+        'address': attr_ipv4(attrs, IFA_LOCAL) or attr_ipv4(attrs, IFA_ADDRESS),
+        'prefixlen': prefixlen,
+        'scope': scope
+    }
+
+def parse_route(body: bytes) -> Dict:
+    _, dst_len, _, _, table, protocol, scope, route_type, _ = RTMSG.unpack_from(body)
+    attrs = parse_attrs(body, RTMSG.size)
+    route = {
+        'dst': attr_ipv4(attrs, RTA_DST) or '0.0.0.0',
+        'dst_len': dst_len,
+        'table': attr_u32(attrs, RTA_TABLE) or table,
+        'protocol': protocol,
+        'scope': scope,
+        'type': route_type,
+        'gateway': attr_ipv4(attrs, RTA_GATEWAY),
+        'oif': attr_u32(attrs, RTA_OIF),
+        'priority': attr_u32(attrs, RTA_PRIORITY),
+        'prefsrc': attr_ipv4(attrs, RTA_PREFSRC),
+        'nexthops': []
+    }
+    data = attrs.get(RTA_MULTIPATH, b'')
+    offset = 0
+    while offset + RTNEXTHOP.size <= len(data):
+        length, _, hops, ifindex = RTNEXTHOP.unpack_from(data, offset)
+        if length < RTNEXTHOP.size:
+            break
+        hop_attrs = parse_attrs(data[offset:offset + length], RTNEXTHOP.size)
+        route['nexthops'].append({'gateway': attr_ipv4(hop_attrs, RTA_GATEWAY), 'oif': ifindex, 'weight': hops + 1})
+        offset += align(length)
+    return route
+
+def parse_rule(body: bytes) -> Dict:
+    _, _, src_len, _, table, _, _, action, _ = RTMSG.unpack_from(body)
+    attrs = parse_attrs(body, RTMSG.size)
+    src = attr_ipv4(attrs, FRA_SRC)
+    return {
+        'table': attr_u32(attrs, FRA_TABLE) or table,
+        'priority': attr_u32(attrs, FRA_PRIORITY) or 0,
+        'fwmark': attr_u32(attrs, FRA_FWMARK),
+        'fwmask': attr_u32(attrs, FRA_FWMASK),
+        # A host address on its own, a network as CIDR
+        'src': src if not src or src_len == 32 else f"{src}/{src_len}",
+        'action': action
+    }
+
+class NetlinkRouting:
+    """Route reads and atomic route swaps, with cached lookups.
+
+    Interface indexes and gateways are cached until the kernel announces a
+    link, address or route change on the rtnetlink multicast groups, so the
+    hot path of a failover is one RTM_NEWROUTE with NLM_F_REPLACE.
+    """
+
+    def __init__(self, watch: bool = True):
+        self.socket = RouteSocket()
+        self.cache_lock = threading.Lock()
+        self.generation = 0
+        self._links = None
+        self._gateways = {}
+        self._listeners = []
+        self._watcher = None
+        if watch:
+            self.start_watcher()
+
+    def start_watcher(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self.watch, name='netlink-watcher', daemon=True)
+            self._watcher.start()
+
+    def add_listener(self, callback):
+        """Call `callback(msg_type, parsed)` for every link, address and route event"""
+        self._listeners.append(callback)
+
+    def watch(self):
+        """Invalidate the caches whenever the kernel reports a change"""
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        while True:
+            try:
+                select.select([sock], [], [])
+                data = sock.recv(65536)
+            except OSError as e:
+                # ENOBUFS means events were dropped; the cache must go either way
+                if e.errno != errno.ENOBUFS:
+                    logger.error(f"Netlink watcher error: {e}")
+                self.invalidate()
+                continue
+
+            self.invalidate()
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                body = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += align(length)
+                if not self._listeners:
+                    continue
+                if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                    parsed = parse_link(body)
+                elif msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+                    parsed = parse_route(body)
+                elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+                    parsed = {'index': struct.unpack_from('=BBBBI', body)[4]}
+                else:
+                    continue
+                for callback in self._listeners:
+                    try:
+                        callback(msg_type, parsed)
+                    except Exception as e:
+                        logger.error(f"Netlink listener failed: {e}")
+
+    def invalidate(self):
+        with self.cache_lock:
+            self.generation += 1
+            self._links = None
+            self._gateways = {}
+
+    def links(self) -> Dict[str, Dict]:
+        with self.cache_lock:
+            if self._links is not None:
+                return self._links
+            generation = self.generation
+        links = {link['name']: link for link in self.socket.get_links()}
+        with self.cache_lock:
+            if generation == self.generation:
+                self._links = links
+        return links
+
+    def link_index(self, interface: str) -> Optional[int]:
+        link = self.links().get(interface)
+        return link['index'] if link else None
+
+    def interface_name(self, index: int) -> Optional[str]:
+        for name, link in self.links().items():
+            if link['index'] == index:
+                return name
+        return None
+
+    def gateway(self, interface: str) -> Optional[str]:
+        """Default gateway reachable through an interface, from any routing table"""
+        with self.cache_lock:
+            if interface in self._gateways:
+                return self._gateways[interface]
+            generation = self.generation
+
+        index = self.link_index(interface)
+        gateway = None
+        if index is not None:
+            candidates = []
+            for route in self.socket.get_routes():
+                if route['dst_len'] != 0 or route['table'] == RT_TABLE_LOCAL:
+                    continue
+                hops = route['nexthops'] or [{'gateway': route['gateway'], 'oif': route['oif']}]
+                for hop in hops:
+                    if hop['oif'] == index and hop['gateway']:
+                        # Prefer the main table, then the lowest metric
+                        candidates.append((route['table'] != RT_TABLE_MAIN, route['priority'] or 0, hop['gateway']))
+            if candidates:
+                gateway = min(candidates)[2]
+
+        with self.cache_lock:
+            if generation == self.generation:
+                self._gateways[interface] = gateway
+        return gateway
+
+    def address(self, interface: str) -> Optional[str]:
+        """First global IPv4 address of an interface"""
+        index = self.link_index(interface)
+        for address in self.socket.get_addresses():
+            if address['index'] == index and address['scope'] == RT_SCOPE_UNIVERSE:
+                return address['address']
+        return None
+
+    def replace_default_route(self, interface: str, gateway: Optional[str] = None,
+                              table: int = RT_TABLE_MAIN) -> bool:
+        """Point the default route at one interface in a single atomic replace"""
+        gateway = gateway or self.gateway(interface)
+        index = self.link_index(interface)
+        if not gateway or index is None:
+            logger.error(f"No gateway found for {interface}")
+            return False
+        try:
+            self.socket.replace_route('0.0.0.0/0', table, gateway=gateway, oif=index)
+            return True
+        except NetlinkError as e:
+            logger.error(f"Failed to replace default route via {interface}: {e}")
+            return False
+
+    def replace_multipath_route(self, weights: Dict[str, int], table: int = RT_TABLE_MAIN) -> bool:
+        """Replace the default route with a weighted multipath route over several interfaces"""
+        nexthops = []
+        for interface, weight in weights.items():
+            gateway = self.gateway(interface)
+            index = self.link_index(interface)
+            if not gateway or index is None:
+                logger.error(f"No gateway found for {interface}")
+                return False
+            nexthops.append((gateway, index, weight))
+        try:
+            self.socket.replace_route('0.0.0.0/0', table, nexthops=nexthops)
+            return True
+        except NetlinkError as e:
+            logger.error(f"Failed to replace multipath default route: {e}")
+            return False
+
+    def format_routes(self, table: int = RT_TABLE_MAIN) -> List[str]:
+        """Routes in a table, formatted like `ip route show`"""
+        lines = []
+        for route in self.socket.get_routes(table):
+            destination = 'default' if route['dst_len'] == 0 else f"{route['dst']}/{route['dst_len']}"
+            parts = [destination]
+            if route['gateway']:
+                parts += ['via', route['gateway']]
+            if route['oif']:
+                parts += ['dev', self.interface_name(route['oif']) or str(route['oif'])]
+            if route['prefsrc']:
+                parts += ['src', route['prefsrc']]
+            if route['priority']:
+                parts += ['metric', str(route['priority'])]
+            for hop in route['nexthops']:
+                parts += ['nexthop', 'via', hop['gateway'], 'dev',
+                          self.interface_name(hop['oif']) or str(hop['oif']), 'weight', str(hop['weight'])]
+            lines.append(' '.join(parts))
+        return lines
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def get_routing() -> NetlinkRouting:
+    """Process-wide NetlinkRouting, so every caller shares one cache and watcher"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = NetlinkRouting()
+        return _shared
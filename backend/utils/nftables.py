@@ -0,0 +1,232 @@
+import json
+import logging
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class NftablesManager:
+    """Client access control and NAT in a dedicated nftables table.
+
+    Everything lives in `inet bytebill`:
+      - `authorized`: set of (ip . mac) with per-element timeouts
+      - `blocked_macs`: verdict map, checked before anything else
+      - `client_upload` / `client_download`: maps from client IP to a named
+        counter per client, for per-client byte accounting
+      - masquerade on every WAN
+    Every change is one `nft -f` transaction, so it applies completely or
+    not at all.
+    """
+
+    def __init__(self):
+        self.table = 'bytebill'
+        self.family = 'inet'
+        self.lan_interface = Config.LAN_INTERFACE
+        self.wan_interfaces = [wan['interface'] for wan in Config.WANS.values()]
+        self.set_size = 65536
+
+    @property
+    def qualified_table(self) -> str:
+        return f"{self.family} {self.table}"
+
+    def run_nft(self, script: str) -> bool:
+        """Apply a script as a single nft transaction"""
+        try:
+            subprocess.run(['nft', '-f', '-'], input=script, capture_output=True, text=True, check=True)
+            return True
+        except subprocess.CalledProcessError as e:
+            logger.error(f"nft transaction rejected: {(e.stderr or '').strip()}")
+            return False
+        except Exception as e:
+            logger.error(f"Unexpected error running nft: {e}")
+            return False
+
+    def query_nft(self, *args) -> Optional[dict]:
+        """Run an nft listing command with JSON output"""
+        try:
+            result = subprocess.run(['nft', '-j', *args], capture_output=True, text=True, check=True)
+            return json.loads(result.stdout)
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logger.error(f"nft {' '.join(args)} failed: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Unexpected error running nft: {e}")
+            return None
+
+    @staticmethod
+    def counter_name(direction: str, ip_address: str) -> str:
+        return f"{direction}_{ip_address.replace('.', '_')}"
+
+    def declarations(self) -> List[str]:
+        """Table, sets, maps and base chains; redeclaring existing objects is a no-op"""
+        return [
+            f"table {self.qualified_table} {{",
+            f"    set authorized {{ type ipv4_addr . ether_addr; flags timeout; size {self.set_size}; }}",
+            f"    map blocked_macs {{ type ether_addr : verdict; size {self.set_size}; }}",
+            f"    map client_upload {{ type ipv4_addr : counter; size {self.set_size}; }}",
+            f"    map client_download {{ type ipv4_addr : counter; size {self.set_size}; }}",
+            "    chain forward { type filter hook forward priority filter; policy accept; }",
+            "    chain postrouting { type nat hook postrouting priority srcnat; policy accept; }",
+            "}"
+        ]
+
+    def ruleset(self) -> str:
+        """Declarations plus the chain contents, replacing the rules but keeping set contents"""
+        lan = f'"{self.lan_interface}"'
+        wans = '{ ' + ', '.join(f'"{wan}"' for wan in self.wan_interfaces) + ' }'
+        table = self.qualified_table
+
+        lines = self.declarations() + [
+            f"flush chain {table} forward",
+            f"flush chain {table} postrouting",
+            # Blocked MACs lose access regardless of any session
+            f"add rule {table} forward iifname {lan} ether saddr vmap @blocked_macs",
+            # Per-client accounting; clients without counters just don't match
+            f"add rule {table} forward oifname {lan} counter name ip daddr map @client_download",
+            f"add rule {table} forward iifname {lan} counter name ip saddr map @client_upload",
+            # Replies back to the LAN; outbound packets are checked below
+            f"add rule {table} forward oifname {lan} ct state established,related accept",
+        ]
+        if Config.ACCESS_CONTROL_ENABLED:
+            lines += [
+                f"add rule {table} forward iifname {lan} oifname {wans} ip saddr . ether saddr @authorized accept",
+                f"add rule {table} forward iifname {lan} drop",
+            ]
+        else:
+            # Nothing fills the set without access control, so it must not gate the LAN
+            lines.append(f"add rule {table} forward iifname {lan} oifname {wans} accept")
+        lines.append(f"add rule {table} postrouting oifname {wans} masquerade")
+        return '\n'.join(lines) + '\n'
+
+    def setup(self) -> bool:
+        """Install or refresh the ruleset atomically"""
+        if self.run_nft(self.ruleset()):
+            logger.info(f"nftables table {self.qualified_table} configured")
+            return True
+        return False
+
+    def client_elements(self, ip_address: str, mac_address: str, timeout: int) -> List[str]:
+        table = self.qualified_table
+        upload = self.counter_name('up', ip_address)
+        download = self.counter_name('down', ip_address)
+        return [
+            f"add element {table} authorized {{ {ip_address} . {mac_address.lower()} timeout {int(timeout)}s }}",
+            f"add counter {table} {upload}",
+            f"add counter {table} {download}",
+            f"add element {table} client_upload {{ {ip_address} : \"{upload}\" }}",
+            f"add element {table} client_download {{ {ip_address} : \"{download}\" }}",
+        ]
+
+    def authorize_clients(self, clients: List[Tuple[str, str, int]]) -> bool:
+        """Authorize (ip, mac, seconds) clients; the kernel drops each entry when it times out"""
+        table = self.qualified_table
+        lines = []
+        for ip_address, mac_address, timeout in clients:
+            if timeout <= 0:
+                continue
+            member = f"{ip_address} . {mac_address.lower()}"
+            # Re-adding an existing element keeps its old timeout; replace it instead
+            lines.append(f"add element {table} authorized {{ {member} timeout 1s }}")
+            lines.append(f"delete element {table} authorized {{ {member} }}")
+            lines.extend(self.client_elements(ip_address, mac_address, timeout))
+
+        if not lines:
+            return True
+        if not self.run_nft('\n'.join(lines) + '\n'):
+            return False
+        logger.info(f"Authorized {len(clients)} client(s)")
+        return True
+
+    def revoke_clients(self, clients: List[Tuple[str, str]]) -> bool:
+        """Remove clients from the authorized set along with their counters"""
+        table = self.qualified_table
+        lines = []
+        for ip_address, mac_address in clients:
+            member = f"{ip_address} . {mac_address.lower()}"
+            upload = self.counter_name('up', ip_address)
+            download = self.counter_name('down', ip_address)
+            # Adding first makes each delete safe when the object is already gone
+            lines.extend([
+                f"add element {table} authorized {{ {member} timeout 1s }}",
+                f"delete element {table} authorized {{ {member} }}",
+                f"add counter {table} {upload}",
+                f"add counter {table} {download}",
+                f"add element {table} client_upload {{ {ip_address} : \"{upload}\" }}",
+                f"add element {table} client_download {{ {ip_address} : \"{download}\" }}",
+                f"delete element {table} client_upload {{ {ip_address} }}",
+                f"delete element {table} client_download {{ {ip_address} }}",
+                f"delete counter {table} {upload}",
+                f"delete counter {table} {download}",
+            ])
+
+        if not lines:
+            return True
+        if not self.run_nft('\n'.join(lines) + '\n'):
+            return False
+        logger.info(f"Revoked {len(clients)} client(s)")
+        return True
+
+    def replace_authorized_clients(self, clients: List[Tuple[str, str, int]]) -> bool:
+        """Atomically replace the whole authorized set, e.g. when resyncing from the database"""
+        table = self.qualified_table
+        lines = self.declarations() + [
+            f"flush set {table} authorized",
+            f"flush map {table} client_upload",
+            f"flush map {table} client_download",
+        ]
+        # Counters of clients that are gone; the flushed maps no longer reference them
+        current = {ip_address for ip_address, _, timeout in clients if timeout > 0}
+        for ip_address in sorted(set(self.get_client_counters()) - current):
+            for direction in ('up', 'down'):
+                name = self.counter_name(direction, ip_address)
+                # Adding first makes the delete safe if only one direction exists
+                lines.extend([f"add counter {table} {name}", f"delete counter {table} {name}"])
+        for ip_address, mac_address, timeout in clients:
+            if timeout > 0:
+                lines.extend(self.client_elements(ip_address, mac_address, timeout))
+
+        if not self.run_nft('\n'.join(lines) + '\n'):
+            return False
+        logger.info(f"Authorized set replaced with {len(clients)} client(s)")
+        return True
+
+    def set_mac_blocked(self, mac_address: str, blocked: bool) -> bool:
+        table = self.qualified_table
+        element = f"{mac_address.lower()} : drop"
+        lines = [f"add element {table} blocked_macs {{ {element} }}"]
+        if not blocked:
+            lines.append(f"delete element {table} blocked_macs {{ {mac_address.lower()} }}")
+        return self.run_nft('\n'.join(lines) + '\n')
+
+    def block_user(self, ip_address: str, mac_address: str):
+        """Block a user by MAC address, whatever their session state"""
+        if self.set_mac_blocked(mac_address, True):
+            logger.info(f"Blocked user: IP {ip_address}, MAC {mac_address}")
+            return True
+        return False
+
+    def unblock_user(self, ip_address: str, mac_address: str, timeout: int):
+        """Lift a MAC block and authorize the client for `timeout` seconds"""
+        if self.set_mac_blocked(mac_address, False) and self.authorize_clients([(ip_address, mac_address, timeout)]):
+            logger.info(f"Unblocked user: IP {ip_address}, MAC {mac_address}")
+            return True
+        return False
+
+    def get_client_counters(self) -> Dict[str, Dict[str, int]]:
+        """Bytes and packets per client IP from the named counters"""
+        listing = self.query_nft('list', 'counters', 'table', self.family, self.table)
+        clients = {}
+        for item in (listing or {}).get('nftables', []):
+            counter = item.get('counter')
+            if not counter:
+                continue
+            direction, _, ip = counter['name'].partition('_')
+            ip = ip.replace('_', '.')
+            stats = clients.setdefault(ip, {'bytes_uploaded': 0, 'bytes_downloaded': 0,
+                                            'packets_uploaded': 0, 'packets_downloaded': 0})
+            suffix = 'uploaded' if direction == 'up' else 'downloaded'
+            stats[f'bytes_{suffix}'] = counter.get('bytes', 0)
+            stats[f'packets_{suffix}'] = counter.get('packets', 0)
+        return clients
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List
+
+from config import Config
+from database import db
+from models.transaction import MpesaTransaction, TransactionStatus
+from utils.access_control import authorize_sessions
+from utils.mpesa import MPESA, MPESAError
+from utils.payments import settle_payments, try_lock
+
+logger = logging.getLogger(__name__)
+
+def query_interval(age_seconds: float) -> int:
+    """Re-query interval for a pending payment of the given age"""
+    for max_age, interval in Config.MPESA_QUERY_BACKOFF:
+        if age_seconds < max_age:
+            return interval
+    return Config.MPESA_QUERY_BACKOFF[-1][1]
+
+class PendingPaymentPoller:
+    """Settles payments whose callbacks never arrived by polling STK Query.
+
+    Each scan picks PENDING transactions older than `MPESA_QUERY_MIN_AGE`,
+    skips the ones still inside their per-age backoff, queries the rest
+    concurrently (all requests draw from the shared Daraja rate limiter) and
+    settles the definitive answers in a single batch.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.mpesa = MPESA()
+        self.interval = Config.MPESA_QUERY_INTERVAL
+        self.min_age = Config.MPESA_QUERY_MIN_AGE
+        self.max_age = Config.MPESA_QUERY_MAX_AGE
+        self.batch_size = Config.MPESA_QUERY_BATCH_SIZE
+        self.executor = ThreadPoolExecutor(
+            max_workers=Config.MPESA_QUERY_CONCURRENCY,
+            thread_name_prefix='mpesa-query'
+        )
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+
+    def due_transactions(self, now: datetime) -> List[MpesaTransaction]:
+        """Pending transactions whose backoff has elapsed, least recently queried first"""
+        candidates = MpesaTransaction.query.filter(
+            MpesaTransaction.status == TransactionStatus.PENDING,
+            MpesaTransaction.created_at <= now - timedelta(seconds=self.min_age),
+            MpesaTransaction.created_at >= now - timedelta(seconds=self.max_age),
+            MpesaTransaction.checkout_request_id.isnot(None)
+        ).order_by(
+            MpesaTransaction.last_queried_at.is_(None).desc(),
+            MpesaTransaction.last_queried_at
+        ).limit(self.batch_size).all()
+
+        due = []
+        for txn in candidates:
+            if txn.last_queried_at is None:
+                due.append(txn)
+                continue
+            age = (now - txn.created_at).total_seconds()
+            if (now - txn.last_queried_at).total_seconds() >= query_interval(age):
+                due.append(txn)
+        return due
+
+    def query(self, checkout_request_id: str):
+        try:
+            return self.mpesa.query_transaction_status(checkout_request_id)
+        except MPESAError as e:
+            logger.warning(f"STK Query for {checkout_request_id} failed: {e}")
+            return None
+
+    def poll_once(self) -> dict:
+        """Run one scan, returning counts for logging"""
+        now = datetime.utcnow()
+        due = self.due_transactions(now)
+        if not due:
+            db.session.rollback()
+            return {'queried': 0, 'settled': 0}
+
+        checkout_ids = [txn.checkout_request_id for txn in due]
+        ids = [txn.id for txn in due]
+        # Release the read snapshot while the HTTP calls are in flight
+        db.session.rollback()
+
+        results = list(self.executor.map(self.query, checkout_ids))
+        definitive = [r for r in results if r is not None and not r.get('pending')]
+
+        outcome = settle_payments(definitive)
+
+        # Record the attempt on everything we asked about in one statement
+        MpesaTransaction.query.filter(MpesaTransaction.id.in_(ids)).update({
+            MpesaTransaction.query_attempts: MpesaTransaction.query_attempts + 1,
+            MpesaTransaction.last_queried_at: now
+        }, synchronize_session=False)
+        db.session.commit()
+
+        if outcome['activated']:
+            logger.info(f"STK Query recovered {len(outcome['activated'])} paid session(s)")
+            authorize_sessions(outcome['activated'])
+        return {'queried': len(checkout_ids), 'settled': len(outcome['settled'])}
+
+    def run(self):
+        """Polling loop"""
+        while not self._stop.wait(self.interval):
+            if self._lock_fd is None:
+                self._lock_fd = try_lock(os.path.join(Config.MPESA_INBOX_DIR, 'poller.lock'))
+                if self._lock_fd is None:
+                    continue
+
+            with self.app.app_context():
+                try:
+                    counts = self.poll_once()
+                    if counts['queried']:
+                        logger.info(f"Pending payments: queried {counts['queried']}, settled {counts['settled']}")
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Pending payment poller error: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='mpesa-query-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.executor.shutdown(wait=False)
+
+def init_payment_poller(app):
+    """Start the pending payment poller for this app"""
+    if Config.MPESA_QUERY_ENABLED and Config.MPESA_CONSUMER_KEY:
+        poller = PendingPaymentPoller(app)
+        poller.start()
+        app.extensions['mpesa_poller'] = poller
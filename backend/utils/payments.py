@@ -0,0 +1,375 @@
+import os
+import json
+import uuid
+import fcntl
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import insert
+from config import Config
+from database import db
+from models.session import Session, SessionStatus, PaymentMethod
+from models.transaction import MpesaTransaction, MpesaCallback, TransactionStatus
+from models.user import User
+from utils.access_control import authorize_sessions
+from utils.callback_inbox import CallbackInbox
+from utils.mpesa import MPESA, MPESAError, initiate_payment
+
+logger = logging.getLogger(__name__)
+
+# Daraja result code for "Request cancelled by user"
+RESULT_CODE_CANCELLED = 1032
+
+def parse_transaction_date(value):
+    """Parse Daraja's YYYYMMDDHHMMSS transaction date"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(str(value), '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+
+def start_mpesa_purchase(plan, phone_number, mac_address, ip_address) -> Dict:
+    """Send an STK Push for a plan and record the paused session awaiting payment.
+
+    The session stays PAUSED until the callback consumer or the pending
+    payment poller settles the transaction.
+    """
+    result = initiate_payment(phone_number, int(plan.price), plan.name)
+    if not result['success']:
+        return result
+
+    now = datetime.utcnow()
+    user = User.query.filter_by(mac_address=mac_address).first()
+    if user is None:
+        user = User(ip_address=ip_address, mac_address=mac_address)
+        db.session.add(user)
+    else:
+        user.ip_address = ip_address
+        user.last_seen = now
+    user.total_sessions = (user.total_sessions or 0) + 1
+    db.session.flush()
+
+    session = Session(
+        session_id=f"session_{uuid.uuid4().hex}",
+        user_id=user.id,
+        plan_id=plan.id,
+        status=SessionStatus.PAUSED,
+        payment_method=PaymentMethod.MPESA,
+        payment_reference=result['checkout_request_id'],
+        duration_limit=plan.duration,
+        data_limit=plan.data_limit,
+        ip_address=ip_address,
+        mac_address=mac_address
+    )
+    db.session.add(session)
+    db.session.flush()
+
+    db.session.add(MpesaTransaction(
+        checkout_request_id=result['checkout_request_id'],
+        merchant_request_id=result.get('merchant_request_id'),
+        phone_number=phone_number,
+        amount=plan.price,
+        plan_id=plan.id,
+        session_id=session.id
+    ))
+    db.session.commit()
+
+    return {
+        'success': True,
+        'checkout_request_id': result['checkout_request_id'],
+        'session_id': session.session_id,
+        'customer_message': result.get('customer_message')
+    }
+
+def settle_payments(results: List[Dict]) -> Dict:
+    """Apply STK results to pending transactions and their sessions in one batch.
+
+    `results` are dicts in the shape returned by `MPESA.validate_callback`.
+    Only PENDING transactions and PAUSED sessions are settled, so duplicate
+    and late results are no-ops, except that a payment settled by the STK
+    Query poller, which carries no receipt, takes the receipt and date of a
+    later successful callback. The caller owns the commit.
+    """
+    by_checkout_id = {}
+    for result in results:
+        by_checkout_id.setdefault(result['checkout_request_id'], result)
+
+    if not by_checkout_id:
+        return {'settled': [], 'activated': [], 'unmatched': []}
+
+    transactions = MpesaTransaction.query.filter(
+        MpesaTransaction.checkout_request_id.in_(list(by_checkout_id))
+    ).with_for_update().all()
+
+    known_ids = {txn.checkout_request_id for txn in transactions}
+    pending = [txn for txn in transactions if txn.status == TransactionStatus.PENDING]
+    unreceipted = [txn for txn in transactions
+                   if txn.status == TransactionStatus.COMPLETED and not txn.mpesa_receipt_number
+                   and by_checkout_id[txn.checkout_request_id]['success']
+                   and by_checkout_id[txn.checkout_request_id].get('mpesa_receipt_number')]
+
+    session_ids = [txn.session_id for txn in pending if txn.session_id]
+    sessions = {}
+    if session_ids:
+        sessions = {
+            session.id: session for session in Session.query.filter(
+                Session.id.in_(session_ids),
+                Session.status == SessionStatus.PAUSED
+            ).with_for_update().all()
+        }
+
+    now = datetime.utcnow()
+    settled = []
+    activated = []
+
+    for txn in pending:
+        result = by_checkout_id[txn.checkout_request_id]
+        session = sessions.get(txn.session_id)
+
+        if result['success']:
+            txn.status = TransactionStatus.COMPLETED
+            txn.result_code = 0
+            txn.result_desc = result.get('result_desc')
+            txn.mpesa_receipt_number = result.get('mpesa_receipt_number')
+            txn.transaction_date = parse_transaction_date(result.get('transaction_date'))
+
+            if session:
+                session.status = SessionStatus.ACTIVE
+                session.start_time = now
+                session.last_activity = now
+                session.payment_reference = txn.mpesa_receipt_number
+                session.amount_paid = txn.amount
+                activated.append(session)
+        else:
+            result_code = result.get('result_code')
+            txn.status = (TransactionStatus.CANCELLED if result_code == RESULT_CODE_CANCELLED
+                          else TransactionStatus.FAILED)
+            txn.result_code = result_code
+            txn.result_desc = result.get('result_desc')
+
+            if session:
+                session.terminate("payment_failed")
+
+        txn.updated_at = now
+        settled.append(txn.checkout_request_id)
+
+    backfilled = backfill_receipts(unreceipted, by_checkout_id, now)
+
+    return {
+        'settled': settled,
+        'activated': activated,
+        'backfilled': backfilled,
+        'unmatched': [cid for cid in by_checkout_id if cid not in known_ids]
+    }
+
+def backfill_receipts(transactions: List[MpesaTransaction], by_checkout_id: Dict, now: datetime) -> List[str]:
+    """Fill in the receipt and date of completed transactions from their callbacks"""
+    sessions = {}
+    session_ids = [txn.session_id for txn in transactions if txn.session_id]
+    if session_ids:
+        sessions = {session.id: session for session in
+                    Session.query.filter(Session.id.in_(session_ids)).with_for_update().all()}
+
+    backfilled = []
+    for txn in transactions:
+        result = by_checkout_id[txn.checkout_request_id]
+        txn.mpesa_receipt_number = result['mpesa_receipt_number']
+        txn.transaction_date = parse_transaction_date(result.get('transaction_date'))
+        txn.updated_at = now
+
+        session = sessions.get(txn.session_id)
+        if session and not session.payment_reference:
+            session.payment_reference = txn.mpesa_receipt_number
+        backfilled.append(txn.checkout_request_id)
+    return backfilled
+
+def try_lock(path: str):
+    """Take an exclusive, non-blocking flock, returning the fd or None"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o640)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+class CallbackConsumer:
+    """Drains the callback inbox into the database in batches.
+
+    Every parsed callback is first recorded in `mpesa_callbacks`, whose unique
+    index on CheckoutRequestID absorbs Safaricom's retries. Callbacks that
+    arrive before their transaction row is committed stay unapplied in the
+    ledger and are retried for `MPESA_CALLBACK_RETRY_WINDOW` seconds.
+    """
+
+    def __init__(self, app, inbox: CallbackInbox):
+        self.app = app
+        self.inbox = inbox
+        self.mpesa = MPESA()
+        self.batch_size = Config.MPESA_CALLBACK_BATCH_SIZE
+        self.poll_interval = Config.MPESA_CALLBACK_POLL_INTERVAL
+        self.retry_window = Config.MPESA_CALLBACK_RETRY_WINDOW
+
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+        self.running = False
+
+    def parse(self, payload: bytes):
+        """Parse a raw callback body, returning None for junk"""
+        try:
+            result = self.mpesa.validate_callback(json.loads(payload))
+        except (ValueError, MPESAError) as e:
+            logger.warning(f"Discarding unparseable M-PESA callback: {e}")
+            return None
+
+        if not result.get('checkout_request_id'):
+            logger.warning("Discarding M-PESA callback without CheckoutRequestID")
+            return None
+
+        result.setdefault('result_code', 0)
+        return result
+
+    def process_batch(self, records) -> int:
+        """Record and apply one batch of inbox records, returning how many were applied"""
+        parsed = {}
+        rows = []
+        for record in records:
+            result = self.parse(record.payload)
+            if result is None or result['checkout_request_id'] in parsed:
+                continue
+            parsed[result['checkout_request_id']] = result
+            rows.append({
+                'checkout_request_id': result['checkout_request_id'],
+                'result_code': result['result_code'],
+                'payload': record.payload.decode('utf-8', 'replace'),
+                'received_at': datetime.utcfromtimestamp(record.received_at)
+            })
+
+        if not rows:
+            return 0
+
+        db.session.execute(
+            insert(MpesaCallback)
+            .prefix_with('IGNORE', dialect='mysql')
+            .prefix_with('OR IGNORE', dialect='sqlite'),
+            rows
+        )
+
+        # Duplicates of applied callbacks are filtered out here; earlier copies
+        # that are still unapplied get another chance along with this batch.
+        callbacks = MpesaCallback.query.filter(
+            MpesaCallback.checkout_request_id.in_(list(parsed)),
+            MpesaCallback.applied_at.is_(None)
+        ).with_for_update().all()
+
+        return self.apply(callbacks, parsed)
+
+    def apply(self, callbacks, parsed=None) -> int:
+        """Settle ledger rows and mark the ones that matched a transaction"""
+        parsed = parsed or {}
+        results = []
+        for callback in callbacks:
+            result = parsed.get(callback.checkout_request_id)
+            if result is None:
+                result = self.parse(callback.payload.encode())
+            if result is not None:
+                results.append(result)
+
+        outcome = settle_payments(results)
+        unmatched = set(outcome['unmatched'])
+        now = datetime.utcnow()
+        applied = 0
+        for callback in callbacks:
+            if callback.checkout_request_id not in unmatched:
+                callback.applied_at = now
+                applied += 1
+
+        db.session.commit()
+
+        if outcome['activated']:
+            logger.info(f"Activated {len(outcome['activated'])} paid session(s)")
+            authorize_sessions(outcome['activated'])
+        return applied
+
+    def retry_unapplied(self) -> int:
+        """Retry callbacks that arrived before their transaction existed"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retry_window)
+        callbacks = MpesaCallback.query.filter(
+            MpesaCallback.applied_at.is_(None),
+            MpesaCallback.received_at >= cutoff
+        ).order_by(MpesaCallback.id).limit(self.batch_size).with_for_update().all()
+
+        if not callbacks:
+            db.session.rollback()
+            return 0
+        return self.apply(callbacks)
+
+    def drain(self) -> int:
+        """Process everything currently in the inbox"""
+        total = 0
+        position = self.inbox.load_position()
+        for batch in self.inbox.iter_pending(position, self.batch_size):
+            try:
+                total += self.process_batch(batch)
+            except Exception:
+                db.session.rollback()
+                raise
+            self.inbox.save_position(batch[-1].segment, batch[-1].end_offset)
+            position = (batch[-1].segment, batch[-1].end_offset)
+
+        if position[0]:
+            self.inbox.prune(position[0])
+        return total
+
+    def acquire_leadership(self) -> bool:
+        """Only one process may consume the inbox at a time"""
+        if self._lock_fd is None:
+            self._lock_fd = try_lock(os.path.join(self.inbox.directory, 'consumer.lock'))
+        return self._lock_fd is not None
+
+    def notify(self):
+        """Wake the consumer after an append in this process"""
+        self._wakeup.set()
+
+    def run(self):
+        """Consumer loop"""
+        last_retry = datetime.min
+        while self.running:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+            if not self.acquire_leadership():
+                continue
+
+            with self.app.app_context():
+                try:
+                    self.drain()
+                    if (datetime.utcnow() - last_retry).total_seconds() >= self.poll_interval * 10:
+                        self.retry_unapplied()
+                        last_retry = datetime.utcnow()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"M-PESA callback consumer error: {e}")
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self.run, name='mpesa-callback-consumer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+
+def init_mpesa_callbacks(app):
+    """Create the callback inbox and start its consumer for this app"""
+    inbox = CallbackInbox(Config.MPESA_INBOX_DIR, fsync=Config.MPESA_INBOX_FSYNC)
+    app.extensions['mpesa_inbox'] = inbox
+
+    if Config.MPESA_CALLBACK_CONSUMER_ENABLED:
+        consumer = CallbackConsumer(app, inbox)
+        consumer.start()
+        app.extensions['mpesa_consumer'] = consumer
@@ -0,0 +1,189 @@
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+from config import Config
+from utils.throughput import FIELDS, read_net_dev
+
+logger = logging.getLogger(__name__)
+
+def read_tcp_counters(path: str = '/proc/net/snmp') -> Dict[str, int]:
+    """The kernel's TCP MIB counters"""
+    with open(path) as f:
+        rows = [line.split() for line in f if line.startswith('Tcp:')]
+    return {name: int(value) for name, value in zip(rows[0][1:], rows[1][1:])}
+
+def count_unreplied(marks: List[int], path: str = '/proc/net/nf_conntrack') -> Optional[Dict[int, tuple]]:
+    """(unreplied, total) conntrack entries per connection mark; None without conntrack in procfs"""
+    counts = {mark: [0, 0] for mark in marks}
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                position = line.find(b' mark=')
+                if position < 0:
+                    continue
+                mark = int(line[position + 6:].split(None, 1)[0]) & Config.FWMARK_MASK
+                if mark in counts:
+                    counts[mark][1] += 1
+                    if b'[UNREPLIED]' in line:
+                        counts[mark][0] += 1
+    except FileNotFoundError:
+        return None
+    return {mark: tuple(count) for mark, count in counts.items()}
+
+class PassiveMonitor:
+    """Signs that a WAN is failing, read from kernel counters without sending anything.
+
+    A WAN that keeps transmitting while almost nothing comes back is
+    suspect, as is one where most connections marked for it never got a
+    reply; the latter needs connmark balancing to attribute connections.
+    Retransmits in the TCP MIB only cover the router's own connections, not
+    forwarded client traffic, so they are a weak signal raised for every WAN.
+    """
+
+    def __init__(self, marks: Dict[str, int]):
+        # interface -> fwmark
+        self.marks = marks
+        self._counters = {}
+        self._tcp = None
+
+    def read(self) -> Dict[str, str]:
+        """Suspect interfaces with the reason, since the previous read"""
+        suspects = {}
+        counters = read_net_dev()
+        for interface in self.marks:
+            current, previous = counters.get(interface), self._counters.get(interface)
+            self._counters[interface] = current
+            if current is None or previous is None:
+                continue
+            sent = current[FIELDS.index('tx_packets')] - previous[FIELDS.index('tx_packets')]
+            received = current[FIELDS.index('rx_packets')] - previous[FIELDS.index('rx_packets')]
+            if sent >= Config.WAN_SUSPECT_MIN_PACKETS and 0 <= received < sent * Config.WAN_SUSPECT_RX_SHARE:
+                suspects[interface] = f"{sent} packets out, {received} in"
+
+        unreplied = count_unreplied(list(self.marks.values()))
+        for interface, mark in self.marks.items():
+            waiting, total = (unreplied or {}).get(mark, (0, 0))
+            if waiting >= Config.WAN_SUSPECT_MIN_UNREPLIED and waiting >= total * Config.WAN_SUSPECT_UNREPLIED_SHARE:
+                suspects.setdefault(interface, f"{waiting} of {total} connections unreplied")
+
+        tcp = read_tcp_counters()
+        if self._tcp is not None:
+            segments = tcp['OutSegs'] - self._tcp['OutSegs']
+            retransmits = tcp['RetransSegs'] - self._tcp['RetransSegs']
+            if segments >= Config.WAN_SUSPECT_MIN_SEGMENTS and retransmits >= segments * Config.WAN_SUSPECT_RETRANS_RATIO:
+                for interface in self.marks:
+                    suspects.setdefault(interface, f"{retransmits} of {segments} TCP segments retransmitted")
+        self._tcp = tcp
+        return suspects
+
+class WanSchedule:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_at = 0.0
+        # Start dense to establish a baseline
+        self.dense_rounds = Config.WAN_PROBE_DENSE_ROUNDS
+        self.suspected_at = None
+        self.last_good = None
+        # (time, echoes) of rounds in the last hour, and seconds to detect past failures
+        self.echoes = deque()
+        self.detections = deque(maxlen=Config.WAN_SCORE_HISTORY)
+        self.suspicions = 0
+
+class ProbeScheduler:
+    """When each WAN is probed next, and how densely.
+
+    A healthy WAN backs off from `base_interval` by `WAN_PROBE_BACKOFF` per
+    clean round up to `WAN_PROBE_MAX_INTERVAL`, with `PROBE_SPARSE_COUNT`
+    echoes per host. A failed round, a passive signal or a netlink event
+    makes it dense: `PROBE_COUNT` echoes every `WAN_PROBE_MIN_INTERVAL`
+    seconds for `WAN_PROBE_DENSE_ROUNDS` rounds. A WAN out of service is
+    probed densely every `WAN_RECOVERY_PROBE_INTERVAL` seconds.
+
+    Echoes per hour and the time each failure took to detect are kept so
+    the cost of probing can be weighed against how fast failures are seen.
+    Time to detect runs from the last good round, which bounds when the
+    failure began, or from the event that reported it.
+    """
+
+    def __init__(self, names: List[str], base_interval: float):
+        self.base_interval = base_interval
+        self.wans = {name: WanSchedule(base_interval) for name in names}
+
+    def due(self, now: float) -> List[str]:
+        return [name for name, schedule in self.wans.items() if schedule.next_at <= now]
+
+    def next_at(self) -> float:
+        return min(schedule.next_at for schedule in self.wans.values())
+
+    def dense(self, name: str) -> bool:
+        return self.wans[name].dense_rounds > 0
+
+    def defer(self, name: str, until: float):
+        """Skip rounds that cannot succeed, e.g. without carrier"""
+        self.wans[name].next_at = until
+
+    def suspect(self, name: str, now: float, reason: str):
+        schedule = self.wans[name]
+        if schedule.suspected_at is None:
+            logger.info(f"{name} suspect ({reason}); probing densely")
+            schedule.suspected_at = now
+            schedule.suspicions += 1
+        schedule.dense_rounds = Config.WAN_PROBE_DENSE_ROUNDS
+        schedule.interval = Config.WAN_PROBE_MIN_INTERVAL
+        schedule.next_at = min(schedule.next_at, now)
+
+    def probed(self, name: str, now: float, echoes: int, online: bool, in_service: bool):
+        """Schedule the next round of a WAN after one finished"""
+        schedule = self.wans[name]
+        schedule.echoes.append((now, echoes))
+        while schedule.echoes and schedule.echoes[0][0] <= now - 3600:
+            schedule.echoes.popleft()
+
+        if online:
+            schedule.last_good = now
+        if not in_service:
+            schedule.dense_rounds = max(1, schedule.dense_rounds)
+            schedule.interval = Config.WAN_RECOVERY_PROBE_INTERVAL
+        elif not online:
+            schedule.dense_rounds = Config.WAN_PROBE_DENSE_ROUNDS
+            schedule.interval = Config.WAN_PROBE_MIN_INTERVAL
+        elif schedule.dense_rounds > 1:
+            schedule.dense_rounds -= 1
+            schedule.interval = Config.WAN_PROBE_MIN_INTERVAL
+        elif schedule.dense_rounds:
+            # Clean dense rounds; a suspicion that came to nothing
+            schedule.dense_rounds = 0
+            schedule.suspected_at = None
+            schedule.interval = self.base_interval
+        else:
+            schedule.interval = min(Config.WAN_PROBE_MAX_INTERVAL, schedule.interval * Config.WAN_PROBE_BACKOFF)
+        schedule.next_at = now + schedule.interval
+
+    def detected(self, name: str, now: float, onset: Optional[float] = None):
+        """A WAN was taken out of service; `onset` is when an event reported the failure"""
+        schedule = self.wans[name]
+        since = onset if onset is not None else schedule.last_good
+        if since is not None:
+            schedule.detections.append(now - since)
+            logger.info(f"{name} failure detected in {now - since:.1f}s")
+        schedule.suspected_at = None
+
+    def probes_per_hour(self, name: str) -> int:
+        return sum(echoes for _, echoes in self.wans[name].echoes)
+
+    def state(self, now: float) -> Dict:
+        state = {}
+        for name, schedule in self.wans.items():
+            detections = list(schedule.detections)
+            state[name] = {
+                'dense': schedule.dense_rounds > 0,
+                'interval': schedule.interval,
+                'next_probe_in': round(max(0.0, schedule.next_at - now), 1),
+                'probes_per_hour': self.probes_per_hour(name),
+                'suspicions': schedule.suspicions,
+                'detections': len(detections),
+                'time_to_detect_avg': round(sum(detections) / len(detections), 1) if detections else None,
+                'time_to_detect_max': round(max(detections), 1) if detections else None
+            }
+        return state
@@ -0,0 +1,271 @@
+import asyncio
+import itertools
+import logging
+import random
+import socket
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+DNS_TYPE_A = 1
+DNS_CLASS_IN = 1
+
+# Raw sockets see every echo reply on the host, so each probe needs its own identifier
+_identifiers = itertools.count(random.randrange(0x10000))
+
+def checksum(data: bytes) -> int:
+    """RFC 1071 internet checksum"""
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def echo_request(identifier: int, sequence: int, payload: bytes = b'bytebill-probe') -> bytes:
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum(header + payload),
+                       identifier, sequence) + payload
+
+def parse_echo_reply(packet: bytes, raw: bool) -> Optional[Tuple[int, int]]:
+    """(identifier, sequence) of an echo reply; raw sockets include the IP header"""
+    if raw:
+        if not packet:
+            return None
+        packet = packet[(packet[0] & 0x0f) * 4:]
+    if len(packet) < 8:
+        return None
+    kind, _, _, identifier, sequence = struct.unpack('!BBHHH', packet[:8])
+    if kind != ICMP_ECHO_REPLY:
+        return None
+    return identifier, sequence
+
+def dns_query(query_id: int, name: str) -> bytes:
+    """A recursive A query; any answer, even an error, proves the resolver is reachable"""
+    labels = b''.join(bytes([len(label)]) + label.encode() for label in name.strip('.').split('.') if label)
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + labels + b'\0' + struct.pack('!HH', DNS_TYPE_A, DNS_CLASS_IN)
+
+def bind_to_device(sock: socket.socket, interface: Optional[str]):
+    """Send through `interface` whatever the routing table says"""
+    if interface:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, interface.encode() + b'\0')
+
+def open_icmp_socket(interface: Optional[str]) -> Tuple[socket.socket, bool]:
+    """(socket, is_raw): an ICMP datagram socket where net.ipv4.ping_group_range
+    allows it, else a raw socket, which needs root or CAP_NET_RAW"""
+    try:
+        sock, raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+    except PermissionError:
+        sock, raw = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+    try:
+        sock.setblocking(False)
+        bind_to_device(sock, interface)
+    except OSError:
+        sock.close()
+        raise
+    return sock, raw
+
+def jitter(rtts: List[float]) -> Optional[float]:
+    """Mean difference between consecutive RTTs, as in RFC 3550"""
+    if len(rtts) < 2:
+        return None
+    return sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1)
+
+def summarize(interface: str, results: List[Dict]) -> Dict:
+    """Combine per-host probe results into one health summary for a WAN"""
+    successful = [r for r in results if r['success']]
+    if not successful:
+        return {
+            'interface': interface,
+            'online': False,
+            'latency': None,
+            'jitter': None,
+            'packet_loss': 100.0,
+            'connectivity_score': 0.0,
+            'results': results
+        }
+
+    jitters = [r['jitter'] for r in successful if r['jitter'] is not None]
+    connectivity_score = len(successful) / len(results) * 100
+    return {
+        'interface': interface,
+        'online': connectivity_score > Config.PROBE_MIN_CONNECTIVITY,
+        'latency': sum(r['latency'] for r in successful) / len(successful),
+        'jitter': sum(jitters) / len(jitters) if jitters else None,
+        'packet_loss': sum(r['packet_loss'] for r in results) / len(results),
+        'connectivity_score': connectivity_score,
+        'results': results
+    }
+
+class WanProber:
+    """Probes every host on every WAN concurrently.
+
+    Each (interface, host) pair is one probe of `count` echoes with its own
+    deadline, and all of them run at once on an event loop, so a full health
+    round takes about one RTT plus the echo spacing when the links are up and
+    `timeout` when one is dead, instead of the sum of every probe.
+
+    Probes use sockets bound to the interface with SO_BINDTODEVICE: ICMP
+    echo by default, or a TCP handshake or a DNS query where ICMP is
+    filtered. Every echo is timed on its own, so results carry per-echo
+    RTTs and jitter as well as loss.
+    """
+
+    def __init__(self, hosts: Optional[List[str]] = None, count: Optional[int] = None,
+                 timeout: Optional[float] = None, method: Optional[str] = None):
+        self.hosts = hosts or Config.PROBE_HOSTS
+        self.count = count or Config.PROBE_COUNT
+        self.timeout = timeout or Config.PROBE_TIMEOUT
+        self.method = method or Config.PROBE_METHOD
+        self.echo_interval = 0.2
+        self.methods = {'icmp': self.icmp_echoes, 'tcp': self.tcp_echoes, 'dns': self.dns_echoes}
+        if self.method not in self.methods:
+            raise ValueError(f"Unknown probe method {self.method}")
+
+    async def icmp_echoes(self, interface: Optional[str], address: str) -> List[Optional[float]]:
+        loop = asyncio.get_running_loop()
+        sock, raw = open_icmp_socket(interface)
+        # Datagram sockets get their identifier from the kernel, which also filters replies by it
+        identifier = next(_identifiers) & 0xffff
+        sent, rtts = {}, [None] * self.count
+        answered = asyncio.Event()
+
+        def on_readable():
+            while True:
+                try:
+                    packet, (source, _) = sock.recvfrom(1024)
+                except (BlockingIOError, InterruptedError):
+                    return
+                received = time.monotonic()
+                reply = parse_echo_reply(packet, raw)
+                if source != address or reply is None or (raw and reply[0] != identifier):
+                    continue
+                sequence = reply[1]
+                if sequence in sent and rtts[sequence] is None:
+                    rtts[sequence] = (received - sent[sequence]) * 1000
+                    if all(rtt is not None for rtt in rtts):
+                        answered.set()
+
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            for sequence in range(self.count):
+                if sequence:
+                    await asyncio.sleep(self.echo_interval)
+                sent[sequence] = time.monotonic()
+                try:
+                    sock.sendto(echo_request(identifier, sequence), (address, 0))
+                except OSError as e:
+                    # No route or the link is down; the echo counts as lost
+                    logger.debug(f"Echo to {address} via {interface} not sent: {e}")
+            # The last echo gets the full timeout to come back
+            try:
+                await asyncio.wait_for(answered.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        return rtts
+
+    async def tcp_echoes(self, interface: Optional[str], address: str) -> List[Optional[float]]:
+        """Time TCP handshakes; a reset proves the path as well as an accept"""
+        loop = asyncio.get_running_loop()
+        rtts = []
+        for attempt in range(self.count):
+            if attempt:
+                await asyncio.sleep(self.echo_interval)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.setblocking(False)
+                bind_to_device(sock, interface)
+                started = time.monotonic()
+                try:
+                    await asyncio.wait_for(loop.sock_connect(sock, (address, Config.PROBE_TCP_PORT)), self.timeout)
+                except ConnectionRefusedError:
+                    pass
+                rtts.append((time.monotonic() - started) * 1000)
+            except (asyncio.TimeoutError, OSError):
+                rtts.append(None)
+            finally:
+                sock.close()
+        return rtts
+
+    async def dns_echoes(self, interface: Optional[str], address: str) -> List[Optional[float]]:
+        loop = asyncio.get_running_loop()
+        rtts = []
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            bind_to_device(sock, interface)
+            sock.connect((address, 53))
+            for attempt in range(self.count):
+                if attempt:
+                    await asyncio.sleep(self.echo_interval)
+                query_id = random.randrange(0x10000)
+                started = time.monotonic()
+                try:
+                    sock.send(dns_query(query_id, Config.PROBE_DNS_NAME))
+                    deadline = started + self.timeout
+                    while True:
+                        response = await asyncio.wait_for(loop.sock_recv(sock, 512),
+                                                          max(0, deadline - time.monotonic()))
+                        # A late answer to an earlier query is not this one's
+                        if len(response) >= 2 and struct.unpack('!H', response[:2])[0] == query_id:
+                            break
+                    rtts.append((time.monotonic() - started) * 1000)
+                except (asyncio.TimeoutError, OSError):
+                    rtts.append(None)
+        finally:
+            sock.close()
+        return rtts
+
+    async def probe(self, interface: Optional[str], host: str) -> Dict:
+        """Send `count` echoes to a host through an interface"""
+        result = {'interface': interface, 'host': host, 'method': self.method, 'success': False,
+                  'latency': None, 'jitter': None, 'packet_loss': 100.0, 'rtts': []}
+        try:
+            addresses = await asyncio.get_running_loop().getaddrinfo(host, None, family=socket.AF_INET)
+            address = addresses[0][4][0]
+            rtts = await self.methods[self.method](interface, address)
+        except Exception as e:
+            logger.error(f"Probe error for {host} via {interface}: {e}")
+            return result
+
+        received = [rtt for rtt in rtts if rtt is not None]
+        result['rtts'] = rtts
+        result['packet_loss'] = (len(rtts) - len(received)) / len(rtts) * 100
+        if received:
+            result['success'] = True
+            result['latency'] = sum(received) / len(received)
+            result['jitter'] = jitter(received)
+        return result
+
+    async def probe_interfaces(self, interfaces: Iterable[Optional[str]]) -> Dict[str, Dict]:
+        """One health round: every host on every interface at once"""
+        interfaces = list(interfaces)
+        probes = [self.probe(interface, host) for interface in interfaces for host in self.hosts]
+        results = await asyncio.gather(*probes)
+
+        summaries = {}
+        for index, interface in enumerate(interfaces):
+            start = index * len(self.hosts)
+            summaries[interface] = summarize(interface, list(results[start:start + len(self.hosts)]))
+        return summaries
+
+    def run(self, interfaces: Iterable[Optional[str]]) -> Dict[str, Dict]:
+        """Run a health round from synchronous code"""
+        started = time.monotonic()
+        summaries = asyncio.run(self.probe_interfaces(interfaces))
+        logger.debug(f"Health round of {len(summaries)} interface(s) took {time.monotonic() - started:.2f}s")
+        return summaries
+
+def probe_wans(interfaces: Iterable[Optional[str]]) -> Dict[str, Dict]:
+    """Health summary per interface from one concurrent round"""
+    return WanProber().run(interfaces)
@@ -0,0 +1,148 @@
+import os
+import logging
+import threading
+from typing import Dict, Optional
+
+from config import Config
+from database import db
+from models.session import Session, SessionStatus
+from utils.payments import try_lock
+from utils.router import RouterManager
+from utils.wan_policy import WanPolicy
+
+logger = logging.getLogger(__name__)
+
+class StateReconciler:
+    """Keeps sysctls, firewall rules, the authorized and WAN pin sets and
+    policy routes in line with the database and Config.
+
+    Each pass reads the live state (one iptables-save, an ipset save per set, /proc
+    and a netlink route dump), diffs it against the desired state and applies
+    only the difference, so a pass without drift changes nothing. The main
+    table's default route is left to the load balancer.
+    """
+
+    def __init__(self, app=None, router: Optional[RouterManager] = None):
+        self.app = app
+        self.router = router or RouterManager()
+        self.interval = Config.RECONCILE_INTERVAL
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+
+    def reconcile_sysctls(self) -> int:
+        changes = self.router.enable_ip_forwarding()
+        return len(changes)
+
+    def reconcile_firewall(self) -> Optional[int]:
+        if Config.FIREWALL_BACKEND == 'nftables':
+            # The nft ruleset is applied as one transaction at startup and owns its table
+            return 0
+        saved = self.router.get_saved_chains()
+        if saved is None:
+            return None
+        batch = self.router.firewall_batch(saved)
+        # Rewritten chains reference the authorized and pin sets
+        if not batch.is_empty() and not self.router.create_sets():
+            return None
+        if not self.router.apply_batch(batch):
+            return None
+        return len(batch)
+
+    def reconcile_clients(self) -> Optional[int]:
+        if not Config.ACCESS_CONTROL_ENABLED or Config.FIREWALL_BACKEND == 'nftables':
+            return 0
+        # Live members are read before the database: a session activated in between
+        # is then re-added rather than removed, and one ended in between is removed
+        members = self.router.get_authorized_members()
+        if members is None:
+            if not self.router.create_authorized_set():
+                return None
+            members = {}
+
+        sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
+        clients = [(s.ip_address, s.mac_address, s.time_remaining) for s in sessions]
+        batch = self.router.authorized_set_batch(members, clients)
+        if not self.router.apply_sets(batch):
+            return None
+        return len(batch)
+
+    def reconcile_wan_policy(self) -> Optional[int]:
+        if not Config.WAN_POLICY_ENABLED or not self.router.marking_enabled:
+            return 0
+        # Sessions move class as they download, so pins are re-derived every pass
+        pinned = self.router.get_pinned_clients()
+        if pinned is None:
+            if not self.router.create_sets():
+                return None
+            pinned = {}
+
+        sessions = Session.query.filter(Session.status == SessionStatus.ACTIVE).all()
+        batch = self.router.pin_set_batch(pinned, WanPolicy(self.router).assignments(sessions))
+        if not self.router.apply_sets(batch):
+            return None
+        return len(batch)
+
+    def reconcile_routes(self) -> Optional[int]:
+        changes = self.router.policy_route_changes()
+        if changes is None:
+            return None
+        if not self.router.apply_policy_routes(changes):
+            return None
+        return len(changes)
+
+    def reconcile(self) -> Dict[str, Optional[int]]:
+        """One pass; the number of changes applied per area, None where it failed"""
+        counts = {}
+        for area, step in (('sysctls', self.reconcile_sysctls),
+                           ('firewall', self.reconcile_firewall),
+                           ('clients', self.reconcile_clients),
+                           ('wan_policy', self.reconcile_wan_policy),
+                           ('routes', self.reconcile_routes)):
+            try:
+                counts[area] = step()
+            except Exception as e:
+                logger.error(f"Reconciling {area} failed: {e}")
+                counts[area] = None
+        return counts
+
+    def run_once(self):
+        with self.app.app_context():
+            try:
+                counts = self.reconcile()
+            finally:
+                db.session.remove()
+
+        drifted = {area: count for area, count in counts.items() if count}
+        if drifted:
+            logger.info("Reconciled drift: " + ', '.join(f"{area} {count}" for area, count in drifted.items()))
+        failed = [area for area, count in counts.items() if count is None]
+        if failed:
+            logger.warning(f"Could not reconcile: {', '.join(failed)}")
+
+    def run(self):
+        """Reconcile on start, then every `RECONCILE_INTERVAL` seconds"""
+        while True:
+            if self._lock_fd is None:
+                self._lock_fd = try_lock(Config.RECONCILE_LOCK_FILE)
+            if self._lock_fd is not None:
+                self.run_once()
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        os.makedirs(os.path.dirname(Config.RECONCILE_LOCK_FILE), exist_ok=True)
+        self._thread = threading.Thread(target=self.run, name='state-reconciler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+def init_reconciler(app):
+    """Start the periodic drift check for this app"""
+    if Config.RECONCILE_ENABLED:
+        reconciler = StateReconciler(app)
+        reconciler.router.warn_unsupported_marking()
+        reconciler.start()
+        app.extensions['state_reconciler'] = reconciler
@@ -1,7 +1,20 @@
+import os
+import json
+import shlex
 import subprocess
 import ipaddress
 import logging
-from typing import List, Dict, Optional
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+from config import Config
+from utils.capacity import load_capacity_estimates
+from utils.firewall import (IPSET_MAX_TIMEOUT, RuleBatch, SetBatch, client_member, format_rule,
+                            parse_saved_chains)
+from utils.fup import steering_factor
+from utils.netlink import (NetlinkError, NetlinkRouting, RT_SCOPE_LINK, RT_TABLE_DEFAULT,
+                           RT_TABLE_MAIN, get_routing)
+from utils.nftables import NftablesManager
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -9,17 +22,50 @@ logger = logging.getLogger(__name__)
 
 class RouterManager:
     def __init__(self):
-        self.wan1_interface = 'enx1'
-        self.wan2_interface = 'enx2'
+        # WAN name -> interface, policy routing table, fwmark and ISP name
+        self.wans = Config.WANS
         self.lan_interface = 'eth0'
         self.lan_subnet = '192.168.88.0/24'
         self.gateway_ip = '192.168.88.1'
         
-        # Routing table IDs for policy routing
-        self.wan1_table = 101
-        self.wan2_table = 102
+        # ipset of (ip, mac) pairs allowed through to the WANs
+        self.authorized_set = 'bytebill_auth'
+        self.authorized_set_size = 65536
+        
+        # User chains holding ByteBill's rules; the built-in chains only get a jump
+        self.nat_chain = 'BYTEBILL-POSTROUTING'
+        self.forward_chain = 'BYTEBILL-FORWARD'
+        self.input_chain = 'BYTEBILL-INPUT'
+        
+        # Connection-sticky balancing: a new LAN connection is marked for one WAN,
+        # the mark is kept in conntrack and `ip rule fwmark` routes it into that WAN's table
+        self.balance_mode = Config.BALANCE_MODE
+        self.balance_chain = 'BYTEBILL-BALANCE'
+        self.select_chain = 'BYTEBILL-WAN-SELECT'  # the weights; rewritten live
+        self.fwmark_mask = Config.FWMARK_MASK
+        self.fwmark_rule_priority = 1000
+        # Traffic from a WAN's own address uses that WAN's table, ahead of the marks
+        self.source_rule_priority = 900
+        
+        # Clients pinned to a WAN by the WAN policy, one hash:ip set per WAN
+        self.pin_set_size = 65536
+        
+        # Connections are marked when balancing per connection or pinning clients. The
+        # marking lives in iptables mangle chains, which the nftables backend does not
+        # install; there new connections follow the multipath route and nobody is pinned
+        self.marking_requested = self.balance_mode == 'connmark' or Config.WAN_POLICY_ENABLED
+        self.marking_enabled = self.marking_requested and Config.FIREWALL_BACKEND != 'nftables'
         
-    def run_command(self, command: List[str], check_output: bool = True) -> Optional[str]:
+        # Kernel settings routing depends on, persisted in a drop-in file
+        self.sysctls = OrderedDict([('net.ipv4.ip_forward', '1'), ('net.ipv4.conf.all.forwarding', '1')])
+        if self.marking_enabled:
+            # Replies arrive on whichever WAN the connection left by; strict
+            # reverse-path filtering would drop those not on the main default route
+            self.sysctls['net.ipv4.conf.all.rp_filter'] = '2'
+        self.sysctl_file = '/etc/sysctl.d/90-bytebill.conf'
+        
+    def run_command(self, command: List[str], check_output: bool = True,
+                    input_data: Optional[str] = None) -> Optional[str]:
         """Run a system command safely"""
         try:
             if check_output:
@@ -27,209 +73,670 @@ class RouterManager:
                     command,
                     capture_output=True,
                     text=True,
+                    input=input_data,
                     check=True
                 )
                 return result.stdout.strip()
             else:
-                subprocess.run(command, check=True)
+                subprocess.run(command, text=True, input=input_data, check=True)
                 return None
         except subprocess.CalledProcessError as e:
-            logger.error(f"Command failed: {' '.join(command)}, Error: {e}")
+            stderr = (e.stderr or '').strip()
+            logger.error(f"Command failed: {' '.join(command)}, Error: {e}" + (f", {stderr}" if stderr else ''))
             return None
         except Exception as e:
             logger.error(f"Unexpected error running command: {e}")
             return None
     
-    def enable_ip_forwarding(self):
-        """Enable IP forwarding"""
-        commands = [
-            ['sysctl', '-w', 'net.ipv4.ip_forward=1'],
-            ['sysctl', '-w', 'net.ipv4.conf.all.forwarding=1']
-        ]
+    def apply_batch(self, batch: RuleBatch) -> bool:
+        """Apply a rule batch with a single iptables-restore, atomically per table"""
+        if batch.is_empty():
+            return True
         
-        for cmd in commands:
-            self.run_command(cmd, check_output=False)
+        if self.run_command(['iptables-restore', '--noflush'], input_data=batch.render()) is None:
+            logger.error(f"Rule batch of {len(batch)} change(s) rejected; the failing table was left unchanged")
+            return False
         
-        # Make it permanent
+        logger.info(f"Applied rule batch of {len(batch)} change(s)")
+        return True
+    
+    def apply_sets(self, batch: SetBatch) -> bool:
+        """Apply ipset changes with a single ipset restore"""
+        if batch.is_empty():
+            return True
+        
+        if self.run_command(['ipset', 'restore', '-exist'], input_data=batch.render()) is None:
+            logger.error(f"ipset batch of {len(batch)} change(s) failed")
+            return False
+        return True
+    
+    def get_saved_chains(self) -> Optional[Dict[str, Dict[str, List[str]]]]:
+        """Live rules of every table from a single iptables-save, or None if it could not be read"""
+        saved = self.run_command(['iptables-save'])
+        if saved is None:
+            return None
+        return parse_saved_chains(saved)
+    
+    @staticmethod
+    def read_sysctl(key: str) -> Optional[str]:
         try:
-            with open('/etc/sysctl.conf', 'a') as f:
-                f.write('\n# ByteBill IP Forwarding\n')
-                f.write('net.ipv4.ip_forward=1\n')
-                f.write('net.ipv4.conf.all.forwarding=1\n')
+            with open(os.path.join('/proc/sys', key.replace('.', '/'))) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+    
+    def sysctl_changes(self) -> Dict[str, str]:
+        """Settings whose live value differs from the desired one"""
+        return OrderedDict((key, value) for key, value in self.sysctls.items()
+                           if self.read_sysctl(key) != value)
+    
+    def persist_sysctls(self) -> bool:
+        """Write the sysctl drop-in if its contents differ; returns whether anything was written"""
+        content = '# ByteBill IP Forwarding\n' + ''.join(f"{key}={value}\n" for key, value in self.sysctls.items())
+        changed = False
+        try:
+            try:
+                with open(self.sysctl_file) as f:
+                    current = f.read()
+            except FileNotFoundError:
+                current = None
+            if current != content:
+                temp_path = f"{self.sysctl_file}.tmp"
+                with open(temp_path, 'w') as f:
+                    f.write(content)
+                os.replace(temp_path, self.sysctl_file)
+                changed = True
+            changed = self.remove_legacy_sysctls() or changed
         except Exception as e:
-            logger.error(f"Failed to update sysctl.conf: {e}")
+            logger.error(f"Failed to persist sysctls: {e}")
+        return changed
     
-    def setup_nat_rules(self):
-        """Setup NAT rules for both WAN interfaces"""
-        # Clear existing NAT rules
-        self.run_command(['iptables', '-t', 'nat', '-F'], check_output=False)
-        
-        # Setup MASQUERADE for both WAN interfaces
-        nat_commands = [
-            ['iptables', '-t', 'nat', '-A', 'POSTROUTING', '-o', self.wan1_interface, '-j', 'MASQUERADE'],
-            ['iptables', '-t', 'nat', '-A', 'POSTROUTING', '-o', self.wan2_interface, '-j', 'MASQUERADE'],
+    def remove_legacy_sysctls(self, path: str = '/etc/sysctl.conf') -> bool:
+        """Drop the blocks earlier versions appended to sysctl.conf on every start"""
+        try:
+            with open(path) as f:
+                lines = f.read().split('\n')
+        except FileNotFoundError:
+            return False
+        
+        ours = {f"{key}={value}" for key, value in self.sysctls.items()}
+        kept = []
+        in_block = False
+        for line in lines:
+            if line == '# ByteBill IP Forwarding':
+                in_block = True
+                # Each block was written with a blank line in front of it
+                if kept and kept[-1] == '':
+                    kept.pop()
+                continue
+            if in_block and line in ours:
+                continue
+            in_block = False
+            kept.append(line)
+        
+        if kept == lines:
+            return False
+        with open(path, 'w') as f:
+            f.write('\n'.join(kept))
+        logger.info(f"Removed duplicate ByteBill settings from {path}")
+        return True
+    
+    def enable_ip_forwarding(self):
+        """Enable IP forwarding, changing only the settings that differ"""
+        changes = self.sysctl_changes()
+        for key, value in changes.items():
+            self.run_command(['sysctl', '-w', f"{key}={value}"], check_output=False)
+        
+        # Make it permanent
+        self.persist_sysctls()
+        return changes
+    
+    def managed_chains(self) -> Dict[Tuple[str, str], List[List[str]]]:
+        """Desired contents of the chains ByteBill owns, keyed by (table, chain)"""
+        chains = OrderedDict([
+            # MASQUERADE for every WAN interface
+            (('nat', self.nat_chain), [
+                ['-o', interface, '-j', 'MASQUERADE'] for interface in self.wan_interfaces()
+            ]),
+            (('filter', self.forward_chain), [
+                # Allow replies back to the LAN; outbound packets are checked below,
+                # so with access control a client's open connections stop when it expires
+                ['-o', self.lan_interface, '-m', 'conntrack', '--ctstate', 'RELATED,ESTABLISHED', '-j', 'ACCEPT'],
+            ] + self.lan_forward_rules()),
+            (('filter', self.input_chain), [
+                # Allow SSH access (be careful with this in production)
+                ['-p', 'tcp', '-m', 'tcp', '--dport', '22', '-j', 'ACCEPT'],
+                
+                # Allow HTTP/HTTPS for captive portal
+                ['-p', 'tcp', '-m', 'tcp', '--dport', '80', '-j', 'ACCEPT'],
+                ['-p', 'tcp', '-m', 'tcp', '--dport', '443', '-j', 'ACCEPT'],
+                
+                # Allow Flask API
+                ['-p', 'tcp', '-m', 'tcp', '--dport', '5000', '-j', 'ACCEPT'],
+                
+                # Allow loopback
+                ['-i', 'lo', '-j', 'ACCEPT'],
+                
+                # Allow LAN access
+                ['-i', self.lan_interface, '-j', 'ACCEPT'],
+            ]),
+        ])
+        if self.marking_enabled:
+            mask = f"{self.fwmark_mask:#x}"
+            chains[('mangle', self.balance_chain)] = [
+                # Packets of known connections get their WAN back from conntrack
+                ['-j', 'CONNMARK', '--restore-mark', '--nfmask', mask, '--ctmask', mask],
+                # Only new connections are assigned one
+                ['-m', 'mark', '--mark', f"0x0/{mask}", '-j', self.select_chain],
+            ]
+        return chains
+    
+    def lan_forward_rules(self) -> List[List[str]]:
+        """LAN -> WAN rules; the authorized set gates them only when access control fills it"""
+        if not Config.ACCESS_CONTROL_ENABLED:
+            return [['-i', self.lan_interface, '-o', interface, '-j', 'ACCEPT']
+                    for interface in self.wan_interfaces()]
+        return [
+            # Only authorized clients reach the WANs; one hash lookup per packet
+            ['-i', self.lan_interface, '-o', interface,
+             '-m', 'set', '--match-set', self.authorized_set, 'src,src', '-j', 'ACCEPT']
+            for interface in self.wan_interfaces()
+        ] + [
+            ['-i', self.lan_interface, '-j', 'DROP'],
         ]
+    
+    def chain_hooks(self) -> List[Tuple[str, str, List[str], str]]:
+        """(table, built-in chain, match, managed chain) jumps into the managed chains"""
+        hooks = [
+            ('nat', 'POSTROUTING', [], self.nat_chain),
+            ('filter', 'FORWARD', [], self.forward_chain),
+            ('filter', 'INPUT', [], self.input_chain),
+        ]
+        if self.marking_enabled:
+            # Traffic from the LAN to anywhere but the LAN
+            hooks.append(('mangle', 'PREROUTING', ['!', '-d', str(ipaddress.ip_network(self.lan_subnet)),
+                                                   '-i', self.lan_interface], self.balance_chain))
+        return hooks
+    
+    def wan_interfaces(self) -> List[str]:
+        return [wan['interface'] for wan in self.wans.values()]
+    
+    def wan_links(self) -> List[Tuple[str, int, int]]:
+        """(interface, fwmark, routing table) of each WAN"""
+        return [(wan['interface'], wan['fwmark'], wan['table']) for wan in self.wans.values()]
+    
+    def pin_sets(self) -> Dict[str, str]:
+        """Name of the set of clients pinned to each WAN"""
+        return OrderedDict((wan['interface'], f"bytebill_{name}") for name, wan in self.wans.items())
+    
+    def select_rules(self, weights: Dict[str, int]) -> List[List[str]]:
+        """Rules choosing the WAN of a new connection.
+        
+        Clients pinned to a WAN with a non-zero weight go there; a WAN taken
+        out of service (weight 0) drops its pins until it is back. In connmark
+        mode everyone else gets a WAN with probability proportional to its
+        weight: each rule only sees connections the ones before it left
+        unmarked, so its probability is its weight over the weights not yet
+        used up, and the last WAN with a weight takes the rest.
+        """
+        mask = f"{self.fwmark_mask:#x}"
+        unmarked = ['-m', 'mark', '--mark', f"0x0/{mask}"]
+        rules = []
+        pin_sets = self.pin_sets()
+        if Config.WAN_POLICY_ENABLED:
+            for interface, mark, _ in self.wan_links():
+                if weights.get(interface, 0) > 0:
+                    rules.append(unmarked + ['-m', 'set', '--match-set', pin_sets[interface], 'src',
+                                             '-j', 'MARK', '--set-xmark', f"{mark:#x}/{mask}"])
         
-        for cmd in nat_commands:
-            self.run_command(cmd, check_output=False)
+        remaining = sum(max(0, weights.get(interface, 0)) for interface, _, _ in self.wan_links())
+        for interface, mark, _ in self.wan_links():
+            weight = max(0, weights.get(interface, 0))
+            if not weight or self.balance_mode != 'connmark':
+                continue
+            set_mark = ['-j', 'MARK', '--set-xmark', f"{mark:#x}/{mask}"]
+            if weight == remaining:
+                rules.append(unmarked + set_mark)
+            else:
+                # iptables-save prints probabilities with 11 decimals
+                rules.append(unmarked + ['-m', 'statistic', '--mode', 'random',
+                                         '--probability', f"{weight / remaining:.11f}"] + set_mark)
+            remaining -= weight
+        rules.append(['-j', 'CONNMARK', '--save-mark', '--nfmask', mask, '--ctmask', mask])
+        return rules
+    
+    def select_batch(self, weights: Dict[str, int], batch: Optional[RuleBatch] = None) -> RuleBatch:
+        batch = batch if batch is not None else RuleBatch()
+        batch.chain('mangle', self.select_chain)
+        for rule in self.select_rules(weights):
+            batch.append('mangle', self.select_chain, rule)
+        return batch
+    
+    def capacity_weights(self) -> Dict[str, int]:
+        """Weights proportional to each WAN's estimated download capacity, falling back to
+        the last speed test; equal without a figure for every WAN. Only estimates from
+        saturation or a speed test count, a peak without queueing is just a lower bound"""
+        weights = {interface: 1 for interface in self.wan_interfaces()}
+        estimates = load_capacity_estimates()
+        measured = {}
+        for name, wan in self.wans.items():
+            estimate = estimates.get(name) or {}
+            download_bps = estimate.get('download_bps')
+            if estimate.get('source') and download_bps:
+                measured[wan['interface']] = download_bps / 1000000
         
-        logger.info("NAT rules configured for both WAN interfaces")
+        if len(measured) != len(weights):
+            try:
+                with open(Config.SPEEDTEST_RESULTS_FILE) as f:
+                    results = json.load(f)
+            except (OSError, ValueError):
+                return weights
+            measured = {}
+            for name, wan in self.wans.items():
+                result = results.get(name) or {}
+                if result.get('status') == 'success' and result.get('download_mbps'):
+                    measured[wan['interface']] = float(result['download_mbps'])
+            if len(measured) != len(weights):
+                return weights
+        # Scaled to at most 100; multipath nexthop weights only go up to 256
+        fastest = max(measured.values())
+        return {interface: max(1, int(round(100 * mbps / fastest))) for interface, mbps in measured.items()}
+    
+    def balance_weights(self) -> Dict[str, int]:
+        """Capacity weights with the FUP WAN's cut by its quota steering; it reaches 0,
+        taking the WAN out of balancing, only when the projection says so"""
+        weights = self.capacity_weights()
+        factor = steering_factor()
+        if factor < 1 and Config.FUP_WAN in self.wans:
+            interface = self.wans[Config.FUP_WAN]['interface']
+            weights[interface] = max(1, int(round(weights[interface] * factor))) if factor > 0 else 0
+        return weights
+    
+    def set_balance_weights(self, weights: Dict[str, int]) -> bool:
+        """Change how new connections are spread; established ones keep their WAN"""
+        if not self.marking_enabled:
+            return True
+        if not self.create_sets() or not self.apply_batch(self.select_batch(weights)):
+            return False
+        logger.info("Connection balancing weights: " + ', '.join(f"{i} {w}" for i, w in weights.items()))
+        return True
+    
+    def forget_connections(self, interface: str) -> bool:
+        """Delete the conntrack entries marked for a WAN that left service; the next
+        packet of each flow is marked again for a WAN that is still up"""
+        if not self.marking_enabled:
+            return True
+        marks = [wan['fwmark'] for wan in self.wans.values() if wan['interface'] == interface]
+        if not marks:
+            return False
+        try:
+            result = subprocess.run(['conntrack', '-D', '--mark', f"{marks[0]}/{self.fwmark_mask:#x}"],
+                                    capture_output=True, text=True)
+        except OSError as e:
+            logger.error(f"Could not delete conntrack entries of {interface}: {e}")
+            return False
+        # conntrack exits 1 when no entry matched
+        output = f"{result.stdout}{result.stderr}"
+        if result.returncode != 0 and ' 0 flow entries' not in output:
+            logger.error(f"Deleting conntrack entries of {interface} failed: {output.strip()}")
+            return False
+        logger.info(f"Deleted conntrack entries marked for {interface}: {output.strip()}")
+        return True
+    
+    def firewall_batch(self, saved: Dict[str, Dict[str, List[str]]],
+                       tables: Optional[List[str]] = None) -> RuleBatch:
+        """The changes that bring the live ruleset to the desired one; empty when nothing drifted.
+        
+        A managed chain is only rewritten when its contents differ, and the
+        rewrite lands in the same iptables-restore commit as the declaration
+        that empties it, so packets never see a half-filled chain. Nothing
+        outside the managed chains is flushed: existing NAT mappings and
+        other software's rules are left alone. Rules are written the way
+        iptables-save prints them so they compare equal.
+        """
+        batch = RuleBatch()
+        chains = self.managed_chains()
+        for (table, chain), rules in chains.items():
+            if tables and table not in tables:
+                continue
+            if saved.get(table, {}).get(chain) != [format_rule(rule) for rule in rules]:
+                batch.chain(table, chain)
+                for rule in rules:
+                    batch.append(table, chain, rule)
+        
+        if ('mangle', self.balance_chain) in chains and (not tables or 'mangle' in tables):
+            # The weights belong to the balancer; only a missing chain is filled in
+            if self.select_chain not in saved.get('mangle', {}):
+                self.select_batch(self.balance_weights(), batch)
+        elif not tables or 'mangle' in tables:
+            # Balancing switched off: unhook the chain so marks stop being set
+            for rule in saved.get('mangle', {}).get('PREROUTING', []):
+                if rule.endswith(f"-j {self.balance_chain}"):
+                    batch.delete('mangle', 'PREROUTING', shlex.split(rule))
+        
+        for table, builtin, match, chain in self.chain_hooks():
+            if tables and table not in tables:
+                continue
+            current = saved.get(table, {}).get(builtin, [])
+            jump = match + ['-j', chain]
+            jumps = current.count(format_rule(jump))
+            if jumps == 0:
+                batch.insert(table, builtin, jump)
+            for _ in range(jumps - 1):
+                batch.delete(table, builtin, jump)
+            
+            # Earlier versions appended these rules straight to the built-in chains
+            for rule in chains[(table, chain)]:
+                for _ in range(current.count(format_rule(rule))):
+                    batch.delete(table, builtin, rule)
+        return batch
+    
+    def setup_nat_rules(self):
+        """Setup NAT rules for every WAN interface"""
+        if self.setup_iptables(tables=['nat']):
+            logger.info(f"NAT rules configured for {len(self.wans)} WAN interfaces")
+            return True
+        return False
     
     def setup_firewall_rules(self):
         """Setup basic firewall rules"""
-        # Allow established and related connections
-        firewall_commands = [
-            ['iptables', '-A', 'FORWARD', '-m', 'conntrack', '--ctstate', 'ESTABLISHED,RELATED', '-j', 'ACCEPT'],
-            ['iptables', '-A', 'FORWARD', '-i', self.lan_interface, '-o', self.wan1_interface, '-j', 'ACCEPT'],
-            ['iptables', '-A', 'FORWARD', '-i', self.lan_interface, '-o', self.wan2_interface, '-j', 'ACCEPT'],
-            
-            # Allow SSH access (be careful with this in production)
-            ['iptables', '-A', 'INPUT', '-p', 'tcp', '--dport', '22', '-j', 'ACCEPT'],
-            
-            # Allow HTTP/HTTPS for captive portal
-            ['iptables', '-A', 'INPUT', '-p', 'tcp', '--dport', '80', '-j', 'ACCEPT'],
-            ['iptables', '-A', 'INPUT', '-p', 'tcp', '--dport', '443', '-j', 'ACCEPT'],
-            
-            # Allow Flask API
-            ['iptables', '-A', 'INPUT', '-p', 'tcp', '--dport', '5000', '-j', 'ACCEPT'],
-            
-            # Allow loopback
-            ['iptables', '-A', 'INPUT', '-i', 'lo', '-j', 'ACCEPT'],
-            
-            # Allow LAN access
-            ['iptables', '-A', 'INPUT', '-i', self.lan_interface, '-j', 'ACCEPT'],
-        ]
+        return self.setup_iptables(tables=['filter'])
+    
+    @property
+    def routing(self) -> NetlinkRouting:
+        """Shared netlink routing handle, opened on first use"""
+        return get_routing()
+    
+    def policy_route_changes(self) -> Optional[List[Tuple[str, int, Optional[str], int]]]:
+        """(destination, table, gateway, oif) routes of the per-WAN tables that are missing or differ.
+        
+        A WAN without a gateway yet (DHCP still running, link down) is left
+        out until a later pass finds one; None only when no WAN has one.
+        """
+        # Gateways are read before the per-WAN tables change underneath us
+        gateways = {interface: self.get_interface_gateway(interface) for interface in self.wan_interfaces()}
+        
+        missing = [interface for interface, gateway in gateways.items() if not gateway]
+        if len(missing) == len(gateways):
+            logger.error(f"Could not determine WAN gateways of {', '.join(missing)}")
+            return None
+        if missing:
+            logger.warning(f"No gateway yet on {', '.join(missing)}; routing table(s) left unchanged")
         
-        for cmd in firewall_commands:
-            self.run_command(cmd, check_output=False)
+        lan_subnet = str(ipaddress.ip_network(self.lan_subnet))
+        lan_index = self.routing.link_index(self.lan_interface)
+        desired = []
+        for interface, _, table in self.wan_links():
+            if not gateways[interface]:
+                continue
+            desired.append(('0.0.0.0/0', table, gateways[interface], self.routing.link_index(interface)))
+            desired.append((lan_subnet, table, None, lan_index))
+        
+        current = {}
+        for _, _, table in self.wan_links():
+            for route in self.routing.socket.get_routes(table):
+                current[(f"{route['dst']}/{route['dst_len']}", table)] = (route['gateway'], route['oif'])
+        return [route for route in desired if current.get(route[:2]) != route[2:]]
     
     def setup_policy_routing(self):
         """Setup policy-based routing for load balancing"""
-        # Clear existing rules
-        self.run_command(['ip', 'rule', 'flush'], check_output=False)
-        self.run_command(['ip', 'route', 'flush', 'table', str(self.wan1_table)], check_output=False)
-        self.run_command(['ip', 'route', 'flush', 'table', str(self.wan2_table)], check_output=False)
-        
-        # Get WAN gateway IPs
-        wan1_gateway = self.get_interface_gateway(self.wan1_interface)
-        wan2_gateway = self.get_interface_gateway(self.wan2_interface)
-        
-        if not wan1_gateway or not wan2_gateway:
-            logger.error("Could not determine WAN gateways")
+        changes = self.policy_route_changes()
+        if changes is None:
             return False
-        
-        # Setup routing tables
-        routing_commands = [
-            # WAN1 table
-            ['ip', 'route', 'add', 'default', 'via', wan1_gateway, 'dev', self.wan1_interface, 'table', str(self.wan1_table)],
-            ['ip', 'route', 'add', self.lan_subnet, 'dev', self.lan_interface, 'table', str(self.wan1_table)],
+        return self.apply_policy_routes(changes)
+    
+    def apply_policy_routes(self, changes: List[Tuple[str, int, Optional[str], int]]) -> bool:
+        sock = self.routing.socket
+        try:
+            # Each route is replaced in place, so the tables are never empty
+            for destination, table, gateway, oif in changes:
+                if gateway:
+                    sock.replace_route(destination, table, gateway=gateway, oif=oif)
+                else:
+                    sock.replace_route(destination, table, oif=oif, scope=RT_SCOPE_LINK)
             
-            # WAN2 table
-            ['ip', 'route', 'add', 'default', 'via', wan2_gateway, 'dev', self.wan2_interface, 'table', str(self.wan2_table)],
-            ['ip', 'route', 'add', self.lan_subnet, 'dev', self.lan_interface, 'table', str(self.wan2_table)],
+            # Default rules; existing ones are left in place rather than flushed and re-added
+            sock.add_rule(RT_TABLE_MAIN, 32766)
+            sock.add_rule(RT_TABLE_DEFAULT, 32767)
             
-            # Default rules
-            ['ip', 'rule', 'add', 'from', 'all', 'table', 'main', 'pref', '32766'],
-            ['ip', 'rule', 'add', 'from', 'all', 'table', 'default', 'pref', '32767'],
-        ]
-        
-        for cmd in routing_commands:
-            self.run_command(cmd, check_output=False)
+            # Marked connections use their WAN's table
+            if self.marking_enabled:
+                for index, (_, mark, table) in enumerate(self.wan_links()):
+                    sock.add_rule(table, self.fwmark_rule_priority + index, fwmark=mark, fwmask=self.fwmark_mask)
+            
+            self.apply_source_rules()
+        except NetlinkError as e:
+            logger.error(f"Failed to configure policy routing: {e}")
+            return False
         
-        logger.info("Policy routing configured")
+        if changes:
+            logger.info(f"Policy routing configured ({len(changes)} route(s) replaced)")
         return True
     
+    def apply_source_rules(self):
+        """`from <WAN address> lookup <WAN table>` for each WAN.
+        
+        A speed test bound to a WAN's address with --source would otherwise
+        follow the main default route out of another WAN and be masqueraded
+        there. Rules for addresses a WAN no longer has are removed.
+        """
+        sock = self.routing.socket
+        desired = set()
+        for index, (interface, _, table) in enumerate(self.wan_links()):
+            address = self.routing.address(interface)
+            if address:
+                desired.add((self.source_rule_priority + index, address, table))
+        
+        for rule in sock.get_rules():
+            if self.source_rule_priority <= rule['priority'] < self.fwmark_rule_priority and rule['src'] and \
+                    (rule['priority'], rule['src'], rule['table']) not in desired:
+                sock.delete_rule(rule['table'], rule['priority'], src=rule['src'])
+        for priority, address, table in sorted(desired):
+            sock.add_rule(table, priority, src=address)
+    
     def get_interface_gateway(self, interface: str) -> Optional[str]:
         """Get the gateway IP for a network interface"""
         try:
-            result = self.run_command(['ip', 'route', 'show', 'dev', interface])
-            if result:
-                lines = result.split('\n')
-                for line in lines:
-                    if 'default via' in line:
-                        parts = line.split()
-                        gateway_index = parts.index('via') + 1
-                        if gateway_index < len(parts):
-                            return parts[gateway_index]
-            return None
+            return self.routing.gateway(interface)
         except Exception as e:
             logger.error(f"Error getting gateway for {interface}: {e}")
             return None
     
     def set_primary_wan(self, wan_interface: str):
         """Set primary WAN interface for routing"""
-        if wan_interface == self.wan1_interface:
-            table_id = self.wan1_table
-        elif wan_interface == self.wan2_interface:
-            table_id = self.wan2_table
-        else:
+        if wan_interface not in self.wan_interfaces():
             logger.error(f"Invalid WAN interface: {wan_interface}")
             return False
         
-        # Remove existing default route
-        self.run_command(['ip', 'route', 'del', 'default'], check_output=False)
-        
-        # Add new default route from specified table
-        gateway = self.get_interface_gateway(wan_interface)
-        if gateway:
-            self.run_command([
-                'ip', 'route', 'add', 'default', 'via', gateway, 'dev', wan_interface
-            ], check_output=False)
+        # One atomic replace; there is no moment without a default route
+        if self.routing.replace_default_route(wan_interface):
             logger.info(f"Primary WAN set to {wan_interface}")
-            return True
+            # New connections follow; established ones stay where they are
+            return self.set_balance_weights({wan_interface: 1})
         
         return False
     
-    def setup_load_balancing(self):
-        """Setup load balancing between WAN interfaces"""
-        wan1_gateway = self.get_interface_gateway(self.wan1_interface)
-        wan2_gateway = self.get_interface_gateway(self.wan2_interface)
+    def setup_load_balancing(self, weights: Optional[Dict[str, int]] = None):
+        """Setup load balancing between WAN interfaces, by measured capacity and FUP steering
+        unless weights are given per interface"""
+        weights = dict(self.balance_weights(), **(weights or {}))
         
-        if not wan1_gateway or not wan2_gateway:
-            logger.error("Cannot setup load balancing - missing gateways")
-            return False
+        # Traffic without a mark, including the router's own, uses the multipath route
+        if self.routing.replace_multipath_route({i: w for i, w in weights.items() if w > 0}):
+            logger.info("Load balancing configured")
+            return self.set_balance_weights(weights)
         
-        # Remove existing default route
-        self.run_command(['ip', 'route', 'del', 'default'], check_output=False)
+        logger.error("Cannot setup load balancing - missing gateways")
+        return False
+    
+    def create_authorized_set(self) -> bool:
+        """Create the authorized-client set if it does not exist"""
+        batch = SetBatch().create(self.authorized_set, 'hash:ip,mac',
+                                  timeout=0, maxelem=self.authorized_set_size)
+        return self.apply_sets(batch)
+    
+    def create_sets(self) -> bool:
+        """Create every set the rules reference"""
+        batch = SetBatch().create(self.authorized_set, 'hash:ip,mac',
+                                  timeout=0, maxelem=self.authorized_set_size)
+        if Config.WAN_POLICY_ENABLED:
+            for name in self.pin_sets().values():
+                batch.create(name, 'hash:ip', timeout=0, maxelem=self.pin_set_size)
+        return self.apply_sets(batch)
+    
+    def pin_clients(self, assignments: List[Tuple[str, Optional[str], int]]) -> bool:
+        """Pin (ip, WAN interface or None, seconds) clients; None leaves a client to the balancer.
         
-        # Add load-balanced default route
-        self.run_command([
-            'ip', 'route', 'add', 'default',
-            'nexthop', 'via', wan1_gateway, 'dev', self.wan1_interface, 'weight', '1',
-            'nexthop', 'via', wan2_gateway, 'dev', self.wan2_interface, 'weight', '1'
-        ], check_output=False)
+        Moving a client is a set delete and add, whatever the number of
+        clients; the kernel drops the pin when the session's time runs out.
+        """
+        batch = SetBatch()
+        pin_sets = self.pin_sets()
+        for ip_address, interface, timeout in assignments:
+            for wan, name in pin_sets.items():
+                if wan == interface and timeout > 0:
+                    batch.add(name, ip_address, timeout)
+                else:
+                    batch.delete(name, ip_address)
+        return self.apply_sets(batch)
+    
+    def get_set_members(self, name: str) -> Optional[Dict[str, int]]:
+        """Member -> seconds the kernel still holds it, or None if the set does not exist"""
+        saved = self.run_command(['ipset', 'save', name])
+        if saved is None:
+            return None
+        members = {}
+        for line in saved.splitlines():
+            fields = line.split()
+            if fields[:1] == ['add']:
+                timeout = fields.index('timeout') if 'timeout' in fields else None
+                # ipset prints MACs in upper case; client_member() uses lower case
+                members[fields[2].lower()] = int(fields[timeout + 1]) if timeout else 0
+        return members
+    
+    def needs_refresh(self, held: int, timeout: int) -> bool:
+        """Whether an entry holding `held` seconds falls short of `timeout`.
         
-        logger.info("Load balancing configured")
-        return True
+        Entries are capped at IPSET_MAX_TIMEOUT and a session can be extended,
+        so a member can expire before its session does; re-adding it with the
+        current remaining time refreshes it. A refresh interval of slack
+        keeps the normal countdown from re-adding every member.
+        """
+        return min(timeout, IPSET_MAX_TIMEOUT) - held > Config.RECONCILE_INTERVAL
     
-    def block_user(self, ip_address: str, mac_address: str):
-        """Block a user by IP and MAC address"""
-        block_commands = [
-            ['iptables', '-A', 'FORWARD', '-s', ip_address, '-j', 'DROP'],
-            ['iptables', '-A', 'FORWARD', '-m', 'mac', '--mac-source', mac_address, '-j', 'DROP']
-        ]
+    def get_pinned_clients(self) -> Optional[Dict[str, Tuple[str, int]]]:
+        """Pinned client IP -> (WAN interface, seconds held), or None if a set could not be read"""
+        pinned = {}
+        for interface, name in self.pin_sets().items():
+            members = self.get_set_members(name)
+            if members is None:
+                return None
+            for ip_address, held in members.items():
+                pinned[ip_address] = (interface, held)
+        return pinned
+    
+    def pin_set_batch(self, pinned: Dict[str, Tuple[str, int]],
+                      assignments: List[Tuple[str, Optional[str], int]]) -> SetBatch:
+        """Moves between the pin sets that bring `pinned` to `assignments`"""
+        batch = SetBatch()
+        pin_sets = self.pin_sets()
+        desired = {ip: (interface, timeout) for ip, interface, timeout in assignments
+                   if interface in pin_sets and timeout > 0}
+        for ip_address, (interface, timeout) in desired.items():
+            current, held = pinned.get(ip_address, (None, 0))
+            if current == interface and not self.needs_refresh(held, timeout):
+                continue
+            if current and current != interface:
+                batch.delete(pin_sets[current], ip_address)
+            batch.add(pin_sets[interface], ip_address, timeout)
+        for ip_address, (interface, _) in sorted(pinned.items()):
+            if ip_address not in desired:
+                batch.delete(pin_sets[interface], ip_address)
+        return batch
+    
+    def authorize_clients(self, clients: List[Tuple[str, str, int]]) -> bool:
+        """Authorize (ip, mac, seconds) clients; the kernel drops each entry when it times out"""
+        batch = SetBatch()
+        for ip_address, mac_address, timeout in clients:
+            # A timeout of 0 would make the entry permanent
+            if timeout > 0:
+                batch.add(self.authorized_set, client_member(ip_address, mac_address), timeout)
         
-        for cmd in block_commands:
-            self.run_command(cmd, check_output=False)
+        if not self.apply_sets(batch):
+            return False
+        logger.info(f"Authorized {len(batch)} client(s)")
+        return True
+    
+    def revoke_clients(self, clients: List[Tuple[str, str]]) -> bool:
+        """Remove (ip, mac) clients from the authorized set"""
+        batch = SetBatch()
+        for ip_address, mac_address in clients:
+            batch.delete(self.authorized_set, client_member(ip_address, mac_address))
         
-        logger.info(f"Blocked user: IP {ip_address}, MAC {mac_address}")
+        if not self.apply_sets(batch):
+            return False
+        logger.info(f"Revoked {len(batch)} client(s)")
+        return True
     
-    def unblock_user(self, ip_address: str, mac_address: str):
-        """Unblock a user by removing iptables rules"""
-        unblock_commands = [
-            ['iptables', '-D', 'FORWARD', '-s', ip_address, '-j', 'DROP'],
-            ['iptables', '-D', 'FORWARD', '-m', 'mac', '--mac-source', mac_address, '-j', 'DROP']
-        ]
+    def get_authorized_members(self) -> Optional[Dict[str, int]]:
+        """Members of the authorized set -> seconds held, or None if the set does not exist"""
+        return self.get_set_members(self.authorized_set)
+    
+    def authorized_set_batch(self, members: Dict[str, int], clients: List[Tuple[str, str, int]]) -> SetBatch:
+        """Add clients missing from the set or about to expire early, and remove members without a client"""
+        batch = SetBatch()
+        desired = {}
+        for ip_address, mac_address, timeout in clients:
+            if timeout > 0:
+                desired[client_member(ip_address, mac_address)] = timeout
+        for member, timeout in desired.items():
+            if member not in members or self.needs_refresh(members[member], timeout):
+                batch.add(self.authorized_set, member, timeout)
+        for member in sorted(set(members) - set(desired)):
+            batch.delete(self.authorized_set, member)
+        return batch
+    
+    def replace_authorized_clients(self, clients: List[Tuple[str, str, int]]) -> bool:
+        """Atomically replace the whole authorized set, e.g. when resyncing from the database"""
+        staging = f"{self.authorized_set}_new"
+        options = {'timeout': 0, 'maxelem': self.authorized_set_size}
         
-        for cmd in unblock_commands:
-            self.run_command(cmd, check_output=False)
+        batch = SetBatch()
+        batch.create(self.authorized_set, 'hash:ip,mac', **options)
+        batch.create(staging, 'hash:ip,mac', **options)
+        batch.flush(staging)
+        for ip_address, mac_address, timeout in clients:
+            if timeout > 0:
+                batch.add(staging, client_member(ip_address, mac_address), timeout)
+        batch.swap(staging, self.authorized_set)
+        batch.destroy(staging)
         
-        logger.info(f"Unblocked user: IP {ip_address}, MAC {mac_address}")
+        if not self.apply_sets(batch):
+            return False
+        logger.info(f"Authorized set replaced with {len(clients)} client(s)")
+        return True
+    
+    def block_user(self, ip_address: str, mac_address: str):
+        """Block a user by IP and MAC address"""
+        if self.revoke_clients([(ip_address, mac_address)]):
+            logger.info(f"Blocked user: IP {ip_address}, MAC {mac_address}")
+            return True
+        return False
+    
+    def unblock_user(self, ip_address: str, mac_address: str, timeout: int):
+        """Unblock a user for `timeout` seconds"""
+        if self.authorize_clients([(ip_address, mac_address, timeout)]):
+            logger.info(f"Unblocked user: IP {ip_address}, MAC {mac_address}")
+            return True
+        return False
     
     def get_routing_table(self):
         """Get current routing table"""
-        result = self.run_command(['ip', 'route', 'show'])
-        return result.split('\n') if result else []
+        try:
+            return self.routing.format_routes()
+        except Exception as e:
+            logger.error(f"Error reading routing table: {e}")
+            return []
     
     def get_iptables_rules(self):
         """Get current iptables rules"""
@@ -241,6 +748,24 @@ class RouterManager:
             'filter': filter_rules.split('\n') if filter_rules else []
         }
     
+    def setup_iptables(self, tables: Optional[List[str]] = None) -> bool:
+        """Apply whatever NAT and firewall changes are needed in a single iptables-restore"""
+        # The rules reference the authorized-client and pin sets
+        if not self.create_sets():
+            return False
+        
+        saved = self.get_saved_chains()
+        if saved is None:
+            logger.error("Could not read the live ruleset")
+            return False
+        return self.apply_batch(self.firewall_batch(saved, tables))
+    
+    def warn_unsupported_marking(self):
+        """Say so when connection marking was asked for but the firewall backend cannot do it"""
+        if self.marking_requested and not self.marking_enabled:
+            logger.warning("BALANCE_MODE=connmark and WAN_POLICY_ENABLED need FIREWALL_BACKEND=iptables; "
+                           "with nftables new connections follow the multipath route and clients are not pinned")
+    
     def initialize_routing(self):
         """Initialize complete routing setup"""
         logger.info("Initializing ByteBill routing...")
@@ -248,11 +773,15 @@ class RouterManager:
         # Enable IP forwarding
         self.enable_ip_forwarding()
         
-        # Setup NAT rules
-        self.setup_nat_rules()
-        
-        # Setup firewall rules
-        self.setup_firewall_rules()
+        # NAT and firewall rules go in as one transaction
+        if Config.FIREWALL_BACKEND == 'nftables':
+            applied = NftablesManager().setup()
+        else:
+            applied = self.setup_iptables()
+        if not applied:
+            logger.error("Routing initialization aborted: firewall rules could not be applied")
+            return False
+        self.warn_unsupported_marking()
         
         # Setup policy routing
         self.setup_policy_routing()
@@ -261,12 +790,13 @@ class RouterManager:
         self.setup_load_balancing()
         
         logger.info("Routing initialization complete")
+        return True
 
 # Convenience functions
 def initialize_router():
     """Initialize router configuration"""
     router = RouterManager()
-    router.initialize_routing()
+    return router.initialize_routing()
 
 def switch_primary_wan(wan_interface: str):
     """Switch primary WAN interface"""
@@ -276,9 +806,9 @@ def switch_primary_wan(wan_interface: str):
 def block_client(ip_address: str, mac_address: str):
     """Block a client"""
     router = RouterManager()
-    router.block_user(ip_address, mac_address)
+    return router.block_user(ip_address, mac_address)
 
-def unblock_client(ip_address: str, mac_address: str):
-    """Unblock a client"""
+def unblock_client(ip_address: str, mac_address: str, timeout: int):
+    """Unblock a client for `timeout` seconds"""
     router = RouterManager()
-    router.unblock_user(ip_address, mac_address)
+    return router.unblock_user(ip_address, mac_address, timeout)
@@ -0,0 +1,177 @@
+import ipaddress
+import logging
+import subprocess
+from typing import Iterable, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Handles used on both shaped devices
+ROOT_CLASS = '1:1'
+DEFAULT_MINOR = 0xfffe
+HASH_TABLE = '100'
+FILTER_PRIO = 10
+MIN_CLIENT_MINOR = 0x10
+QUANTUM = 1514  # one full frame per round, whatever the class rate
+
+class ShapingError(Exception):
+    pass
+
+class TrafficShaper:
+    """Per-client HTB shaping on the LAN interface and its IFB mirror.
+
+    Downloads are shaped on LAN egress, matched on destination IP; uploads
+    are redirected from LAN ingress to the IFB device and shaped there,
+    matched on source IP. Each client gets an HTB class with a leaf
+    fq_codel or cake qdisc. Classification goes through a 256-bucket u32
+    hash table keyed on the last address octet, so lookup cost does not
+    grow with the number of clients. Class and filter handles are derived
+    from the client IP, so removing a client needs no state lookup, and
+    every change is a single `tc -batch`.
+    """
+
+    def __init__(self):
+        self.lan_interface = Config.LAN_INTERFACE
+        self.ifb_interface = Config.SHAPING_IFB_INTERFACE
+        self.lan_subnet = ipaddress.ip_network(Config.LAN_SUBNET)
+        self.leaf_qdisc = Config.SHAPING_LEAF_QDISC
+        # (device, address matched, offset of that address in the IP header, total kbps)
+        self.directions = {
+            'download': (self.lan_interface, 'dst', 16, Config.SHAPING_DOWNLOAD_KBPS),
+            'upload': (self.ifb_interface, 'src', 12, Config.SHAPING_UPLOAD_KBPS)
+        }
+
+    def run_batch(self, lines: List[str], quiet: bool = False) -> bool:
+        """Run tc commands in one process; -force keeps going past individual failures"""
+        if not lines:
+            return True
+        try:
+            result = subprocess.run(['tc', '-force', '-batch', '-'], input='\n'.join(lines) + '\n',
+                                    capture_output=True, text=True)
+        except Exception as e:
+            logger.error(f"Unexpected error running tc: {e}")
+            return False
+        if result.returncode != 0:
+            (logger.debug if quiet else logger.warning)(f"tc batch of {len(lines)} command(s) had errors: {result.stderr.strip()}")
+            return False
+        return True
+
+    def client_handles(self, ip_address: str) -> Tuple[str, str, str]:
+        """(class minor, hash bucket, filter node) for a client address"""
+        address = ipaddress.ip_address(ip_address)
+        if address not in self.lan_subnet:
+            raise ShapingError(f"{ip_address} is not in {self.lan_subnet}")
+        offset = int(address) - int(self.lan_subnet.network_address)
+        minor = MIN_CLIENT_MINOR + offset
+        if minor >= DEFAULT_MINOR:
+            raise ShapingError(f"{self.lan_subnet} is too large to shape per client")
+        # Addresses sharing a last octet share a bucket; the node tells them apart
+        return f"{minor:x}", f"{offset & 0xff:x}", f"{(offset >> 8) + 1:x}"
+
+    def teardown_commands(self) -> List[str]:
+        return [
+            f"qdisc del dev {self.lan_interface} root",
+            f"qdisc del dev {self.lan_interface} ingress",
+            f"qdisc del dev {self.ifb_interface} root",
+        ]
+
+    def root_commands(self) -> List[str]:
+        """HTB trees, hash tables and the IFB redirect"""
+        lan = self.lan_interface
+        commands = [
+            # Send everything arriving from the LAN through the IFB so uploads can be shaped
+            f"qdisc add dev {lan} handle ffff: ingress",
+            f"filter add dev {lan} parent ffff: protocol ip u32 match u32 0 0 "
+            f"action mirred egress redirect dev {self.ifb_interface}",
+        ]
+        for device, field, offset, total_kbps in self.directions.values():
+            commands += [
+                f"qdisc add dev {device} root handle 1: htb default {DEFAULT_MINOR:x}",
+                f"class add dev {device} parent 1: classid {ROOT_CLASS} htb rate {total_kbps}kbit ceil {total_kbps}kbit quantum {QUANTUM}",
+                # Unshaped traffic: the router itself, clients without a rate limit
+                f"class add dev {device} parent {ROOT_CLASS} classid 1:{DEFAULT_MINOR:x} htb "
+                f"rate {max(1, total_kbps // 100)}kbit ceil {total_kbps}kbit quantum {QUANTUM}",
+                f"qdisc add dev {device} parent 1:{DEFAULT_MINOR:x} {self.leaf_qdisc}",
+                f"filter add dev {device} parent 1: prio {FILTER_PRIO} handle {HASH_TABLE}: protocol ip u32 divisor 256",
+                f"filter add dev {device} parent 1: prio {FILTER_PRIO} protocol ip u32 ht 800:: "
+                f"match ip {field} {self.lan_subnet} hashkey mask 0x000000ff at {offset} link {HASH_TABLE}:",
+            ]
+        return commands
+
+    def client_commands(self, ip_address: str, download_kbps: Optional[int],
+                        upload_kbps: Optional[int]) -> List[str]:
+        minor, bucket, node = self.client_handles(ip_address)
+        commands = []
+        for direction, rate in (('download', download_kbps), ('upload', upload_kbps)):
+            if not rate:
+                continue
+            device, field, _, _ = self.directions[direction]
+            commands += [
+                f"class replace dev {device} parent {ROOT_CLASS} classid 1:{minor} htb rate {rate}kbit ceil {rate}kbit quantum {QUANTUM}",
+                f"qdisc replace dev {device} parent 1:{minor} handle {minor}: {self.leaf_qdisc}",
+                f"filter replace dev {device} parent 1: prio {FILTER_PRIO} handle {HASH_TABLE}:{bucket}:{node} "
+                f"protocol ip u32 ht {HASH_TABLE}:{bucket}: match ip {field} {ip_address}/32 flowid 1:{minor}",
+            ]
+        return commands
+
+    def removal_commands(self, ip_address: str) -> List[str]:
+        minor, bucket, node = self.client_handles(ip_address)
+        commands = []
+        for device, _, _, _ in self.directions.values():
+            # The filter goes first; a class still referenced by a filter cannot be deleted
+            commands += [
+                f"filter del dev {device} parent 1: prio {FILTER_PRIO} handle {HASH_TABLE}:{bucket}:{node} protocol ip u32",
+                f"class del dev {device} classid 1:{minor}",
+            ]
+        return commands
+
+    def ensure_ifb(self) -> bool:
+        """Create and bring up the IFB device"""
+        subprocess.run(['ip', 'link', 'add', self.ifb_interface, 'type', 'ifb'], capture_output=True)
+        result = subprocess.run(['ip', 'link', 'set', self.ifb_interface, 'up'], capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error(f"Could not bring up {self.ifb_interface}: {result.stderr.strip()}")
+            return False
+        return True
+
+    def setup(self, clients: Iterable[Tuple[str, Optional[int], Optional[int]]] = ()) -> bool:
+        """Build the shaping hierarchy with an initial set of (ip, download_kbps, upload_kbps) clients"""
+        if not self.ensure_ifb():
+            return False
+
+        # Deleting qdiscs that do not exist yet is expected to fail; the rest must not
+        self.run_batch(self.teardown_commands(), quiet=True)
+        commands = self.root_commands()
+        for ip_address, download_kbps, upload_kbps in clients:
+            try:
+                commands += self.client_commands(ip_address, download_kbps, upload_kbps)
+            except ShapingError as e:
+                logger.warning(f"Not shaping client: {e}")
+
+        if not self.run_batch(commands):
+            return False
+        logger.info(f"Traffic shaping configured on {self.lan_interface}/{self.ifb_interface}")
+        return True
+
+    def add_clients(self, clients: Iterable[Tuple[str, Optional[int], Optional[int]]]) -> bool:
+        """Shape (ip, download_kbps, upload_kbps) clients, replacing any previous limits"""
+        commands = []
+        for ip_address, download_kbps, upload_kbps in clients:
+            try:
+                commands += self.client_commands(ip_address, download_kbps, upload_kbps)
+            except ShapingError as e:
+                logger.warning(f"Not shaping client: {e}")
+        return self.run_batch(commands)
+
+    def remove_clients(self, ip_addresses: Iterable[str]) -> bool:
+        """Drop the classes and filters of clients; missing ones are skipped"""
+        commands = []
+        for ip_address in ip_addresses:
+            try:
+                commands += self.removal_commands(ip_address)
+            except ShapingError:
+                continue
+        # A client shaped in one direction only has nothing to delete in the other
+        self.run_batch(commands, quiet=True)
+        return True
@@ -0,0 +1,142 @@
+import os
+import json
+import mmap
+import struct
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BBSR'
+VERSION = 1
+# magic, version, slot capacity, sequence; the sequence is 8-byte aligned at offset 16
+HEADER = struct.Struct('<4sH2xI4xQ')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 16
+LENGTH = struct.Struct('<I')
+DEFAULT_CAPACITY = 262144
+
+class SharedRecord:
+    """One JSON record published by a single process and read by any number of
+    others through a shared memory mapping, normally on tmpfs.
+
+    The file holds two slots. The writer fills the slot readers are not
+    pointed at, then bumps the sequence number, so publishing is a single
+    8-byte store. A reader copies the slot the sequence points at and
+    accepts it only if the sequence has not moved meanwhile, so it never
+    sees a half-written record and never waits on a lock.
+    """
+
+    def __init__(self, path: str, writable: bool = False, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.writable = writable
+        self.capacity = capacity
+        self.map = None
+        self.inode = None
+        if writable:
+            self.create()
+
+    def size(self) -> int:
+        return HEADER.size + 2 * (LENGTH.size + self.capacity)
+
+    def slot_offset(self, sequence: int) -> int:
+        return HEADER.size + (sequence % 2) * (LENGTH.size + self.capacity)
+
+    def create(self):
+        """Map the record for writing, reusing a compatible file so open readers keep theirs"""
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            fd = None
+        if fd is not None:
+            try:
+                header = os.pread(fd, HEADER.size, 0)
+                if (len(header) == HEADER.size and HEADER.unpack(header)[:3] == (MAGIC, VERSION, self.capacity)
+                        and os.fstat(fd).st_size == self.size()):
+                    self.map = mmap.mmap(fd, 0)
+                    return
+            finally:
+                os.close(fd)
+
+        # Incompatible or missing: build a new file and swap it in; readers remap on the inode change
+        temp_path = f"{self.path}.tmp"
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size())
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, self.capacity, 0), 0)
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, self.path)
+
+    def publish(self, record: Dict) -> bool:
+        data = json.dumps(record, separators=(',', ':')).encode()
+        if len(data) > self.capacity:
+            logger.error(f"Record of {len(data)} bytes does not fit {self.path} ({self.capacity} bytes)")
+            return False
+        sequence = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] + 1
+        offset = self.slot_offset(sequence)
+        self.map[offset + LENGTH.size:offset + LENGTH.size + len(data)] = data
+        LENGTH.pack_into(self.map, offset, len(data))
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, sequence)
+        return True
+
+    def open(self) -> bool:
+        """(Re)map the file for reading when it is new or was replaced"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self.map is not None and stat.st_ino == self.inode:
+            return True
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, capacity, _ = HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION or len(mapped) < HEADER.size + 2 * (LENGTH.size + capacity):
+            mapped.close()
+            logger.warning(f"{self.path} is not a version {VERSION} shared record")
+            return False
+        self.map, self.inode, self.capacity = mapped, stat.st_ino, capacity
+        return True
+
+    def read(self, attempts: int = 100) -> Optional[Dict]:
+        """The last published record, or None before the first one"""
+        if not self.open():
+            return None
+        for _ in range(attempts):
+            sequence = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+            if sequence == 0:
+                return None
+            offset = self.slot_offset(sequence)
+            length = LENGTH.unpack_from(self.map, offset)[0]
+            data = self.map[offset + LENGTH.size:offset + LENGTH.size + min(length, self.capacity)]
+            if SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] != sequence:
+                # The writer came round to this slot while it was copied
+                continue
+            try:
+                return json.loads(data)
+            except ValueError:
+                continue
+        logger.warning(f"Gave up reading {self.path} after {attempts} attempts")
+        return None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+# path -> reader, shared by the threads of this process
+_readers = {}
+_readers_lock = threading.Lock()
+
+def read_shared(path: str) -> Optional[Dict]:
+    """The last record published at `path`, through a mapping kept open across calls"""
+    with _readers_lock:
+        reader = _readers.get(path)
+        if reader is None:
+            reader = _readers[path] = SharedRecord(path)
+        return reader.read()
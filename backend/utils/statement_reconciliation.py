@@ -0,0 +1,408 @@
+import csv
+import heapq
+import itertools
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, or_
+
+from database import db
+from models.reconciliation import ReconciliationRun
+from models.session import Session
+from models.transaction import MpesaTransaction, TransactionStatus
+
+logger = logging.getLogger(__name__)
+
+# Column headings of the M-PESA org portal statement export
+STATEMENT_COLUMNS = {
+    'receipt': 'Receipt No.',
+    'completed_at': 'Completion Time',
+    'paid_in': 'Paid In',
+    'status': 'Transaction Status'
+}
+
+STATEMENT_DATE_FORMATS = ['%d-%m-%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M']
+
+# Statement and Daraja times are East Africa Time; created_at is UTC
+LOCAL_TIME_OFFSET = timedelta(hours=3)
+
+# How far a statement row may be from the creation of a payment settled
+# without a receipt (by the STK Query poller) and still be matched to it
+RECEIPTLESS_MATCH_WINDOW = timedelta(minutes=10)
+
+REPORT_FIELDS = ['issue', 'receipt', 'statement_amount', 'db_amount', 'session_amount',
+                 'statement_time', 'db_time', 'checkout_request_id', 'statement_line']
+
+class ReconciliationError(Exception):
+    pass
+
+class StatementEntry(NamedTuple):
+    receipt: str
+    completed_at: Optional[datetime]
+    amount: Decimal
+    line: int
+
+class LedgerEntry(NamedTuple):
+    receipt: str
+    amount: Decimal
+    session_amount: Optional[Decimal]
+    transaction_date: Optional[datetime]
+    checkout_request_id: str
+
+def normalize_receipt(value) -> str:
+    return (value or '').strip().upper()
+
+def parse_amount(value) -> Optional[Decimal]:
+    value = (value or '').replace(',', '').strip()
+    if not value:
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return None
+
+def parse_statement_time(value) -> Optional[datetime]:
+    value = (value or '').strip()
+    for fmt in STATEMENT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+def read_statement(path: str, columns: Dict[str, str] = None) -> Iterator[StatementEntry]:
+    """Stream completed paid-in rows from a statement CSV in file order"""
+    columns = columns or STATEMENT_COLUMNS
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+
+        # Exports carry a preamble (organisation, period, ...) before the header row
+        header = None
+        for row in reader:
+            if columns['receipt'] in row:
+                header = {name: index for index, name in enumerate(row)}
+                break
+        if header is None:
+            raise ReconciliationError(f"No '{columns['receipt']}' header found in {path}")
+
+        receipt_index = header[columns['receipt']]
+        paid_in_index = header.get(columns['paid_in'])
+        time_index = header.get(columns['completed_at'])
+        status_index = header.get(columns['status'])
+        if paid_in_index is None:
+            raise ReconciliationError(f"No '{columns['paid_in']}' column found in {path}")
+
+        for row in reader:
+            if len(row) <= max(receipt_index, paid_in_index):
+                continue
+            if status_index is not None and row[status_index].strip().lower() != 'completed':
+                continue
+
+            amount = parse_amount(row[paid_in_index])
+            receipt = normalize_receipt(row[receipt_index])
+            if not receipt or not amount or amount <= 0:
+                continue
+
+            completed_at = parse_statement_time(row[time_index]) if time_index is not None else None
+            yield StatementEntry(receipt, completed_at, amount, reader.line_num)
+
+class SortedStatement:
+    """Statement entries ordered by receipt in bounded memory.
+
+    A first pass checks whether the export is already ordered and finds its
+    period. Unordered exports are external-sorted: sorted runs of
+    `chunk_size` rows are spilled to temporary files and merged lazily.
+    Rows completed outside an explicit `window` are left out of every pass.
+    """
+
+    def __init__(self, path: str, columns: Dict[str, str] = None, chunk_size: int = 50000,
+                 window: Tuple[Optional[datetime], Optional[datetime]] = (None, None)):
+        self.path = path
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.window = window
+        self.period_start = None
+        self.period_end = None
+        self.rows = 0
+        self._runs = []
+        self._tmpdir = None
+
+    def entries(self) -> Iterator[StatementEntry]:
+        """Statement rows in file order, without those completed outside the window"""
+        start, end = self.window
+        for entry in read_statement(self.path, self.columns):
+            # A row without a completion time cannot be placed, so it is kept
+            if entry.completed_at and ((start and entry.completed_at < start) or
+                                       (end and entry.completed_at > end)):
+                continue
+            yield entry
+
+    def scan(self):
+        ordered = True
+        previous = ''
+        for entry in self.entries():
+            self.rows += 1
+            if entry.receipt < previous:
+                ordered = False
+            previous = entry.receipt
+            if entry.completed_at:
+                if self.period_start is None or entry.completed_at < self.period_start:
+                    self.period_start = entry.completed_at
+                if self.period_end is None or entry.completed_at > self.period_end:
+                    self.period_end = entry.completed_at
+
+        if not ordered:
+            self._spill_runs()
+
+    def _spill_runs(self):
+        self._tmpdir = tempfile.mkdtemp(prefix='bytebill-recon-')
+        chunk = []
+        for entry in self.entries():
+            chunk.append(entry)
+            if len(chunk) >= self.chunk_size:
+                self._write_run(chunk)
+                chunk = []
+        if chunk:
+            self._write_run(chunk)
+        logger.info(f"Statement not ordered by receipt; merged {len(self._runs)} sorted run(s)")
+
+    def _write_run(self, chunk: List[StatementEntry]):
+        chunk.sort(key=lambda entry: (entry.receipt, entry.line))
+        path = os.path.join(self._tmpdir, f"run-{len(self._runs):05d}.csv")
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            for entry in chunk:
+                writer.writerow([entry.receipt, entry.completed_at.isoformat() if entry.completed_at else '',
+                                 str(entry.amount), entry.line])
+        self._runs.append(path)
+
+    @staticmethod
+    def _read_run(path: str) -> Iterator[StatementEntry]:
+        with open(path, newline='') as f:
+            for receipt, completed_at, amount, line in csv.reader(f):
+                yield StatementEntry(
+                    receipt,
+                    datetime.fromisoformat(completed_at) if completed_at else None,
+                    Decimal(amount),
+                    int(line)
+                )
+
+    def __iter__(self) -> Iterator[StatementEntry]:
+        if not self._runs:
+            return self.entries()
+        return heapq.merge(*(self._read_run(path) for path in self._runs),
+                           key=lambda entry: (entry.receipt, entry.line))
+
+    def cleanup(self):
+        for path in self._runs:
+            os.remove(path)
+        if self._tmpdir:
+            os.rmdir(self._tmpdir)
+        self._runs = []
+
+def in_period(period_start: Optional[datetime], period_end: Optional[datetime]):
+    """Period filter on the transaction date, or the creation time of transactions without one"""
+    dated = [MpesaTransaction.transaction_date.isnot(None)]
+    undated = [MpesaTransaction.transaction_date.is_(None)]
+    if period_start:
+        dated.append(MpesaTransaction.transaction_date >= period_start)
+        undated.append(MpesaTransaction.created_at >= period_start - LOCAL_TIME_OFFSET)
+    if period_end:
+        dated.append(MpesaTransaction.transaction_date <= period_end)
+        undated.append(MpesaTransaction.created_at <= period_end - LOCAL_TIME_OFFSET)
+    return or_(and_(*dated), and_(*undated))
+
+def ledger_query():
+    return db.session.query(
+        MpesaTransaction.mpesa_receipt_number,
+        MpesaTransaction.amount,
+        Session.amount_paid,
+        MpesaTransaction.transaction_date,
+        MpesaTransaction.checkout_request_id,
+        MpesaTransaction.created_at
+    ).outerjoin(
+        Session, Session.id == MpesaTransaction.session_id
+    ).filter(
+        MpesaTransaction.status == TransactionStatus.COMPLETED
+    )
+
+def stream_ledger(period_start: Optional[datetime], period_end: Optional[datetime],
+                  batch_size: int = 2000) -> Iterator[LedgerEntry]:
+    """Stream completed M-PESA transactions ordered by receipt with a server-side cursor"""
+    query = ledger_query().filter(
+        MpesaTransaction.mpesa_receipt_number.isnot(None),
+        in_period(period_start, period_end)
+    )
+
+    for receipt, amount, session_amount, transaction_date, checkout_request_id, _ in \
+            query.order_by(MpesaTransaction.mpesa_receipt_number).yield_per(batch_size):
+        yield LedgerEntry(normalize_receipt(receipt), amount, session_amount, transaction_date, checkout_request_id)
+
+def receiptless_ledger(period_start: Optional[datetime], period_end: Optional[datetime]) -> Dict[Decimal, List[LedgerEntry]]:
+    """Completed transactions without a receipt by amount, dated by their creation in local time.
+
+    These are payments the poller settled whose callback never came; there
+    are few of them, so they are held in memory and matched on amount and time.
+    """
+    query = ledger_query().filter(
+        MpesaTransaction.mpesa_receipt_number.is_(None),
+        in_period(period_start, period_end)
+    )
+
+    by_amount = {}
+    for _, amount, session_amount, transaction_date, checkout_request_id, created_at in query:
+        local_time = transaction_date or (created_at + LOCAL_TIME_OFFSET if created_at else None)
+        by_amount.setdefault(amount, []).append(
+            LedgerEntry('', amount, session_amount, local_time, checkout_request_id))
+    return by_amount
+
+def take_receiptless(by_amount: Dict[Decimal, List[LedgerEntry]], stmt: StatementEntry) -> Optional[LedgerEntry]:
+    """Remove and return the receiptless transaction closest in time to a statement row"""
+    candidates = [entry for entry in by_amount.get(stmt.amount, []) if entry.transaction_date and stmt.completed_at
+                  and abs(entry.transaction_date - stmt.completed_at) <= RECEIPTLESS_MATCH_WINDOW]
+    if not candidates:
+        return None
+    entry = min(candidates, key=lambda entry: abs(entry.transaction_date - stmt.completed_at))
+    by_amount[stmt.amount].remove(entry)
+    return entry
+
+def grouped(entries, source: str) -> Iterator[Tuple[str, list]]:
+    """Group consecutive entries by receipt, failing loudly if the input is not ordered"""
+    previous = None
+    for receipt, group in itertools.groupby(entries, key=lambda entry: entry.receipt):
+        if previous is not None and receipt < previous:
+            raise ReconciliationError(f"{source} is not ordered by receipt ({receipt!r} after {previous!r})")
+        previous = receipt
+        yield receipt, list(group)
+
+class StatementReconciler:
+    """Merge-joins a statement export against the database in constant memory"""
+
+    def __init__(self, statement_path: str, report_path: str, columns: Dict[str, str] = None,
+                 period_start: datetime = None, period_end: datetime = None, chunk_size: int = 50000):
+        self.statement_path = statement_path
+        self.report_path = report_path
+        self.columns = columns
+        self.period_start = period_start
+        self.period_end = period_end
+        self.chunk_size = chunk_size
+
+    def run(self) -> ReconciliationRun:
+        run = ReconciliationRun(statement_file=os.path.abspath(self.statement_path),
+                                report_file=os.path.abspath(self.report_path))
+        db.session.add(run)
+        db.session.commit()
+
+        statement = SortedStatement(self.statement_path, self.columns, self.chunk_size,
+                                    window=(self.period_start, self.period_end))
+        try:
+            statement.scan()
+            run.period_start = self.period_start or statement.period_start
+            run.period_end = self.period_end or statement.period_end
+            run.statement_rows = statement.rows
+            counts = self.merge(statement, run.period_start, run.period_end)
+
+            for name, value in counts.items():
+                setattr(run, name, value)
+            run.status = 'completed'
+        except Exception as e:
+            db.session.rollback()
+            run.status = 'failed'
+            run.error = str(e)
+            logger.error(f"Reconciliation run {run.id} failed: {e}")
+        finally:
+            statement.cleanup()
+
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+        return run
+
+    def merge(self, statement, period_start, period_end) -> Dict:
+        counts = {
+            'db_rows': 0, 'matched': 0, 'missing_in_db': 0, 'missing_in_statement': 0,
+            'duplicates': 0, 'amount_mismatches': 0,
+            'statement_total': Decimal('0'), 'db_total': Decimal('0')
+        }
+
+        with open(self.report_path, 'w', newline='') as f:
+            report = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            report.writeheader()
+
+            def record(issue, stmt=None, ledger=None):
+                report.writerow({
+                    'issue': issue,
+                    'receipt': (stmt or ledger).receipt,
+                    'statement_amount': stmt.amount if stmt else '',
+                    'db_amount': ledger.amount if ledger else '',
+                    'session_amount': ledger.session_amount if ledger and ledger.session_amount is not None else '',
+                    'statement_time': stmt.completed_at.isoformat() if stmt and stmt.completed_at else '',
+                    'db_time': ledger.transaction_date.isoformat() if ledger and ledger.transaction_date else '',
+                    'checkout_request_id': ledger.checkout_request_id if ledger else '',
+                    'statement_line': stmt.line if stmt else ''
+                })
+
+            def take_statement(group):
+                counts['statement_total'] += sum(entry.amount for entry in group)
+                for extra in group[1:]:
+                    record('duplicate_in_statement', stmt=extra)
+                    counts['duplicates'] += 1
+                return group[0]
+
+            def take_ledger(group):
+                counts['db_rows'] += len(group)
+                counts['db_total'] += sum(entry.amount for entry in group)
+                for extra in group[1:]:
+                    record('duplicate_in_db', ledger=extra)
+                    counts['duplicates'] += 1
+                return group[0]
+
+            def compare(stmt_entry, ledger_entry) -> bool:
+                if stmt_entry.amount != ledger_entry.amount:
+                    record('amount_mismatch', stmt=stmt_entry, ledger=ledger_entry)
+                    counts['amount_mismatches'] += 1
+                    return False
+                if ledger_entry.session_amount is not None and ledger_entry.session_amount != ledger_entry.amount:
+                    record('session_amount_mismatch', stmt=stmt_entry, ledger=ledger_entry)
+                    counts['amount_mismatches'] += 1
+                    return False
+                counts['matched'] += 1
+                return True
+
+            receiptless = receiptless_ledger(period_start, period_end)
+            statement_groups = grouped(iter(statement), 'Statement')
+            ledger_groups = grouped(stream_ledger(period_start, period_end), 'Database')
+            stmt = next(statement_groups, None)
+            ledger = next(ledger_groups, None)
+
+            while stmt or ledger:
+                if ledger is None or (stmt and stmt[0] < ledger[0]):
+                    stmt_entry = take_statement(stmt[1])
+                    ledger_entry = take_receiptless(receiptless, stmt_entry)
+                    if ledger_entry:
+                        take_ledger([ledger_entry])
+                        if compare(stmt_entry, ledger_entry):
+                            # Reported so the pairing can be checked by hand
+                            record('matched_without_receipt', stmt=stmt_entry, ledger=ledger_entry)
+                    else:
+                        record('missing_in_db', stmt=stmt_entry)
+                        counts['missing_in_db'] += 1
+                    stmt = next(statement_groups, None)
+                elif stmt is None or ledger[0] < stmt[0]:
+                    record('missing_in_statement', ledger=take_ledger(ledger[1]))
+                    counts['missing_in_statement'] += 1
+                    ledger = next(ledger_groups, None)
+                else:
+                    compare(take_statement(stmt[1]), take_ledger(ledger[1]))
+                    stmt = next(statement_groups, None)
+                    ledger = next(ledger_groups, None)
+
+            for entries in receiptless.values():
+                for ledger_entry in entries:
+                    record('missing_in_statement', ledger=take_ledger([ledger_entry]))
+                    counts['missing_in_statement'] += 1
+
+        return counts
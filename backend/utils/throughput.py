@@ -0,0 +1,217 @@
+import time
+import logging
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('rx_bytes', 'rx_packets', 'rx_errors', 'rx_drops',
+          'tx_bytes', 'tx_packets', 'tx_errors', 'tx_drops')
+# Position of each field among the counters after "iface:" in /proc/net/dev
+COLUMNS = (0, 1, 2, 3, 8, 9, 10, 11)
+
+def read_net_dev(path: str = '/proc/net/dev') -> Dict[str, Tuple[int, ...]]:
+    """Counters of every interface, in FIELDS order, from one read"""
+    with open(path) as f:
+        lines = f.read().splitlines()[2:]
+    counters = {}
+    for line in lines:
+        name, _, values = line.partition(':')
+        values = values.split()
+        counters[name.strip()] = tuple(int(values[column]) for column in COLUMNS)
+    return counters
+
+class RingBuffer:
+    """Fixed-size circular buffer over a typed array; appends never allocate"""
+
+    def __init__(self, size: int, typecode: str = 'd'):
+        self.size = size
+        self.data = array(typecode, [0]) * size
+        self.index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def last(self, n: int) -> array:
+        """The newest `n` values, oldest first"""
+        n = min(n, self.count)
+        start = self.index - n
+        if start >= 0:
+            return self.data[start:self.index]
+        return self.data[start:] + self.data[:self.index]
+
+    def get(self, age: int):
+        """The value appended `age` appends before the newest"""
+        return self.data[(self.index - 1 - age) % self.size]
+
+class InterfaceSeries:
+    """Running counter totals of one interface per sample.
+
+    Totals accumulate deltas rather than copying the kernel's counters, so
+    a device reset does not show up as a negative rate, and the average over
+    any window is two lookups instead of a sum.
+    """
+
+    def __init__(self, size: int):
+        self.times = RingBuffer(size + 1, 'd')
+        self.totals = {field: RingBuffer(size + 1, 'Q') for field in FIELDS}
+        # Per-sample rates, kept so peaks are a max() over an array
+        self.bps = {'rx': RingBuffer(size, 'd'), 'tx': RingBuffer(size, 'd')}
+        self.counters = None
+
+    def add(self, counters: Tuple[int, ...], timestamp: float):
+        if self.counters is None:
+            deltas = (0,) * len(FIELDS)
+        elif any(now < before for now, before in zip(counters, self.counters)):
+            # A counter going backwards means the device was reset or recreated
+            deltas = (0,) * len(FIELDS)
+        else:
+            deltas = tuple(now - before for now, before in zip(counters, self.counters))
+
+        if self.times.count:
+            elapsed = timestamp - self.times.get(0)
+            for direction, buffer in self.bps.items():
+                buffer.append(deltas[FIELDS.index(f'{direction}_bytes')] * 8 / elapsed if elapsed > 0 else 0.0)
+            for field, delta in zip(FIELDS, deltas):
+                self.totals[field].append(self.totals[field].get(0) + delta)
+        else:
+            for field in FIELDS:
+                self.totals[field].append(0)
+        self.times.append(timestamp)
+        self.counters = counters
+
+    def rate(self, newer: int, older: int) -> Optional[Dict[str, float]]:
+        """Average rates between two samples, given as ages, with error and drop counts"""
+        seconds = self.times.get(newer) - self.times.get(older)
+        if seconds <= 0:
+            return None
+        totals = {field: buffer.get(newer) - buffer.get(older) for field, buffer in self.totals.items()}
+        return {
+            'rx_bps': totals['rx_bytes'] * 8 / seconds,
+            'tx_bps': totals['tx_bytes'] * 8 / seconds,
+            'rx_pps': totals['rx_packets'] / seconds,
+            'tx_pps': totals['tx_packets'] / seconds,
+            'errors': totals['rx_errors'] + totals['tx_errors'],
+            'drops': totals['rx_drops'] + totals['tx_drops']
+        }
+
+    def window(self, samples: int) -> Optional[Dict[str, float]]:
+        """Average rates over the newest `samples` samples"""
+        samples = min(samples, self.times.count - 1)
+        if samples < 1:
+            return None
+        return self.rate(0, samples)
+
+    def peak(self) -> Dict[str, float]:
+        """Highest single-sample rates still in the buffer"""
+        return {f'{direction}_bps': max(buffer.last(buffer.size), default=0.0)
+                for direction, buffer in self.bps.items()}
+
+    def sparkline(self, samples: int, points: int) -> Dict[str, List[float]]:
+        """rx/tx bps over the newest `samples` samples, averaged into at most `points` buckets"""
+        samples = min(samples, self.times.count - 1)
+        ages = sorted({round(samples * (points - i) / points) for i in range(points + 1)}, reverse=True)
+        line = {'rx_bps': [], 'tx_bps': []}
+        for older, newer in zip(ages, ages[1:]):
+            rate = self.rate(newer, older) or {'rx_bps': 0.0, 'tx_bps': 0.0}
+            line['rx_bps'].append(round(rate['rx_bps'], 1))
+            line['tx_bps'].append(round(rate['tx_bps'], 1))
+        return line
+
+class ThroughputSampler:
+    """Per-second throughput of every interface from /proc/net/dev.
+
+    One read of /proc/net/dev per tick covers all interfaces; the deltas go
+    into ring buffers holding `THROUGHPUT_HISTORY` seconds, so rates,
+    averages and sparklines are computed from memory without touching the
+    kernel per request. It is cheap enough that every worker runs its own.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.interval = Config.THROUGHPUT_SAMPLE_INTERVAL
+        self.size = int(Config.THROUGHPUT_HISTORY / self.interval)
+        self.series: Dict[str, InterfaceSeries] = {}
+        self.sampled_at = None
+        self.windows = {'avg_1m': 60, 'avg_5m': 300, 'avg_1h': 3600}
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        counters = read_net_dev()
+        now = time.monotonic()
+        with self._lock:
+            for interface, values in counters.items():
+                series = self.series.get(interface)
+                if series is None:
+                    series = self.series[interface] = InterfaceSeries(self.size)
+                series.add(values, now)
+            self.sampled_at = time.time()
+
+    def samples(self, seconds: float) -> int:
+        return max(1, int(round(seconds / self.interval)))
+
+    def counters(self, interface: str) -> Optional[Dict[str, int]]:
+        """Cumulative counters of the last sample"""
+        with self._lock:
+            series = self.series.get(interface)
+            if series is None or series.counters is None:
+                return None
+            return dict(zip(FIELDS, series.counters))
+
+    def peak(self, interface: str, seconds: float) -> Optional[Dict[str, float]]:
+        """Highest one-sample rx/tx bps over the last `seconds`"""
+        with self._lock:
+            series = self.series.get(interface)
+            if series is None or not series.bps['rx'].count:
+                return None
+            samples = self.samples(seconds)
+            return {f'{direction}_bps': max(buffer.last(samples)) for direction, buffer in series.bps.items()}
+
+    def rates(self, interface: str, sparkline_seconds: int = 300, sparkline_points: int = 60) -> Optional[Dict]:
+        """Current and peak bps, window averages and a sparkline for an interface"""
+        with self._lock:
+            series = self.series.get(interface)
+            if series is None or series.times.count < 2:
+                return None
+            rates = {'current': series.window(1), 'peak': series.peak()}
+            for name, seconds in self.windows.items():
+                rates[name] = series.window(self.samples(seconds))
+            rates['sparkline'] = series.sparkline(self.samples(sparkline_seconds), sparkline_points)
+            return rates
+
+    def run(self):
+        """Sample every `THROUGHPUT_SAMPLE_INTERVAL` seconds on a fixed grid"""
+        next_tick = time.monotonic()
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Throughput sampling failed: {e}")
+            next_tick += self.interval
+            # Skip ticks missed while suspended rather than sampling in a burst
+            next_tick = max(next_tick, time.monotonic())
+            if self._stop.wait(next_tick - time.monotonic()):
+                break
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='throughput-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+def init_throughput_sampler(app):
+    """Start per-second interface sampling for this app"""
+    if Config.THROUGHPUT_SAMPLER_ENABLED:
+        sampler = ThroughputSampler(app)
+        sampler.start()
+        app.extensions['throughput_sampler'] = sampler
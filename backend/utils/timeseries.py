@@ -0,0 +1,307 @@
+import os
+import re
+import mmap
+import time
+import struct
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BBTS'
+VERSION = 1
+# magic, version, record size, record count
+HEADER = struct.Struct('<4sHHQ')
+# timestamp, min, max, sum, count; a raw sample is a record with count 1
+RECORD = struct.Struct('<I3dI')
+TIMESTAMP = struct.Struct('<I')
+
+# (tier, bucket seconds); each tier is downsampled from the one before it
+TIERS = (('raw', 0), ('minute', 60), ('hour', 3600))
+# Span of one segment file per tier
+SEGMENT_SECONDS = {'raw': 86400, 'minute': 30 * 86400, 'hour': 365 * 86400}
+INITIAL_CAPACITY = 1024
+
+Record = Tuple[int, float, float, float, int]
+
+class Segment:
+    """One memory-mapped file of fixed-width records in timestamp order.
+
+    A single writer appends records and then bumps the count in the header,
+    so a reader mapping the file at any moment sees a consistent prefix. The
+    file doubles in size when full.
+    """
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        if writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, HEADER.size + INITIAL_CAPACITY * RECORD.size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, VERSION, RECORD.size, 0), 0)
+                self.map = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+        else:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, _ = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.map.close()
+            raise ValueError(f"{path} is not a version {VERSION} metrics segment")
+
+    @property
+    def capacity(self) -> int:
+        return (len(self.map) - HEADER.size) // RECORD.size
+
+    def __len__(self) -> int:
+        # A reader may have mapped the file before the writer grew it
+        return min(HEADER.unpack_from(self.map)[3], self.capacity)
+
+    def timestamp(self, index: int) -> int:
+        return TIMESTAMP.unpack_from(self.map, HEADER.size + index * RECORD.size)[0]
+
+    def last_timestamp(self) -> Optional[int]:
+        count = len(self)
+        return self.timestamp(count - 1) if count else None
+
+    def bisect(self, timestamp: int) -> int:
+        """Index of the first record at or after `timestamp`"""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, start: int, end: int) -> List[Record]:
+        """Records with start <= timestamp < end"""
+        first, last = self.bisect(start), self.bisect(end)
+        return list(RECORD.iter_unpack(self.map[HEADER.size + first * RECORD.size:HEADER.size + last * RECORD.size]))
+
+    def append(self, record: Record):
+        count = len(self)
+        if count == self.capacity:
+            self.grow()
+        RECORD.pack_into(self.map, HEADER.size + count * RECORD.size, *record)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, count + 1)
+
+    def grow(self):
+        size = HEADER.size + self.capacity * 2 * RECORD.size
+        self.map.close()
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.map.close()
+
+class TimeSeriesStore:
+    """Embedded store for ISP metrics: one directory per tier and series,
+    one segment file per `SEGMENT_SECONDS` span.
+
+    Samples go to the raw tier and are rolled up into minute and hour
+    buckets (min, max, sum, count) as they arrive; a bucket is written when
+    the first sample of the next one shows up. Old segments are dropped
+    per tier after `METRICS_RETENTION`. Queries pick the finest tier that
+    still covers the range within `max_points`, and read only the segments
+    the range overlaps, each with a binary search.
+
+    Only one process may write; readers can be anywhere.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or Config.METRICS_DIR
+        self.retention = Config.METRICS_RETENTION
+        # (tier, series) -> (segment start, open segment), for the writer
+        self._segments = {}
+        # (tier, series) -> [bucket start, min, max, sum, count] of the bucket being filled
+        self._buckets = {}
+
+    def series_directory(self, tier: str, series: str) -> str:
+        return os.path.join(self.directory, tier, re.sub(r'[^A-Za-z0-9_.-]', '_', series))
+
+    def segment_path(self, tier: str, series: str, segment_start: int) -> str:
+        return os.path.join(self.series_directory(tier, series), f"{segment_start}.seg")
+
+    def segment_start(self, tier: str, timestamp: int) -> int:
+        return timestamp - timestamp % SEGMENT_SECONDS[tier]
+
+    def writer_segment(self, tier: str, series: str, timestamp: int) -> Segment:
+        start = self.segment_start(tier, timestamp)
+        current = self._segments.get((tier, series))
+        if current and current[0] == start:
+            return current[1]
+        if current:
+            current[1].close()
+        os.makedirs(self.series_directory(tier, series), exist_ok=True)
+        segment = Segment(self.segment_path(tier, series, start), writable=True)
+        self._segments[(tier, series)] = (start, segment)
+        self.prune(tier, series, timestamp)
+        return segment
+
+    def prune(self, tier: str, series: str, now: int):
+        """Delete segments that ended before the tier's retention window"""
+        directory = self.series_directory(tier, series)
+        for name in os.listdir(directory):
+            if not name.endswith('.seg'):
+                continue
+            segment_start = int(name[:-4])
+            if segment_start + SEGMENT_SECONDS[tier] < now - self.retention[tier]:
+                os.remove(os.path.join(directory, name))
+                logger.debug(f"Dropped expired {tier} segment {name} of {series}")
+
+    def read_segments(self, tier: str, series: str, start: int, end: int) -> List[Segment]:
+        segments = []
+        # Nothing older than the retention window is kept
+        start = max(start, int(time.time()) - self.retention[tier] - SEGMENT_SECONDS[tier])
+        segment_start = self.segment_start(tier, start)
+        while segment_start < end:
+            path = self.segment_path(tier, series, segment_start)
+            try:
+                segments.append(Segment(path))
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                # Being created by the writer right now, or not a segment at all
+                logger.debug(f"Skipping {path}: {e}")
+            segment_start += SEGMENT_SECONDS[tier]
+        return segments
+
+    def records(self, tier: str, series: str, start: int, end: int) -> List[Record]:
+        records = []
+        for segment in self.read_segments(tier, series, start, end):
+            try:
+                records += segment.range(start, end)
+            finally:
+                segment.close()
+        return records
+
+    def last_timestamp(self, series: str, tier: str = 'raw') -> Optional[int]:
+        """Timestamp of the newest record of a series in a tier"""
+        directory = self.series_directory(tier, series)
+        try:
+            names = sorted((name for name in os.listdir(directory) if name.endswith('.seg')),
+                           key=lambda name: int(name[:-4]))
+        except FileNotFoundError:
+            return None
+        for name in reversed(names):
+            segment = Segment(os.path.join(directory, name))
+            try:
+                timestamp = segment.last_timestamp()
+            finally:
+                segment.close()
+            if timestamp is not None:
+                return timestamp
+        return None
+
+    def bucket(self, level: int, series: str, bucket_start: int) -> list:
+        """The bucket being filled in a tier, recovered on first use"""
+        key = (TIERS[level][0], series)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = self.recover(level, series, bucket_start)
+        return bucket
+
+    def recover(self, level: int, series: str, bucket_start: int) -> list:
+        """Write the buckets a previous writer left unflushed, then rebuild the current one,
+        both from the tier below"""
+        tier, width = TIERS[level]
+        lower = TIERS[level - 1][0]
+        last = self.last_timestamp(series, tier)
+        since = last + width if last is not None else bucket_start - SEGMENT_SECONDS[lower]
+
+        pending = None
+        for record in self.records(lower, series, since, bucket_start):
+            start = record[0] - record[0] % width
+            if pending and pending[0] != start:
+                self.roll(level, series, tuple(pending))
+                pending = None
+            if pending is None:
+                pending = empty_bucket(start)
+            merge(pending, record)
+        if pending:
+            self.roll(level, series, tuple(pending))
+
+        bucket = empty_bucket(bucket_start)
+        for record in self.records(lower, series, bucket_start, bucket_start + width):
+            merge(bucket, record)
+        return bucket
+
+    def roll(self, level: int, series: str, record: Record):
+        """Write a record to a tier and fold it into the next tier's bucket"""
+        tier = TIERS[level][0]
+        upper = level + 1 < len(TIERS)
+        if upper:
+            width = TIERS[level + 1][1]
+            bucket_start = record[0] - record[0] % width
+            # Loaded before the write so a rebuilt bucket does not count this record twice
+            bucket = self.bucket(level + 1, series, bucket_start)
+
+        self.writer_segment(tier, series, record[0]).append(record)
+
+        if upper:
+            if bucket[0] != bucket_start:
+                if bucket[4]:
+                    self.roll(level + 1, series, tuple(bucket))
+                bucket[:] = empty_bucket(bucket_start)
+            merge(bucket, record)
+
+    def append(self, series: str, value: float, timestamp: Optional[float] = None) -> bool:
+        """Record a sample; returns False for one not newer than the last of its series"""
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        last = self.writer_segment('raw', series, timestamp).last_timestamp()
+        if last is None:
+            # A fresh segment; the last sample may be in the previous one
+            last = self.last_timestamp(series)
+        if last is not None and timestamp <= last:
+            return False
+        value = float(value)
+        self.roll(0, series, (timestamp, value, value, value, 1))
+        return True
+
+    def choose_tier(self, start: int, end: int, max_points: int) -> str:
+        now = time.time()
+        for tier, width in TIERS:
+            resolution = width or Config.ISP_SAMPLE_INTERVAL
+            if start >= now - self.retention[tier] and (end - start) / resolution <= max_points:
+                return tier
+        return TIERS[-1][0]
+
+    def query(self, series: str, start: float, end: float, tier: Optional[str] = None,
+              max_points: int = 500) -> Dict:
+        """Points of a series in [start, end) as columns of timestamp, min, max and average"""
+        start, end = int(start), int(end)
+        tier = tier or self.choose_tier(start, end, max_points)
+        records = self.records(tier, series, start, end)
+        return {
+            'series': series,
+            'tier': tier,
+            't': [record[0] for record in records],
+            'min': [record[1] for record in records],
+            'max': [record[2] for record in records],
+            'avg': [record[3] / record[4] for record in records]
+        }
+
+    def close(self):
+        for _, segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+def empty_bucket(bucket_start: int) -> list:
+    return [bucket_start, float('inf'), float('-inf'), 0.0, 0]
+
+def merge(bucket: list, record: Record):
+    bucket[1] = min(bucket[1], record[1])
+    bucket[2] = max(bucket[2], record[2])
+    bucket[3] += record[3]
+    bucket[4] += record[4]
@@ -0,0 +1,77 @@
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+from config import Config
+from models.plan import PlanType
+from models.session import Session, SessionStatus
+from utils.router import RouterManager
+
+logger = logging.getLogger(__name__)
+
+def traffic_class(session: Session) -> str:
+    """heavy, premium or standard.
+
+    Heavy users go first so the FUP-capped link is protected even from
+    premium plans that download a lot.
+    """
+    plan = session.plan
+    if (session.bytes_downloaded or 0) >= Config.WAN_POLICY_HEAVY_BYTES:
+        return 'heavy'
+    if plan and (plan.type == PlanType.UNLIMITED or plan.data_limit is None
+                 or plan.data_limit > Config.WAN_POLICY_LARGE_PLAN_BYTES):
+        return 'heavy'
+    if plan and (plan.download_kbps or 0) >= Config.WAN_POLICY_PREMIUM_KBPS:
+        return 'premium'
+    return 'standard'
+
+class WanPolicy:
+    """Assigns each session's new connections to a WAN by traffic class.
+
+    Assignments become membership of the per-WAN pin sets, so moving a
+    client between WANs never rewrites a rule.
+    """
+
+    def __init__(self, router: Optional[RouterManager] = None):
+        self.router = router or RouterManager()
+        self.wans = {name: wan['interface'] for name, wan in self.router.wans.items()}
+        self._fastest = None
+
+    def fastest_wan(self) -> str:
+        if self._fastest is None:
+            weights = self.router.balance_weights()
+            self._fastest = max(weights, key=weights.get)
+        return self._fastest
+
+    def target(self, session: Session) -> Optional[str]:
+        """WAN interface the session is pinned to, or None to leave it to the balancer"""
+        wan = Config.WAN_POLICY_CLASSES.get(traffic_class(session))
+        if wan == 'fastest':
+            return self.fastest_wan()
+        return self.wans.get(wan)
+
+    def assignments(self, sessions: Iterable[Session]) -> List[Tuple[str, Optional[str], int]]:
+        """(ip, WAN interface or None, seconds left) for active sessions"""
+        return [(s.ip_address, self.target(s), s.time_remaining)
+                for s in sessions if s.status == SessionStatus.ACTIVE]
+
+def pin_sessions(sessions: Iterable[Session]) -> bool:
+    """Pin newly activated sessions to their WAN"""
+    if not Config.WAN_POLICY_ENABLED:
+        return True
+    policy = WanPolicy()
+    if not policy.router.marking_enabled:
+        return True
+    assignments = policy.assignments(sessions)
+    if not assignments:
+        return True
+    return policy.router.pin_clients(assignments)
+
+def unpin_sessions(sessions: Iterable[Session]) -> bool:
+    """Drop ended sessions from the pin sets"""
+    if not Config.WAN_POLICY_ENABLED:
+        return True
+    router = RouterManager()
+    assignments = [(s.ip_address, None, 0) for s in sessions]
+    if not assignments or not router.marking_enabled:
+        return True
+    return router.pin_clients(assignments)
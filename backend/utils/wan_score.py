@@ -0,0 +1,174 @@
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+def ewma(average: Optional[float], value: float) -> float:
+    return value if average is None else average + Config.WAN_SCORE_ALPHA * (value - average)
+
+class WanHealth:
+    """Smoothed health of one WAN, with hysteresis on whether it carries traffic.
+
+    Latency, jitter and loss are EWMAs over probe rounds, so one bad round
+    moves the score a little instead of replacing it. A WAN is taken out of
+    service after `WAN_DOWN_ROUNDS` failed rounds in a row or when its score
+    drops below `WAN_SCORE_DOWN`. It only comes back after `WAN_UP_ROUNDS`
+    good rounds with a score of at least `WAN_SCORE_UP`, and not before
+    `WAN_HOLD_DOWN` seconds have passed since it went out.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # (timestamp, online, latency, jitter, loss) of recent rounds
+        self.samples = deque(maxlen=Config.WAN_SCORE_HISTORY)
+        self.latency = None
+        self.jitter = None
+        self.loss = None
+        self.failures = 0
+        self.successes = 0
+        # None until the first round
+        self.up = None
+        self.changed_at = None
+        self.flaps = 0
+        self.transitions = deque(maxlen=Config.WAN_SCORE_HISTORY)
+
+    def observe(self, timestamp: float, result: Dict) -> bool:
+        """Fold in one probe round; returns whether the WAN went in or out of service"""
+        online = result['online']
+        latency = result['latency'] if online else None
+        self.samples.append((timestamp, online, latency, result.get('jitter'), result['packet_loss']))
+
+        self.loss = ewma(self.loss, result['packet_loss'])
+        # A failed round has no latency; its loss already counts against the score
+        if latency is not None:
+            self.latency = ewma(self.latency, latency)
+        if online and result.get('jitter') is not None:
+            self.jitter = ewma(self.jitter, result['jitter'])
+        self.failures = 0 if online else self.failures + 1
+        self.successes = self.successes + 1 if online else 0
+
+        score = self.score()
+        if self.up is None:
+            self.up, self.changed_at = online, timestamp
+            return False
+        if self.up and (self.failures >= Config.WAN_DOWN_ROUNDS or score < Config.WAN_SCORE_DOWN):
+            reason = f"{self.failures} failed rounds" if self.failures >= Config.WAN_DOWN_ROUNDS else f"score {score:.1f}"
+            self.change(False, timestamp, reason)
+            return True
+        if (not self.up and self.successes >= Config.WAN_UP_ROUNDS and score >= Config.WAN_SCORE_UP
+                and timestamp - self.changed_at >= Config.WAN_HOLD_DOWN):
+            self.change(True, timestamp, f"score {score:.1f}")
+            return True
+        return False
+
+    def take_down(self, timestamp: float, reason: str) -> bool:
+        """Out of service now, e.g. on carrier loss; recovery still needs good rounds"""
+        self.successes = 0
+        if self.up is False:
+            return False
+        self.change(False, timestamp, reason)
+        return True
+
+    def change(self, up: bool, timestamp: float, reason: str):
+        logger.warning(f"{self.name} {'back in service' if up else 'taken out of service'} ({reason})")
+        self.up, self.changed_at = up, timestamp
+        self.flaps += 1
+        self.transitions.append(timestamp)
+
+    def score(self) -> float:
+        """0-100 from smoothed latency and loss, less a penalty for jitter"""
+        if self.latency is None:
+            return 0.0
+        latency_score = max(0, 100 - (self.latency / 2))  # 200ms = 0 points
+        packet_loss_score = max(0, 100 - (self.loss * 2))  # 50% loss = 0 points
+        jitter_penalty = min(Config.WAN_SCORE_JITTER_CAP, (self.jitter or 0) * Config.WAN_SCORE_JITTER_WEIGHT)
+        return max(0.0, (latency_score * 0.6) + (packet_loss_score * 0.4) - jitter_penalty)
+
+    def recent_flaps(self, now: float) -> int:
+        return sum(1 for timestamp in self.transitions if timestamp > now - Config.WAN_FLAP_WINDOW)
+
+    def state(self, now: float) -> Dict:
+        return {
+            'in_service': bool(self.up),
+            'score': round(self.score(), 2),
+            'latency_ms': self.latency,
+            'jitter_ms': self.jitter,
+            'packet_loss': self.loss,
+            'failed_rounds': self.failures,
+            'changed_at': self.changed_at,
+            'flaps': self.flaps,
+            'recent_flaps': self.recent_flaps(now)
+        }
+
+class WanScoreboard:
+    """Health of every WAN and which of the ones in service is preferred.
+
+    The preference only moves when another WAN scores at least
+    `WAN_PREFERENCE_MARGIN` better for `WAN_PREFERENCE_SUSTAIN` seconds, or
+    when the preferred WAN goes out of service.
+    """
+
+    def __init__(self, names: List[str]):
+        self.wans = {name: WanHealth(name) for name in names}
+        self.preferred = None
+        self.switches = 0
+        # (challenger, since) while another WAN is scoring better
+        self._challenger = None
+
+    def __getitem__(self, name: str) -> WanHealth:
+        return self.wans[name]
+
+    def observe(self, timestamp: float, results: Dict[str, Dict]) -> bool:
+        """Fold in one probe round of every WAN; returns whether any went in or out of service"""
+        changed = False
+        for name, result in results.items():
+            changed = self.wans[name].observe(timestamp, result) or changed
+        self.update_preferred(timestamp)
+        return changed
+
+    def take_down(self, name: str, timestamp: float, reason: str) -> bool:
+        changed = self.wans[name].take_down(timestamp, reason)
+        self.update_preferred(timestamp)
+        return changed
+
+    def in_service(self) -> List[str]:
+        return [name for name, health in self.wans.items() if health.up]
+
+    def update_preferred(self, now: float):
+        usable = self.in_service()
+        if not usable:
+            self._challenger = None
+            return
+        best = max(usable, key=lambda name: self.wans[name].score())
+        if self.preferred not in usable:
+            self.prefer(best)
+            return
+        margin = self.wans[best].score() - self.wans[self.preferred].score()
+        if best == self.preferred or margin < Config.WAN_PREFERENCE_MARGIN:
+            self._challenger = None
+        elif self._challenger is None or self._challenger[0] != best:
+            self._challenger = (best, now)
+        elif now - self._challenger[1] >= Config.WAN_PREFERENCE_SUSTAIN:
+            self.prefer(best)
+
+    def prefer(self, name: str):
+        if self.preferred is not None:
+            logger.info(f"Preferred WAN is now {name} (was {self.preferred})")
+            self.switches += 1
+        self.preferred = name
+        self._challenger = None
+
+    def flaps(self) -> int:
+        """Times any WAN went in or out of service"""
+        return sum(health.flaps for health in self.wans.values())
+
+    def state(self, now: float) -> Dict:
+        return {
+            'preferred': self.preferred,
+            'preference_switches': self.switches,
+            'flaps': self.flaps(),
+            'wans': {name: health.state(now) for name, health in self.wans.items()}
+        }
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+ByteBill Firewall Backend Benchmark
+Compares ruleset load time and per-packet forwarding cost of the firewall
+backends with 1,000 and 5,000 authorized clients:
+
+  iptables-rules  one ACCEPT rule per client (linear, for reference)
+  iptables-ipset  RouterManager: authorized-client ipset + iptables-restore
+  nftables        NftablesManager: own table, sets, maps and named counters
+
+Runs in three throwaway network namespaces (client -> router -> sink joined
+by veth pairs), so the host ruleset is not touched. Needs root, iproute2,
+and iptables/ipset and/or nft.
+
+Usage: sudo python bench_firewall.py [--clients 1000 5000] [--duration SECONDS]
+                                     [--backends iptables-rules iptables-ipset nftables]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.environ.get('BYTEBILL_BACKEND_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'backend'
+)
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+CLIENT_NS = 'bbf-client'
+ROUTER_NS = 'bbf-router'
+SINK_NS = 'bbf-sink'
+LAN, WAN1, WAN2 = 'lan0', 'wan0', 'wan1'
+CLIENT_IP, SINK_IP = '10.88.0.2', '10.99.0.2'
+BACKENDS = ['iptables-rules', 'iptables-ipset', 'nftables']
+REQUIRED_TOOLS = {
+    'iptables-rules': ['iptables-restore'],
+    'iptables-ipset': ['iptables-restore', 'ipset'],
+    'nftables': ['nft']
+}
+
+def sh(*command, ns=None, check=True):
+    if ns:
+        command = ('ip', 'netns', 'exec', ns) + command
+    return subprocess.run(command, capture_output=True, text=True, check=check).stdout.strip()
+
+def create_topology():
+    destroy_topology()
+    for ns in (CLIENT_NS, ROUTER_NS, SINK_NS):
+        sh('ip', 'netns', 'add', ns)
+        sh('ip', 'link', 'set', 'lo', 'up', ns=ns)
+
+    sh('ip', 'link', 'add', 'veth-c', 'netns', CLIENT_NS, 'type', 'veth', 'peer', 'name', LAN, 'netns', ROUTER_NS)
+    sh('ip', 'link', 'add', 'veth-s', 'netns', SINK_NS, 'type', 'veth', 'peer', 'name', WAN1, 'netns', ROUTER_NS)
+    sh('ip', 'link', 'add', WAN2, 'type', 'dummy', ns=ROUTER_NS)
+
+    sh('ip', 'addr', 'add', f'{CLIENT_IP}/24', 'dev', 'veth-c', ns=CLIENT_NS)
+    sh('ip', 'addr', 'add', '10.88.0.1/24', 'dev', LAN, ns=ROUTER_NS)
+    sh('ip', 'addr', 'add', '10.99.0.1/24', 'dev', WAN1, ns=ROUTER_NS)
+    sh('ip', 'addr', 'add', f'{SINK_IP}/24', 'dev', 'veth-s', ns=SINK_NS)
+    for ns, dev in ((CLIENT_NS, 'veth-c'), (ROUTER_NS, LAN), (ROUTER_NS, WAN1), (ROUTER_NS, WAN2), (SINK_NS, 'veth-s')):
+        sh('ip', 'link', 'set', dev, 'up', ns=ns)
+
+    sh('ip', 'route', 'add', 'default', 'via', '10.88.0.1', ns=CLIENT_NS)
+    sh('sysctl', '-qw', 'net.ipv4.ip_forward=1', ns=ROUTER_NS)
+
+    # Static neighbours keep ARP out of the measurement
+    sink_mac = sh('cat', '/sys/class/net/veth-s/address', ns=SINK_NS)
+    router_lan_mac = sh('cat', f'/sys/class/net/{LAN}/address', ns=ROUTER_NS)
+    sh('ip', 'neigh', 'replace', SINK_IP, 'lladdr', sink_mac, 'dev', WAN1, ns=ROUTER_NS)
+    sh('ip', 'neigh', 'replace', '10.88.0.1', 'lladdr', router_lan_mac, 'dev', 'veth-c', ns=CLIENT_NS)
+    return sh('cat', '/sys/class/net/veth-c/address', ns=CLIENT_NS)
+
+def destroy_topology():
+    for ns in (CLIENT_NS, ROUTER_NS, SINK_NS):
+        sh('ip', 'netns', 'del', ns, check=False)
+
+def reset_router():
+    """Remove whatever the previous backend loaded"""
+    for command in (('iptables', '-F'), ('iptables', '-t', 'nat', '-F'), ('ipset', 'destroy'),
+                    ('nft', 'delete', 'table', 'inet', 'bytebill')):
+        if shutil.which(command[0]):
+            sh(*command, ns=ROUTER_NS, check=False)
+
+def synthetic_clients(count, client_mac, timeout=3600):
+    """count - 1 made-up clients plus the real one, added last"""
+    clients = []
+    for i in range(count - 1):
+        ip = f"10.{100 + (i >> 16)}.{(i >> 8) & 0xff}.{i & 0xff}"
+        mac = f"02:00:00:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}"
+        clients.append((ip, mac, timeout))
+    clients.append((CLIENT_IP, client_mac, timeout))
+    return clients
+
+def load(backend, count, client_mac):
+    """Runs inside the router namespace: load a backend and time it"""
+    from config import Config, wan_registry
+    Config.LAN_INTERFACE = LAN
+    # Measure the gated ruleset the authorized set is loaded for
+    Config.ACCESS_CONTROL_ENABLED = True
+    Config.WANS = wan_registry(f'{WAN1},{WAN2}', 'Sink,Dummy')
+    from utils.firewall import RuleBatch
+    from utils.nftables import NftablesManager
+    from utils.router import RouterManager
+
+    router = RouterManager()
+    router.lan_interface = LAN
+    clients = synthetic_clients(count, client_mac)
+    extra = ('10.250.0.1', '02:ff:00:00:00:01', 3600)
+
+    started = time.perf_counter()
+    if backend == 'iptables-rules':
+        batch = RuleBatch()
+        batch.append('nat', 'POSTROUTING', ['-o', WAN1, '-j', 'MASQUERADE'])
+        for ip, mac, _ in clients:
+            batch.append('filter', 'FORWARD', ['-i', LAN, '-s', ip, '-m', 'mac', '--mac-source', mac, '-j', 'ACCEPT'])
+        batch.append('filter', 'FORWARD', ['-i', LAN, '-j', 'DROP'])
+        ok = router.apply_batch(batch)
+    elif backend == 'iptables-ipset':
+        ok = router.setup_iptables() and router.replace_authorized_clients(clients)
+    else:
+        firewall = NftablesManager()
+        ok = firewall.setup() and firewall.replace_authorized_clients(clients)
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    if backend == 'iptables-rules':
+        ip, mac, _ = extra
+        router.apply_batch(RuleBatch().insert('filter', 'FORWARD', ['-i', LAN, '-s', ip, '-m', 'mac', '--mac-source', mac, '-j', 'ACCEPT']))
+    elif backend == 'iptables-ipset':
+        router.authorize_clients([extra])
+    else:
+        NftablesManager().authorize_clients([extra])
+    add_seconds = time.perf_counter() - started
+
+    print(json.dumps({'ok': bool(ok), 'load_seconds': load_seconds, 'add_seconds': add_seconds}))
+
+def blast(target, duration):
+    """Runs inside the client namespace: send small UDP datagrams as fast as possible"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = b'x' * 18
+    deadline = time.perf_counter() + duration
+    sent = 0
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            try:
+                sock.sendto(payload, (target, 9))
+                sent += 1
+            except OSError:
+                pass
+    print(json.dumps({'sent': sent}))
+
+def measure_pps(duration):
+    """Packets per second forwarded from client to sink"""
+    read = lambda: int(sh('cat', '/sys/class/net/veth-s/statistics/rx_packets', ns=SINK_NS))
+    before = read()
+    started = time.perf_counter()
+    sh(sys.executable, os.path.abspath(__file__), '--blast', SINK_IP, '--duration', str(duration), ns=CLIENT_NS)
+    elapsed = time.perf_counter() - started
+    return (read() - before) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark iptables and nftables firewall backends')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds of traffic per measurement')
+    parser.add_argument('--load', choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument('--client-mac', help=argparse.SUPPRESS)
+    parser.add_argument('--blast', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        return load(args.load, args.clients[0], args.client_mac)
+    if args.blast:
+        return blast(args.blast, args.duration)
+
+    if os.geteuid() != 0:
+        sys.exit("bench_firewall.py needs root to create network namespaces")
+    backends = [b for b in args.backends if all(shutil.which(tool) for tool in REQUIRED_TOOLS[b])]
+    for skipped in sorted(set(args.backends) - set(backends)):
+        print(f"Skipping {skipped}: {', '.join(REQUIRED_TOOLS[skipped])} not installed")
+
+    client_mac = create_topology()
+    try:
+        baseline = measure_pps(args.duration)
+        print(f"\nBaseline forwarding, no rules: {baseline:,.0f} pps\n")
+        print(f"{'backend':<16}{'clients':>8}{'load ms':>10}{'add 1 ms':>10}{'pps':>12}{'ns/pkt':>9}")
+
+        for backend in backends:
+            for count in args.clients:
+                reset_router()
+                result = json.loads(sh(sys.executable, os.path.abspath(__file__), '--load', backend,
+                                       '--clients', str(count), '--client-mac', client_mac, ns=ROUTER_NS))
+                if not result['ok']:
+                    print(f"{backend:<16}{count:>8}  failed to load ruleset")
+                    continue
+                pps = measure_pps(args.duration)
+                overhead_ns = (1 / pps - 1 / baseline) * 1e9 if pps else float('nan')
+                print(f"{backend:<16}{count:>8}{result['load_seconds'] * 1000:>10.1f}"
+                      f"{result['add_seconds'] * 1000:>10.1f}{pps:>12,.0f}{overhead_ns:>9.0f}")
+    finally:
+        destroy_topology()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+ByteBill M-PESA Callback Ingest Benchmark
+Measures how fast /api/mpesa/callback acknowledges callbacks and how fast the
+background consumer drains them into the database, including Safaricom-style
+duplicate retries.
+
+Usage: python bench_mpesa_callbacks.py [--callbacks N] [--duplicates RATIO]
+                                       [--database-uri URI] [--no-fsync]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import json
+from decimal import Decimal
+
+BACKEND_DIR = os.environ.get('BYTEBILL_BACKEND_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'backend'
+)
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+def build_callback(checkout_request_id, success=True):
+    """Build an stkCallback body like the ones Daraja sends"""
+    callback = {
+        'MerchantRequestID': f'MR-{checkout_request_id}',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': 0 if success else 1032,
+        'ResultDesc': 'The service request is processed successfully.' if success else 'Request cancelled by user'
+    }
+    if success:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 50},
+            {'Name': 'MpesaReceiptNumber', 'Value': f'R{checkout_request_id[-9:]}'},
+            {'Name': 'TransactionDate', 'Value': 20240101120000},
+            {'Name': 'PhoneNumber', 'Value': 254700000000}
+        ]}
+    return json.dumps({'Body': {'stkCallback': callback}}).encode()
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark M-PESA callback ingestion')
+    parser.add_argument('--callbacks', type=int, default=5000, help='distinct checkout requests')
+    parser.add_argument('--duplicates', type=float, default=0.3, help='fraction of callbacks retried')
+    parser.add_argument('--database-uri', default=None, help='SQLAlchemy URI (default: temporary SQLite)')
+    parser.add_argument('--no-fsync', action='store_true', help='skip fdatasync on append')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bytebill-bench-')
+    os.environ['MPESA_INBOX_DIR'] = os.path.join(workdir, 'inbox')
+
+    from config import Config
+    Config.SQLALCHEMY_DATABASE_URI = args.database_uri or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    Config.MPESA_CALLBACK_CONSUMER_ENABLED = False
+    Config.MPESA_QUERY_ENABLED = False
+    Config.MPESA_INBOX_FSYNC = not args.no_fsync
+    # Paid sessions are activated here; keep them out of the host's firewall and qdiscs
+    Config.ACCESS_CONTROL_ENABLED = Config.SHAPING_ENABLED = Config.WAN_POLICY_ENABLED = False
+
+    from app import create_app
+    from database import db
+    from models.plan import Plan, PlanType
+    from models.user import User
+    from models.session import Session, SessionStatus, PaymentMethod
+    from models.transaction import MpesaTransaction, MpesaCallback, TransactionStatus
+    from utils.payments import CallbackConsumer
+
+    app = create_app(network_workers=False)
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+
+        print(f"Seeding {args.callbacks} pending purchases...")
+        plan = Plan(name='Bench Hourly', type=PlanType.HOURLY, duration=3600, price=Decimal('50.00'))
+        db.session.add(plan)
+        db.session.flush()
+
+        checkout_ids = []
+        for i in range(args.callbacks):
+            mac = f'02:00:{i >> 24 & 0xff:02x}:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}'
+            user = User(ip_address='192.168.88.10', mac_address=mac)
+            db.session.add(user)
+            db.session.flush()
+
+            session = Session(
+                session_id=f'bench-{i}', user_id=user.id, plan_id=plan.id,
+                status=SessionStatus.PAUSED, payment_method=PaymentMethod.MPESA,
+                duration_limit=plan.duration, ip_address=user.ip_address, mac_address=mac
+            )
+            db.session.add(session)
+            db.session.flush()
+
+            checkout_id = f'ws_CO_BENCH_{i:09d}'
+            db.session.add(MpesaTransaction(
+                checkout_request_id=checkout_id, phone_number='254700000000',
+                amount=plan.price, plan_id=plan.id, session_id=session.id
+            ))
+            checkout_ids.append(checkout_id)
+        db.session.commit()
+
+    bodies = [build_callback(cid, success=random.random() > 0.1) for cid in checkout_ids]
+    bodies += random.sample(bodies, int(len(bodies) * args.duplicates))
+    random.shuffle(bodies)
+
+    # Acknowledge path
+    latencies = []
+    started = time.perf_counter()
+    for body in bodies:
+        t0 = time.perf_counter()
+        response = client.post('/api/mpesa/callback', data=body, content_type='application/json')
+        latencies.append((time.perf_counter() - t0) * 1000)
+        assert response.status_code == 200, response.data
+    ack_elapsed = time.perf_counter() - started
+
+    # Consumer path
+    with app.app_context():
+        consumer = CallbackConsumer(app, app.extensions['mpesa_inbox'])
+        started = time.perf_counter()
+        applied = consumer.drain()
+        drain_elapsed = time.perf_counter() - started
+
+        # Replaying the whole inbox must be a no-op
+        consumer.inbox.save_position(consumer.inbox.segments()[0], 0)
+        replayed = consumer.drain()
+
+        ledger = MpesaCallback.query.count()
+        completed = MpesaTransaction.query.filter_by(status=TransactionStatus.COMPLETED).count()
+        active = Session.query.filter_by(status=SessionStatus.ACTIVE).count()
+
+    print("\n=== Callback Ingest Benchmark ===")
+    print(f"Callbacks posted:   {len(bodies)} ({len(bodies) - len(checkout_ids)} duplicates)")
+    print(f"fsync per append:   {Config.MPESA_INBOX_FSYNC}")
+    print(f"Ack throughput:     {len(bodies) / ack_elapsed:,.0f} callbacks/s")
+    print(f"Ack latency:        p50 {percentile(latencies, 50):.2f} ms, "
+          f"p99 {percentile(latencies, 99):.2f} ms, max {max(latencies):.2f} ms")
+    print(f"Consumer drain:     {len(bodies) / drain_elapsed:,.0f} callbacks/s ({applied} applied)")
+    print(f"Replay applied:     {replayed} (expected 0)")
+    print(f"Ledger rows:        {ledger} (expected {len(checkout_ids)})")
+    print(f"Completed / active: {completed} / {active}")
+    print(f"Work directory:     {workdir}")
+
+if __name__ == '__main__':
+    main()
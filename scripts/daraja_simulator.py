@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+"""
+ByteBill Daraja API Simulator
+A local stand-in for Safaricom's Daraja sandbox. It implements the OAuth,
+STK Push and STK Query endpoints and delivers STK callbacks to the
+CallBackURL of each request, with configurable latency, API failures,
+cancelled payments, lost callbacks and duplicate callbacks.
+
+Point the backend at it with:
+    MPESA_API_BASE_URL=http://127.0.0.1:8089 MPESA_CONSUMER_KEY=sim \
+    MPESA_CONSUMER_SECRET=sim MPESA_SHORTCODE=174379 MPESA_PASSKEY=sim python app.py
+"""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class DarajaSimulator:
+    def __init__(self, latency_ms=50, jitter_ms=20, failure_rate=0.0, cancel_rate=0.1,
+                 callback_loss_rate=0.0, duplicate_rate=0.2, customer_delay=(1.0, 3.0), seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.cancel_rate = cancel_rate
+        self.callback_loss_rate = callback_loss_rate
+        self.duplicate_rate = duplicate_rate
+        self.customer_delay = customer_delay
+        self.random = random.Random(seed)
+
+        self.transactions = {}
+        self.tokens = set()
+        self.lock = threading.Lock()
+        self.counters = {
+            'oauth': 0, 'stk_push': 0, 'stk_query': 0, 'api_failures': 0,
+            'callbacks_sent': 0, 'callbacks_lost': 0, 'callbacks_duplicated': 0,
+            'callback_errors': 0
+        }
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def simulate_latency(self):
+        delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        time.sleep(delay)
+
+    def should_fail(self):
+        return self.random.random() < self.failure_rate
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(token)
+        self.count('oauth')
+        return {'access_token': token, 'expires_in': '3599'}
+
+    def valid_token(self, header):
+        if not header or not header.startswith('Bearer '):
+            return False
+        with self.lock:
+            return header[len('Bearer '):] in self.tokens
+
+    def stk_push(self, payload):
+        """Accept an STK Push and schedule the customer's response"""
+        required = ['BusinessShortCode', 'Password', 'Timestamp', 'Amount', 'PhoneNumber', 'CallBackURL']
+        missing = [field for field in required if not payload.get(field)]
+        if missing:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': f"Bad Request - Invalid {missing[0]}"}
+
+        checkout_request_id = f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:12]}"
+        merchant_request_id = f"{self.random.randint(10000, 99999)}-{uuid.uuid4().hex[:8]}"
+
+        with self.lock:
+            self.transactions[checkout_request_id] = {
+                'merchant_request_id': merchant_request_id,
+                'callback_url': payload['CallBackURL'],
+                'amount': payload['Amount'],
+                'phone_number': payload['PhoneNumber'],
+                'status': 'processing',
+                'requested_at': time.time(),
+                'completed_at': None,
+                'receipt': None,
+                'result_code': None
+            }
+        self.count('stk_push')
+
+        delay = self.random.uniform(*self.customer_delay)
+        threading.Timer(delay, self.complete, args=(checkout_request_id,)).start()
+
+        return 200, {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing'
+        }
+
+    def complete(self, checkout_request_id):
+        """The customer answers the prompt; deliver the callback"""
+        cancelled = self.random.random() < self.cancel_rate
+        with self.lock:
+            txn = self.transactions[checkout_request_id]
+            txn['status'] = 'cancelled' if cancelled else 'completed'
+            txn['result_code'] = 1032 if cancelled else 0
+            txn['receipt'] = None if cancelled else f"S{uuid.uuid4().hex[:9].upper()}"
+            txn['completed_at'] = time.time()
+
+        if self.random.random() < self.callback_loss_rate:
+            self.count('callbacks_lost')
+            return
+
+        self.deliver(checkout_request_id)
+        if self.random.random() < self.duplicate_rate:
+            self.count('callbacks_duplicated')
+            threading.Timer(self.random.uniform(0.1, 2.0), self.deliver, args=(checkout_request_id,)).start()
+
+    def build_callback(self, checkout_request_id):
+        with self.lock:
+            txn = dict(self.transactions[checkout_request_id])
+
+        callback = {
+            'MerchantRequestID': txn['merchant_request_id'],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': txn['result_code'],
+            'ResultDesc': ('Request cancelled by user' if txn['result_code']
+                           else 'The service request is processed successfully.')
+        }
+        if not txn['result_code']:
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': txn['amount']},
+                {'Name': 'MpesaReceiptNumber', 'Value': txn['receipt']},
+                {'Name': 'TransactionDate', 'Value': int(datetime.fromtimestamp(txn['completed_at']).strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(txn['phone_number'])}
+            ]}
+        return txn['callback_url'], {'Body': {'stkCallback': callback}}
+
+    def deliver(self, checkout_request_id):
+        url, body = self.build_callback(checkout_request_id)
+        request = urllib.request.Request(
+            url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+            self.count('callbacks_sent')
+        except Exception as e:
+            self.count('callback_errors')
+            logger.warning(f"Callback delivery for {checkout_request_id} failed: {e}")
+
+    def stk_query(self, payload):
+        checkout_request_id = payload.get('CheckoutRequestID')
+        self.count('stk_query')
+        with self.lock:
+            txn = self.transactions.get(checkout_request_id)
+            txn = dict(txn) if txn else None
+
+        if txn is None:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}
+        if txn['status'] == 'processing':
+            return 500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}
+
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': txn['merchant_request_id'],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': str(txn['result_code']),
+            'ResultDesc': ('Request cancelled by user' if txn['result_code']
+                           else 'The service request is processed successfully.')
+        }
+
+    def snapshot(self):
+        """Transactions and counters, for load-test reporting"""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'transactions': {cid: dict(txn) for cid, txn in self.transactions.items()}
+            }
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    simulator = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        sim = self.simulator
+        if self.path.startswith('/oauth/v1/generate'):
+            sim.simulate_latency()
+            if not (self.headers.get('Authorization') or '').startswith('Basic '):
+                return self.send_json(400, {'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'})
+            return self.send_json(200, sim.issue_token())
+        if self.path == '/simulator/state':
+            return self.send_json(200, sim.snapshot())
+        self.send_json(404, {'errorMessage': 'Not found'})
+
+    def do_POST(self):
+        sim = self.simulator
+        routes = {
+            '/mpesa/stkpush/v1/processrequest': sim.stk_push,
+            '/mpesa/stkpushquery/v1/query': sim.stk_query
+        }
+        handler = routes.get(self.path)
+        if handler is None:
+            return self.send_json(404, {'errorMessage': 'Not found'})
+
+        sim.simulate_latency()
+        if not sim.valid_token(self.headers.get('Authorization')):
+            return self.send_json(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+        if sim.should_fail():
+            sim.count('api_failures')
+            return self.send_json(503, {'errorCode': '503.001.01', 'errorMessage': 'Service Unavailable'})
+
+        payload = self.read_json()
+        if payload is None:
+            return self.send_json(400, {'errorCode': '400.002.01', 'errorMessage': 'Invalid JSON'})
+
+        status, body = handler(payload)
+        self.send_json(status, body)
+
+def start_simulator(host='127.0.0.1', port=8089, **options):
+    """Start a simulator in a background thread, returning (simulator, server)"""
+    simulator = DarajaSimulator(**options)
+    handler = type('BoundSimulatorHandler', (SimulatorHandler,), {'simulator': simulator})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='daraja-simulator', daemon=True).start()
+    return simulator, server
+
+def add_simulator_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=50, help='mean API latency')
+    parser.add_argument('--jitter-ms', type=float, default=20, help='API latency standard deviation')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of API calls answered with 503')
+    parser.add_argument('--cancel-rate', type=float, default=0.1, help='fraction of customers cancelling the prompt')
+    parser.add_argument('--callback-loss-rate', type=float, default=0.0, help='fraction of callbacks never delivered')
+    parser.add_argument('--duplicate-rate', type=float, default=0.2, help='fraction of callbacks delivered twice')
+    parser.add_argument('--customer-delay', type=float, nargs=2, default=[1.0, 3.0],
+                        metavar=('MIN', 'MAX'), help='seconds before the customer answers')
+    parser.add_argument('--seed', type=int, default=None)
+
+def simulator_options(args):
+    return {
+        'latency_ms': args.latency_ms,
+        'jitter_ms': args.jitter_ms,
+        'failure_rate': args.failure_rate,
+        'cancel_rate': args.cancel_rate,
+        'callback_loss_rate': args.callback_loss_rate,
+        'duplicate_rate': args.duplicate_rate,
+        'customer_delay': tuple(args.customer_delay),
+        'seed': args.seed
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Daraja API simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    simulator, server = start_simulator(args.host, args.port, **simulator_options(args))
+    logger.info(f"Daraja simulator listening on http://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
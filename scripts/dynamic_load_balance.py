@@ -2,172 +2,114 @@
 
 """
 ByteBill Dynamic Load Balancer
-This script monitors both WAN connections and dynamically switches between them
+This script monitors every WAN connection and dynamically switches between them
 based on connectivity, latency, and bandwidth availability.
 """
 
-import subprocess
 import time
 import logging
-import json
 import os
 import signal
 import sys
+import threading
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/var/log/bytebill-loadbalancer.log'),
-        logging.StreamHandler()
-    ]
+BACKEND_DIR = os.environ.get('BYTEBILL_BACKEND_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'backend'
 )
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+from config import Config
+from utils.netlink import NetlinkRouting, RTM_DELADDR, RTM_DELLINK, RTM_DELROUTE, RTM_NEWLINK
+from utils.probe_schedule import PassiveMonitor, ProbeScheduler
+from utils.prober import WanProber
+from utils.router import RouterManager
+from utils.shared_state import SharedRecord
+from utils.wan_score import WanScoreboard
+
 logger = logging.getLogger(__name__)
 
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('/var/log/bytebill-loadbalancer.log'),
+            logging.StreamHandler()
+        ]
+    )
+
 class LoadBalancer:
-    def __init__(self):
-        self.wan1_interface = 'enx1'
-        self.wan2_interface = 'enx2'
+    """Routing decisions from WAN health. The prober, netlink handle, router and
+    passive monitor can be passed in, so the decisions can be replayed against
+    recorded traces without touching the system (see simulate_load_balancer.py)."""
+    
+    def __init__(self, routing=None, router=None, prober=None, sparse_prober=None, passive=None):
+        # WAN name -> interface, from the registry in Config
+        self.wans = {name: wan['interface'] for name, wan in Config.WANS.items()}
+        self.interfaces = list(self.wans.values())
         self.lan_interface = 'eth0'
         
-        # Monitoring configuration
-        self.test_hosts = ['8.8.8.8', '1.1.1.1', '208.67.222.222']
-        self.ping_timeout = 5
-        self.ping_count = 3
-        self.check_interval = 30  # seconds
-        
-        # Failover thresholds
-        self.max_latency = 200  # ms
-        self.max_packet_loss = 30  # percentage
-        self.min_connectivity_score = 50  # percentage
-        
-        # Load balancing weights
-        self.wan1_weight = 1
-        self.wan2_weight = 1
+        # Monitoring configuration; every host on every due WAN is probed at once,
+        # with fewer echoes while a WAN is stable
+        self.prober = prober or WanProber()
+        self.sparse_prober = sparse_prober or WanProber(count=Config.PROBE_SPARSE_COUNT)
+        self.check_interval = 30  # seconds; stable WANs back off from here
+        self.schedule = ProbeScheduler(self.interfaces, self.check_interval)
+        self.passive = passive or PassiveMonitor({wan['interface']: wan['fwmark'] for wan in Config.WANS.values()})
+        
+        # Load balancing weights per interface, from the last measured capacity of each WAN
+        self.weights = {interface: 1 for interface in self.interfaces}
+        # WANs in the multipath route while load balanced
+        self.balanced = set()
+        # WANs in service when routes last changed; one that leaves loses its marked connections
+        self.serving = set()
         
         # State tracking
         self.current_primary = None
-        self.wan1_stats = {'online': False, 'latency': 0, 'packet_loss': 0}
-        self.wan2_stats = {'online': False, 'latency': 0, 'packet_loss': 0}
+        self.stats = {interface: {'online': False, 'latency': 0, 'packet_loss': 0} for interface in self.interfaces}
         
-        # History for trend analysis
-        self.history_size = 10
-        self.wan1_history = []
-        self.wan2_history = []
+        # Smoothed scores with hysteresis; routing follows the WANs in service
+        self.scoreboard = WanScoreboard(self.interfaces)
         
         self.running = True
         
-    def run_command(self, command: List[str]) -> Optional[str]:
-        """Run a command and return output"""
-        try:
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-            return result.stdout.strip() if result.returncode == 0 else None
-        except Exception as e:
-            logger.error(f"Command failed: {' '.join(command)}, Error: {e}")
-            return None
-    
-    def ping_host(self, host: str, interface: str) -> Dict:
-        """Ping a host through specific interface"""
-        try:
-            cmd = ['ping', '-c', str(self.ping_count), '-W', str(self.ping_timeout), '-I', interface, host]
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=self.ping_timeout + 5
-            )
-            
-            if result.returncode == 0:
-                lines = result.stdout.split('\n')
-                
-                # Extract packet loss
-                packet_loss = 0
-                for line in lines:
-                    if '% packet loss' in line:
-                        packet_loss = float(line.split('%')[0].split()[-1])
-                        break
-                
-                # Extract average latency
-                avg_latency = 0
-                for line in lines:
-                    if 'rtt min/avg/max/mdev' in line or 'round-trip' in line:
-                        parts = line.split('/')
-                        if len(parts) >= 5:
-                            avg_latency = float(parts[4])
-                        break
-                
-                return {
-                    'success': True,
-                    'latency': avg_latency,
-                    'packet_loss': packet_loss
-                }
-            else:
-                return {
-                    'success': False,
-                    'latency': 9999,
-                    'packet_loss': 100
-                }
-                
-        except Exception as e:
-            logger.error(f"Ping error for {host} via {interface}: {e}")
-            return {
-                'success': False,
-                'latency': 9999,
-                'packet_loss': 100
-            }
+        # Netlink handle; gateway lookups are cached until the kernel reports a change
+        self.routing = routing or NetlinkRouting()
+        
+        # Link events arrive on the netlink watcher thread; routing decisions are serialized
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.carrier = {interface: False for interface in self.interfaces}
+        # WANs whose link, address or routes changed, probed without waiting for their next round
+        self.suspects = set()
+        self.next_passive = 0.0
+        
+        # Connection marking, when BALANCE_MODE is connmark
+        self.router = router or RouterManager()
+        
+        # Live state for the API, in shared memory
+        self.state_record = None
+        
+    def test_connectivity(self, interfaces: List[str], dense: bool = True) -> Dict[str, Dict]:
+        """Test connectivity of several interfaces in one concurrent round"""
+        summaries = (self.prober if dense else self.sparse_prober).run(interfaces)
+        return {interface: {
+            'online': summary['online'],
+            'latency': summary['latency'] if summary['latency'] is not None else 9999,
+            'jitter': summary['jitter'],
+            'packet_loss': summary['packet_loss'],
+            'connectivity_score': summary['connectivity_score']
+        } for interface, summary in summaries.items()}
     
     def test_interface_connectivity(self, interface: str) -> Dict:
         """Test connectivity for an interface"""
-        results = []
-        
-        for host in self.test_hosts:
-            result = self.ping_host(host, interface)
-            results.append(result)
-        
-        # Calculate averages
-        successful_tests = [r for r in results if r['success']]
-        
-        if not successful_tests:
-            return {
-                'online': False,
-                'latency': 9999,
-                'packet_loss': 100,
-                'connectivity_score': 0
-            }
-        
-        avg_latency = sum(r['latency'] for r in successful_tests) / len(successful_tests)
-        avg_packet_loss = sum(r['packet_loss'] for r in results) / len(results)
-        connectivity_score = (len(successful_tests) / len(results)) * 100
-        
-        return {
-            'online': connectivity_score > self.min_connectivity_score,
-            'latency': avg_latency,
-            'packet_loss': avg_packet_loss,
-            'connectivity_score': connectivity_score
-        }
+        return self.test_connectivity([interface])[interface]
     
     def get_interface_gateway(self, interface: str) -> Optional[str]:
         """Get gateway for interface"""
-        result = self.run_command(['ip', 'route', 'show', 'dev', interface])
-        if result:
-            for line in result.split('\n'):
-                if 'default via' in line:
-                    parts = line.split()
-                    try:
-                        gateway_index = parts.index('via') + 1
-                        return parts[gateway_index]
-                    except (ValueError, IndexError):
-                        continue
-        return None
+        return self.routing.gateway(interface)
     
     def set_primary_route(self, interface: str) -> bool:
         """Set primary default route"""
@@ -176,157 +118,229 @@ class LoadBalancer:
             logger.error(f"No gateway found for {interface}")
             return False
         
-        # Remove existing default routes
-        self.run_command(['ip', 'route', 'del', 'default'])
-        
-        # Add new default route
-        success = self.run_command(['ip', 'route', 'add', 'default', 'via', gateway, 'dev', interface])
-        
-        if success is not None:
+        # Replace the default route in place; there is no window without one
+        if self.routing.replace_default_route(interface, gateway):
             logger.info(f"Primary route set to {interface} via {gateway}")
+            # New connections follow; established ones keep their WAN
+            self.router.set_balance_weights({interface: 1})
             return True
         else:
             logger.error(f"Failed to set primary route to {interface}")
             return False
     
+    def update_weights(self) -> bool:
+        """Pick up new capacity measurements and FUP steering; returns whether the weights changed"""
+        weights = self.router.balance_weights()
+        weights = {interface: weights.get(interface, 0) for interface in self.interfaces}
+        changed = weights != self.weights
+        self.weights = weights
+        return changed
+    
     def setup_load_balancing(self) -> bool:
-        """Setup load balancing between both interfaces"""
-        wan1_gateway = self.get_interface_gateway(self.wan1_interface)
-        wan2_gateway = self.get_interface_gateway(self.wan2_interface)
-        
-        if not wan1_gateway or not wan2_gateway:
-            logger.error("Cannot setup load balancing - missing gateways")
-            return False
-        
-        # Remove existing default route
-        self.run_command(['ip', 'route', 'del', 'default'])
-        
-        # Add load-balanced route
-        cmd = [
-            'ip', 'route', 'add', 'default',
-            'nexthop', 'via', wan1_gateway, 'dev', self.wan1_interface, 'weight', str(self.wan1_weight),
-            'nexthop', 'via', wan2_gateway, 'dev', self.wan2_interface, 'weight', str(self.wan2_weight)
-        ]
-        
-        success = self.run_command(cmd)
-        if success is not None:
-            logger.info(f"Load balancing configured: WAN1 weight {self.wan1_weight}, WAN2 weight {self.wan2_weight}")
+        """Setup load balancing between the interfaces in service"""
+        self.update_weights()
+        in_service = set(self.scoreboard.in_service())
+        weights = {interface: weight if interface in in_service else 0 for interface, weight in self.weights.items()}
+        
+        # A WAN out of service or steered out of balancing keeps no nexthop either
+        nexthops = {interface: weight for interface, weight in weights.items() if weight > 0}
+        if self.routing.replace_multipath_route(nexthops) and self.router.set_balance_weights(weights):
+            self.balanced = in_service
+            logger.info("Load balancing configured: " + ', '.join(f"{i} weight {w}" for i, w in nexthops.items()))
             return True
         else:
             logger.error("Failed to setup load balancing")
             return False
     
     def determine_best_interface(self) -> Optional[str]:
-        """Determine which interface should be primary"""
-        wan1_online = self.wan1_stats['online']
-        wan2_online = self.wan2_stats['online']
-        
-        # If only one is online, use that one
-        if wan1_online and not wan2_online:
-            return self.wan1_interface
-        elif wan2_online and not wan1_online:
-            return self.wan2_interface
-        elif not wan1_online and not wan2_online:
-            return None
-        
-        # Both are online, choose based on performance
-        wan1_score = self.calculate_interface_score(self.wan1_stats)
-        wan2_score = self.calculate_interface_score(self.wan2_stats)
-        
-        logger.info(f"Interface scores - WAN1: {wan1_score:.2f}, WAN2: {wan2_score:.2f}")
-        
-        if wan1_score > wan2_score:
-            return self.wan1_interface
-        else:
-            return self.wan2_interface
+        """The preferred interface among those in service; it only changes on a sustained lead"""
+        return self.scoreboard.preferred if self.scoreboard.in_service() else None
     
-    def calculate_interface_score(self, stats: Dict) -> float:
-        """Calculate a score for interface quality"""
-        if not stats['online']:
-            return 0
-        
-        # Lower latency is better, lower packet loss is better
-        latency_score = max(0, 100 - (stats['latency'] / 2))  # 200ms = 0 points
-        packet_loss_score = max(0, 100 - (stats['packet_loss'] * 2))  # 50% loss = 0 points
-        
-        # Weight the scores
-        total_score = (latency_score * 0.6) + (packet_loss_score * 0.4)
-        
-        return total_score
+    def determine_mode(self) -> Optional[str]:
+        """'load_balanced' with two or more WANs in service, else the one in service, else None"""
+        in_service = self.scoreboard.in_service()
+        if len(in_service) > 1:
+            return 'load_balanced'
+        return in_service[0] if in_service else None
     
-    def update_statistics(self):
-        """Update statistics for both interfaces"""
-        logger.info("Testing WAN connectivity...")
-        
-        # Test WAN1
-        wan1_result = self.test_interface_connectivity(self.wan1_interface)
-        self.wan1_stats = wan1_result
-        self.wan1_history.append(wan1_result)
-        if len(self.wan1_history) > self.history_size:
-            self.wan1_history.pop(0)
-        
-        # Test WAN2
-        wan2_result = self.test_interface_connectivity(self.wan2_interface)
-        self.wan2_stats = wan2_result
-        self.wan2_history.append(wan2_result)
-        if len(self.wan2_history) > self.history_size:
-            self.wan2_history.pop(0)
-        
-        logger.info(f"WAN1 ({self.wan1_interface}): Online={wan1_result['online']}, "
-                   f"Latency={wan1_result['latency']:.1f}ms, Loss={wan1_result['packet_loss']:.1f}%")
-        logger.info(f"WAN2 ({self.wan2_interface}): Online={wan2_result['online']}, "
-                   f"Latency={wan2_result['latency']:.1f}ms, Loss={wan2_result['packet_loss']:.1f}%")
+    def update_statistics(self, interfaces: Optional[List[str]] = None, dense: bool = True):
+        """Update statistics for every interface, or only the given ones"""
+        interfaces = interfaces or self.interfaces
+        logger.info(f"Testing WAN connectivity of {', '.join(interfaces)}{'' if dense else ' (sparse)'}...")
+        
+        # Every WAN in one round; a dead link costs the probe timeout, not a timeout per echo
+        results = self.test_connectivity(interfaces, dense)
+        prober = self.prober if dense else self.sparse_prober
+        
+        with self.lock:
+            self.stats.update(results)
+            in_service = {interface: self.scoreboard[interface].up for interface in results}
+            self.scoreboard.observe(time.time(), results)
+            now = time.monotonic()
+            for interface, result in results.items():
+                health = self.scoreboard[interface]
+                if in_service[interface] and not health.up:
+                    self.schedule.detected(interface, now)
+                self.schedule.probed(interface, now, len(prober.hosts) * prober.count,
+                                     result['online'], bool(health.up))
+        
+        for name, interface in self.wans.items():
+            if interface in results:
+                result = results[interface]
+                logger.info(f"{name.upper()} ({interface}): Online={result['online']}, "
+                           f"Latency={result['latency']:.1f}ms, Loss={result['packet_loss']:.1f}%, "
+                           f"Score={self.scoreboard[interface].score():.2f}")
+    
+    def on_netlink_event(self, msg_type: int, parsed: Dict):
+        """Fail over on carrier loss at once; anything else on a WAN gets it probed now"""
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            interface = parsed['name']
+            if interface not in self.carrier:
+                return
+            carrier = msg_type == RTM_NEWLINK and parsed['up'] and parsed['lower_up']
+            if carrier == self.carrier[interface]:
+                return
+            self.carrier[interface] = carrier
+            if not carrier:
+                self.carrier_lost(interface)
+            else:
+                # Fast probes confirm the link carries traffic before anything fails back
+                logger.info(f"Carrier up on {interface}; probing before failing back")
+                self.suspects.add(interface)
+                self.wakeup.set()
+        elif msg_type in (RTM_DELADDR, RTM_DELROUTE):
+            indexes = {parsed.get('index'), parsed.get('oif')} | {hop['oif'] for hop in parsed.get('nexthops', [])}
+            for interface in self.carrier:
+                if self.routing.link_index(interface) in indexes:
+                    self.suspects.add(interface)
+                    self.wakeup.set()
+    
+    def carrier_lost(self, interface: str):
+        """Take the WAN out of service now; the routing decision also drops its marked connections"""
+        started = time.monotonic()
+        with self.lock:
+            if not self.scoreboard.take_down(interface, time.time(), 'carrier lost'):
+                return
+            self.make_routing_decision()
+            self.schedule.detected(interface, time.monotonic(), onset=started)
+        logger.warning(f"Carrier lost on {interface}; rerouted in {(time.monotonic() - started) * 1000:.1f}ms")
+        self.save_status()
+    
+    def probe_due(self, now: float) -> List[str]:
+        """WANs whose next round is due, after folding in events and passive signals"""
+        with self.lock:
+            suspects, self.suspects = self.suspects, set()
+        for interface in suspects:
+            self.schedule.suspect(interface, now, 'link, address or route change')
+        if now >= self.next_passive:
+            self.next_passive = now + Config.WAN_PASSIVE_INTERVAL
+            try:
+                for interface, reason in self.passive.read().items():
+                    # A WAN out of service is probed for its return already
+                    if self.scoreboard[interface].up:
+                        self.schedule.suspect(interface, now, reason)
+            except OSError as e:
+                logger.error(f"Reading passive WAN signals failed: {e}")
+        
+        due = []
+        for interface in self.schedule.due(now):
+            if self.carrier[interface]:
+                due.append(interface)
+            else:
+                # Nothing gets through without carrier; its return is an event
+                self.schedule.defer(interface, now + self.check_interval)
+        return due
     
     def make_routing_decision(self):
-        """Make routing decision based on current statistics"""
-        best_interface = self.determine_best_interface()
+        """Make routing decision based on which WANs are in service"""
+        mode = self.determine_mode()
         
-        if best_interface is None:
-            logger.warning("No WAN interfaces are online!")
+        if mode is None:
+            # Keep the last routes; they are no worse than none
+            logger.warning("No WAN interfaces are in service!")
             return
         
-        # Check if we need to change primary interface
-        if self.current_primary != best_interface:
-            logger.info(f"Switching primary interface from {self.current_primary} to {best_interface}")
+        # Routes change only when a WAN goes in or out of service, never on one round's numbers
+        if self.current_primary != mode:
+            logger.info(f"Switching primary interface from {self.current_primary} to {mode}")
             
-            if self.wan1_stats['online'] and self.wan2_stats['online']:
-                # Both online, use load balancing
-                self.setup_load_balancing()
-                self.current_primary = 'load_balanced'
-            else:
+            if mode == 'load_balanced':
+                if self.setup_load_balancing():
+                    self.current_primary = mode
+            elif self.set_primary_route(mode):
                 # Use failover
-                if self.set_primary_route(best_interface):
-                    self.current_primary = best_interface
-                else:
-                    logger.error("Failed to switch primary interface")
-        
-        elif self.current_primary == 'load_balanced':
-            # Check if we should switch from load balancing to failover
-            if not (self.wan1_stats['online'] and self.wan2_stats['online']):
-                if self.set_primary_route(best_interface):
-                    self.current_primary = best_interface
+                self.current_primary = mode
+            else:
+                logger.error("Failed to switch primary interface")
+        
+        elif mode == 'load_balanced' and (self.update_weights() or self.balanced != set(self.scoreboard.in_service())):
+            # Re-weighting, or a WAN joining or leaving the balance, only affects new connections
+            self.setup_load_balancing()
+        
+        # Connections marked for a WAN that left would keep routing into its table;
+        # with their conntrack entries gone they are marked again for one in service
+        serving = set(self.scoreboard.in_service())
+        for interface in sorted(self.serving - serving):
+            self.router.forget_connections(interface)
+        self.serving = serving
     
     def save_status(self):
-        """Save current status to file"""
-        status = {
-            'timestamp': datetime.now().isoformat(),
-            'current_primary': self.current_primary,
-            'wan1_stats': self.wan1_stats,
-            'wan2_stats': self.wan2_stats,
-            'wan1_interface': self.wan1_interface,
-            'wan2_interface': self.wan2_interface
-        }
+        """Publish current status to the API; the main loop and link events both do"""
+        with self.lock:
+            status = {
+                'timestamp': datetime.now().isoformat(),
+                'updated_at': time.time(),
+                'current_primary': self.current_primary,
+                'preferred_interface': self.determine_best_interface(),
+                'stats': self.stats,
+                'weights': self.weights,
+                'balanced': sorted(self.balanced),
+                'carrier': self.carrier,
+                'scores': self.scoreboard.state(time.time()),
+                'probes': self.schedule.state(time.monotonic()),
+                'flaps': self.scoreboard.flaps(),
+                # (timestamp, online, latency, jitter, loss) of recent probe rounds
+                'history': {interface: list(health.samples) for interface, health in self.scoreboard.wans.items()},
+                'wans': self.wans
+            }
+            
+            try:
+                if self.state_record is None:
+                    self.state_record = SharedRecord(Config.LOADBALANCER_STATE_FILE, writable=True)
+                self.state_record.publish(status)
+            except Exception as e:
+                logger.error(f"Failed to save status: {e}")
+    
+    def watch_links(self):
+        """Carrier changes are acted on as the kernel reports them, not at the next round"""
+        links = self.routing.links()
+        for interface in self.carrier:
+            link = links.get(interface)
+            self.carrier[interface] = bool(link and link['up'] and link['lower_up'])
+        self.routing.add_listener(self.on_netlink_event)
+    
+    def run_once(self) -> float:
+        """Probe the WANs that are due and route accordingly; returns seconds until the next pass"""
+        self.wakeup.clear()
+        # Scheduled rounds catch degradations no link event reports
+        due = self.probe_due(time.monotonic())
+        dense = [interface for interface in due if self.schedule.dense(interface)]
+        sparse = [interface for interface in due if not self.schedule.dense(interface)]
+        for interfaces, is_dense in ((dense, True), (sparse, False)):
+            if interfaces:
+                self.update_statistics(interfaces, is_dense)
+        if due:
+            with self.lock:
+                self.make_routing_decision()
+            self.save_status()
         
-        try:
-            with open('/var/lib/bytebill/loadbalancer_status.json', 'w') as f:
-                json.dump(status, f, indent=2)
-        except Exception as e:
-            logger.error(f"Failed to save status: {e}")
+        return max(0, min(self.schedule.next_at(), self.next_passive) - time.monotonic())
     
     def signal_handler(self, signum, frame):
         """Handle shutdown signals"""
         logger.info(f"Received signal {signum}, shutting down...")
         self.running = False
+        self.wakeup.set()
     
     def run(self):
         """Main monitoring loop"""
@@ -336,16 +350,15 @@ class LoadBalancer:
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
         
-        # Create status directory
+        # Create state directories
         os.makedirs('/var/lib/bytebill', exist_ok=True)
+        os.makedirs(os.path.dirname(Config.LOADBALANCER_STATE_FILE), exist_ok=True)
+        
+        self.watch_links()
         
         while self.running:
             try:
-                self.update_statistics()
-                self.make_routing_decision()
-                self.save_status()
-                
-                time.sleep(self.check_interval)
+                self.wakeup.wait(self.run_once())
                 
             except KeyboardInterrupt:
                 logger.info("Received keyboard interrupt, shutting down...")
@@ -357,5 +370,6 @@ class LoadBalancer:
         logger.info("ByteBill Load Balancer stopped")
 
 if __name__ == '__main__':
+    configure_logging()
     load_balancer = LoadBalancer()
     load_balancer.run()
@@ -1,11 +1,11 @@
 #!/bin/bash
 
 # ByteBill ISP Speed Test Script
-# This script runs speed tests on both WAN interfaces and logs the results
+# This script runs speed tests on every WAN interface and logs the results
 
 # Configuration
-WAN1_INTERFACE="enx1"
-WAN2_INTERFACE="enx2"
+WAN_INTERFACES="${WAN_INTERFACES:-enx1,enx2}"  # as in the backend's WANS, in order
+IFS=',' read -r -a WANS <<< "$WAN_INTERFACES"
 LOG_FILE="/var/log/bytebill-speedtest.log"
 RESULT_FILE="/var/lib/bytebill/speedtest_results.json"
 
@@ -15,7 +15,8 @@ mkdir -p /var/log
 
 # Function to log messages
 log_message() {
-    echo "$(date '+%Y-%m-%d %H:%M:%S') - $1" | tee -a "$LOG_FILE"
+    # On stderr, so results captured from stdout stay plain JSON
+    echo "$(date '+%Y-%m-%d %H:%M:%S') - $1" | tee -a "$LOG_FILE" >&2
 }
 
 # Function to check if interface is up and has IP
@@ -57,16 +58,17 @@ run_speedtest() {
     fi
     
     # Check interface status
-    if ! check_interface "$interface"; then
+    if ! check_interface "$interface" >&2; then
         log_message "ERROR: $interface_name ($interface) is not ready for testing"
         return 1
     fi
     
-    # Run speedtest with interface binding
+    # speedtest-cli has no interface option, only a source address to bind;
+    # the `from <address> lookup <WAN table>` rule sends the test out of this WAN
+    local source=$(ip -4 -o addr show dev "$interface" | awk '{print $4}' | cut -d/ -f1 | head -n 1)
     local temp_file=$(mktemp)
     
-    # Try to bind to interface
-    if speedtest-cli --interface "$interface" --simple --timeout 60 > "$temp_file" 2>&1; then
+    if speedtest-cli --source "$source" --simple --timeout 60 > "$temp_file" 2>&1; then
         local ping_ms=$(grep "Ping:" "$temp_file" | awk '{print $2}')
         local download_mbps=$(grep "Download:" "$temp_file" | awk '{print $2}')
         local upload_mbps=$(grep "Upload:" "$temp_file" | awk '{print $2}')
@@ -113,32 +115,22 @@ EOF
     rm -f "$temp_file"
 }
 
-# Function to save results to JSON file
+# Function to save results to JSON file, one result per WAN in order
 save_results() {
-    local wan1_result="$1"
-    local wan2_result="$2"
-    
-    local combined_result=$(cat <<EOF
-{
-  "test_time": "$(date -Iseconds)",
-  "wan1": $wan1_result,
-  "wan2": $wan2_result
-}
-EOF
-)
-    
-    # Save to file
-    echo "$combined_result" > "$RESULT_FILE"
-    
-    # Also append to history file
-    local history_file="/var/lib/bytebill/speedtest_history.jsonl"
-    echo "$combined_result" >> "$history_file"
-    
-    # Keep only last 100 entries in history
-    if [ -f "$history_file" ]; then
-        tail -n 100 "$history_file" > "${history_file}.tmp"
-        mv "${history_file}.tmp" "$history_file"
-    fi
+    local combined_result="{
+  \"test_time\": \"$(date -Iseconds)\""
+    local index=1
+    for result in "$@"; do
+        combined_result+=",
+  \"wan$index\": $result"
+        index=$((index + 1))
+    done
+    combined_result+="
+}"
+    
+    # Save to file; the backend's ISP sampler records each new result in its metrics history
+    echo "$combined_result" > "${RESULT_FILE}.tmp"
+    mv "${RESULT_FILE}.tmp" "$RESULT_FILE"
 }
 
 # Function to run connectivity test
@@ -160,36 +152,29 @@ main() {
     # Test connectivity first
     log_message "Testing basic connectivity..."
     
-    wan1_connectivity="false"
-    wan2_connectivity="false"
-    
-    if test_connectivity "$WAN1_INTERFACE"; then
-        wan1_connectivity="true"
-        log_message "WAN1 ($WAN1_INTERFACE) connectivity: OK"
-    else
-        log_message "WAN1 ($WAN1_INTERFACE) connectivity: FAILED"
-    fi
-    
-    if test_connectivity "$WAN2_INTERFACE"; then
-        wan2_connectivity="true"
-        log_message "WAN2 ($WAN2_INTERFACE) connectivity: OK"
-    else
-        log_message "WAN2 ($WAN2_INTERFACE) connectivity: FAILED"
-    fi
+    local connectivity=()
+    for i in "${!WANS[@]}"; do
+        if test_connectivity "${WANS[$i]}"; then
+            connectivity[$i]="true"
+            log_message "WAN$((i + 1)) (${WANS[$i]}) connectivity: OK"
+        else
+            connectivity[$i]="false"
+            log_message "WAN$((i + 1)) (${WANS[$i]}) connectivity: FAILED"
+        fi
+    done
     
     # Run speed tests
-    local wan1_result
-    local wan2_result
-    
-    if [ "$wan1_connectivity" = "true" ]; then
-        wan1_result=$(run_speedtest "$WAN1_INTERFACE" "WAN1")
-    else
-        local timestamp=$(date -Iseconds)
-        wan1_result=$(cat <<EOF
+    local results=()
+    for i in "${!WANS[@]}"; do
+        if [ "${connectivity[$i]}" = "true" ]; then
+            results[$i]=$(run_speedtest "${WANS[$i]}" "WAN$((i + 1))")
+        else
+            local timestamp=$(date -Iseconds)
+            results[$i]=$(cat <<EOF
 {
   "timestamp": "$timestamp",
-  "interface": "$WAN1_INTERFACE",
-  "interface_name": "WAN1",
+  "interface": "${WANS[$i]}",
+  "interface_name": "WAN$((i + 1))",
   "ping_ms": null,
   "download_mbps": null,
   "upload_mbps": null,
@@ -197,46 +182,25 @@ main() {
 }
 EOF
 )
-    fi
-    
-    if [ "$wan2_connectivity" = "true" ]; then
-        wan2_result=$(run_speedtest "$WAN2_INTERFACE" "WAN2")
-    else
-        local timestamp=$(date -Iseconds)
-        wan2_result=$(cat <<EOF
-{
-  "timestamp": "$timestamp",
-  "interface": "$WAN2_INTERFACE",
-  "interface_name": "WAN2",
-  "ping_ms": null,
-  "download_mbps": null,
-  "upload_mbps": null,
-  "status": "no_connectivity"
-}
-EOF
-)
-    fi
+        fi
+    done
     
     # Save results
-    save_results "$wan1_result" "$wan2_result"
+    save_results "${results[@]}"
     
     log_message "Speed test completed. Results saved to $RESULT_FILE"
     
     # Display summary
     echo "=== Speed Test Summary ==="
-    echo "WAN1 ($WAN1_INTERFACE): $(echo "$wan1_result" | jq -r '.status')"
-    if echo "$wan1_result" | jq -e '.download_mbps' >/dev/null 2>&1; then
-        echo "  Download: $(echo "$wan1_result" | jq -r '.download_mbps') Mbps"
-        echo "  Upload: $(echo "$wan1_result" | jq -r '.upload_mbps') Mbps"
-        echo "  Ping: $(echo "$wan1_result" | jq -r '.ping_ms') ms"
-    fi
-    
-    echo "WAN2 ($WAN2_INTERFACE): $(echo "$wan2_result" | jq -r '.status')"
-    if echo "$wan2_result" | jq -e '.download_mbps' >/dev/null 2>&1; then
-        echo "  Download: $(echo "$wan2_result" | jq -r '.download_mbps') Mbps"
-        echo "  Upload: $(echo "$wan2_result" | jq -r '.upload_mbps') Mbps"
-        echo "  Ping: $(echo "$wan2_result" | jq -r '.ping_ms') ms"
-    fi
+    for i in "${!WANS[@]}"; do
+        local result="${results[$i]}"
+        echo "WAN$((i + 1)) (${WANS[$i]}): $(echo "$result" | jq -r '.status')"
+        if echo "$result" | jq -e '.download_mbps' >/dev/null 2>&1; then
+            echo "  Download: $(echo "$result" | jq -r '.download_mbps') Mbps"
+            echo "  Upload: $(echo "$result" | jq -r '.upload_mbps') Mbps"
+            echo "  Ping: $(echo "$result" | jq -r '.ping_ms') ms"
+        fi
+    done
 }
 
 # Check if running as root
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+ByteBill M-PESA Load Test
+Drives N concurrent captive-portal purchases through the backend against the
+local Daraja simulator and reports payment-to-session-activation latency.
+
+The backend and simulator both run in-process: purchases go through
+POST /api/mpesa/purchase, the simulator delivers callbacks (with duplicates
+and losses) to /api/mpesa/callback, and the callback consumer and pending
+payment poller activate the sessions.
+
+Usage: python mpesa_load_test.py [--purchases N] [--concurrency C]
+                                 [--callback-loss-rate R] [--database-uri URI]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from decimal import Decimal
+
+import requests
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.environ.get('BYTEBILL_BACKEND_DIR') or os.path.join(SCRIPT_DIR, '..', 'backend')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+
+from daraja_simulator import start_simulator, add_simulator_arguments, simulator_options
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(label, values):
+    if not values:
+        print(f"{label:<28} n/a")
+        return
+    print(f"{label:<28} p50 {percentile(values, 50):7.0f} ms   p90 {percentile(values, 90):7.0f} ms   "
+          f"p99 {percentile(values, 99):7.0f} ms   max {max(values):7.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description='M-PESA purchase load test against the Daraja simulator')
+    parser.add_argument('--purchases', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--database-uri', default=None, help='SQLAlchemy URI (default: temporary SQLite)')
+    parser.add_argument('--backend-port', type=int, default=5055)
+    parser.add_argument('--simulator-port', type=int, default=8089)
+    parser.add_argument('--rate-limit', type=float, default=None, help='override MPESA_API_RATE_LIMIT')
+    parser.add_argument('--query-min-age', type=int, default=10, help='seconds before lost callbacks are queried')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for every purchase to settle')
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bytebill-loadtest-')
+    backend_url = f"http://127.0.0.1:{args.backend_port}"
+    os.environ.update({
+        'MPESA_API_BASE_URL': f"http://127.0.0.1:{args.simulator_port}",
+        'MPESA_CALLBACK_URL': f"{backend_url}/api/mpesa/callback",
+        'MPESA_CONSUMER_KEY': 'simulator',
+        'MPESA_CONSUMER_SECRET': 'simulator',
+        'MPESA_PASSKEY': 'simulator',
+        'MPESA_SHORTCODE': '174379',
+        'MPESA_INBOX_DIR': os.path.join(workdir, 'inbox')
+    })
+
+    from config import Config
+    if args.database_uri:
+        Config.SQLALCHEMY_DATABASE_URI = args.database_uri
+    else:
+        Config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+        Config.SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    if args.rate_limit:
+        Config.MPESA_API_RATE_LIMIT = args.rate_limit
+        Config.MPESA_API_BURST = args.rate_limit
+    Config.MPESA_QUERY_MIN_AGE = args.query_min_age
+    Config.MPESA_QUERY_INTERVAL = 2
+    Config.MPESA_QUERY_BACKOFF = [(60, 3), (600, 15), (86400, 60)]
+    # Paid sessions are activated here; keep them out of the host's firewall and qdiscs
+    Config.ACCESS_CONTROL_ENABLED = Config.SHAPING_ENABLED = Config.WAN_POLICY_ENABLED = False
+
+    from werkzeug.serving import make_server
+    from app import create_app
+    from database import db
+    from models.plan import Plan, PlanType
+    from models.session import Session, SessionStatus
+    from models.transaction import MpesaTransaction, TransactionStatus
+
+    simulator, simulator_server = start_simulator(port=args.simulator_port, **simulator_options(args))
+
+    app = create_app(network_workers=False)
+    with app.app_context():
+        db.create_all()
+        plan = Plan(name='Load Test Hourly', type=PlanType.HOURLY, duration=3600, price=Decimal('50.00'))
+        db.session.add(plan)
+        db.session.commit()
+        plan_id = plan.id
+
+    backend = make_server('127.0.0.1', args.backend_port, app, threaded=True)
+    threading.Thread(target=backend.serve_forever, name='backend', daemon=True).start()
+
+    print(f"Driving {args.purchases} purchases with concurrency {args.concurrency}...")
+    http = requests.Session()
+
+    def purchase(i):
+        requested_at = time.time()
+        response = http.post(f"{backend_url}/api/mpesa/purchase", json={
+            'plan_id': plan_id,
+            'phone_number': f"07{i:08d}",
+            'mac_address': f"02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}",
+            'ip_address': f"192.168.88.{10 + i % 200}"
+        }, timeout=30)
+        if response.status_code != 201:
+            return None
+        return response.json()['checkout_request_id'], requested_at
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        purchases = list(pool.map(purchase, range(args.purchases)))
+    accepted = {cid: requested_at for cid, requested_at in filter(None, purchases)}
+    push_elapsed = time.time() - started
+
+    # Wait for every accepted purchase to leave PENDING
+    deadline = time.time() + args.timeout
+    with app.app_context():
+        while time.time() < deadline:
+            pending = MpesaTransaction.query.filter(
+                MpesaTransaction.checkout_request_id.in_(list(accepted)),
+                MpesaTransaction.status == TransactionStatus.PENDING
+            ).count()
+            db.session.rollback()
+            if pending == 0:
+                break
+            time.sleep(0.5)
+
+        rows = db.session.query(MpesaTransaction, Session).join(
+            Session, Session.id == MpesaTransaction.session_id
+        ).filter(MpesaTransaction.checkout_request_id.in_(list(accepted))).all()
+
+    state = simulator.snapshot()
+    activation_latency = []
+    end_to_end_latency = []
+    outcome = {'active': 0, 'cancelled': 0, 'pending': 0, 'mismatched': 0}
+
+    for txn, session in rows:
+        sim_txn = state['transactions'].get(txn.checkout_request_id)
+        if txn.status == TransactionStatus.PENDING:
+            outcome['pending'] += 1
+            continue
+        if session.status == SessionStatus.ACTIVE:
+            outcome['active'] += 1
+            activated_at = session.start_time.replace(tzinfo=timezone.utc).timestamp()
+            activation_latency.append((activated_at - sim_txn['completed_at']) * 1000)
+            end_to_end_latency.append((activated_at - accepted[txn.checkout_request_id]) * 1000)
+            if sim_txn['status'] != 'completed':
+                outcome['mismatched'] += 1
+        else:
+            outcome['cancelled'] += 1
+            if sim_txn['status'] != 'cancelled':
+                outcome['mismatched'] += 1
+
+    counters = state['counters']
+    print("\n=== M-PESA Load Test ===")
+    print(f"Purchases accepted:          {len(accepted)}/{args.purchases} in {push_elapsed:.1f}s "
+          f"({len(accepted) / push_elapsed:.1f}/s)")
+    print(f"Sessions activated:          {outcome['active']}")
+    print(f"Cancelled / failed:          {outcome['cancelled']}")
+    print(f"Still pending at timeout:    {outcome['pending']}")
+    print(f"Outcome mismatches:          {outcome['mismatched']} (expected 0)")
+    print(f"Callbacks sent / dup / lost: {counters['callbacks_sent']} / "
+          f"{counters['callbacks_duplicated']} / {counters['callbacks_lost']}")
+    print(f"OAuth / STK query calls:     {counters['oauth']} / {counters['stk_query']}")
+    summarize("Payment -> activation:", activation_latency)
+    summarize("Purchase -> activation:", end_to_end_latency)
+
+    backend.shutdown()
+    simulator_server.shutdown()
+
+if __name__ == '__main__':
+    main()
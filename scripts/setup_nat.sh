@@ -4,10 +4,32 @@
 # This script configures NAT rules for the WiFi hotspot management system
 
 # Configuration
-WAN1_INTERFACE="enx1"  # USB-to-Ethernet adapter 1
-WAN2_INTERFACE="enx2"  # USB-to-Ethernet adapter 2
+WAN_INTERFACES="${WAN_INTERFACES:-enx1,enx2}"  # USB-to-Ethernet adapters, as in the backend's WANS
 LAN_INTERFACE="eth0"   # Built-in Ethernet for LAN
 LAN_SUBNET="192.168.88.0/24"
+FIREWALL_BACKEND="${FIREWALL_BACKEND:-iptables}"  # iptables or nftables
+
+IFS=',' read -r -a WANS <<< "$WAN_INTERFACES"
+
+# Per-WAN rules, one of each for every uplink
+NFT_WANS=""
+FORWARD_RULES=()
+NAT_RULES=()
+for wan in "${WANS[@]}"; do
+    NFT_WANS="${NFT_WANS:+$NFT_WANS, }\"$wan\""
+    FORWARD_RULES+=("-A FORWARD -i $LAN_INTERFACE -o $wan -j ACCEPT")
+    FORWARD_RULES+=("-A FORWARD -i $wan -o $LAN_INTERFACE -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT")
+    NAT_RULES+=("-A POSTROUTING -o $wan -j MASQUERADE")
+done
+
+print_summary() {
+    echo "NAT setup complete!"
+    for i in "${!WANS[@]}"; do
+        echo "WAN$((i + 1)) Interface: ${WANS[$i]}"
+    done
+    echo "LAN Interface: $LAN_INTERFACE"
+    echo "LAN Subnet: $LAN_SUBNET"
+}
 
 echo "Setting up ByteBill NAT configuration..."
 
@@ -16,66 +38,96 @@ echo "Enabling IP forwarding..."
 sysctl -w net.ipv4.ip_forward=1
 sysctl -w net.ipv4.conf.all.forwarding=1
 
-# Make IP forwarding permanent
-if ! grep -q "net.ipv4.ip_forward=1" /etc/sysctl.conf; then
-    echo "net.ipv4.ip_forward=1" >> /etc/sysctl.conf
+# Make IP forwarding permanent; the backend keeps the same drop-in file
+cat > /etc/sysctl.d/90-bytebill.conf <<EOF
+# ByteBill IP Forwarding
+net.ipv4.ip_forward=1
+net.ipv4.conf.all.forwarding=1
+EOF
+
+if [ "$FIREWALL_BACKEND" = "nftables" ]; then
+    # Replace ByteBill's own table in one nft transaction; other tables are untouched
+    echo "Applying nftables ruleset..."
+    nft -f - <<EOF
+table inet bytebill
+delete table inet bytebill
+table inet bytebill {
+    chain forward {
+        type filter hook forward priority filter; policy accept;
+        iifname "$LAN_INTERFACE" oifname { $NFT_WANS } accept
+        oifname "$LAN_INTERFACE" ct state established,related accept
+    }
+    chain postrouting {
+        type nat hook postrouting priority srcnat; policy accept;
+        oifname { $NFT_WANS } masquerade
+    }
+}
+EOF
+
+    if [ $? -ne 0 ]; then
+        echo "Error: nftables ruleset rejected, existing ruleset left unchanged"
+        exit 1
+    fi
+
+    echo "Current ByteBill table:"
+    nft list table inet bytebill
+
+    print_summary
+    exit 0
 fi
 
-if ! grep -q "net.ipv4.conf.all.forwarding=1" /etc/sysctl.conf; then
-    echo "net.ipv4.conf.all.forwarding=1" >> /etc/sysctl.conf
-fi
-
-# Clear existing iptables rules
-echo "Clearing existing iptables rules..."
-iptables -F
-iptables -t nat -F
-iptables -t mangle -F
-iptables -X
-
-# Set default policies
-iptables -P INPUT ACCEPT
-iptables -P FORWARD ACCEPT
-iptables -P OUTPUT ACCEPT
-
-# Setup NAT rules for both WAN interfaces
-echo "Setting up NAT rules..."
-iptables -t nat -A POSTROUTING -o $WAN1_INTERFACE -j MASQUERADE
-iptables -t nat -A POSTROUTING -o $WAN2_INTERFACE -j MASQUERADE
-
-# Setup forward rules
-echo "Setting up forward rules..."
-iptables -A FORWARD -i $LAN_INTERFACE -o $WAN1_INTERFACE -j ACCEPT
-iptables -A FORWARD -i $LAN_INTERFACE -o $WAN2_INTERFACE -j ACCEPT
-iptables -A FORWARD -i $WAN1_INTERFACE -o $LAN_INTERFACE -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
-iptables -A FORWARD -i $WAN2_INTERFACE -o $LAN_INTERFACE -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
-
+# Replace the filter, nat and mangle tables in one iptables-restore
+# transaction so the ruleset is never left half-applied
+echo "Applying iptables rules..."
+iptables-restore <<EOF
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+# Forward rules
+$(printf '%s\n' "${FORWARD_RULES[@]}")
 # Allow loopback traffic
-iptables -A INPUT -i lo -j ACCEPT
-iptables -A OUTPUT -o lo -j ACCEPT
-
+-A INPUT -i lo -j ACCEPT
+-A OUTPUT -o lo -j ACCEPT
 # Allow SSH (port 22)
-iptables -A INPUT -p tcp --dport 22 -j ACCEPT
-
+-A INPUT -p tcp --dport 22 -j ACCEPT
 # Allow HTTP and HTTPS for captive portal
-iptables -A INPUT -p tcp --dport 80 -j ACCEPT
-iptables -A INPUT -p tcp --dport 443 -j ACCEPT
-
+-A INPUT -p tcp --dport 80 -j ACCEPT
+-A INPUT -p tcp --dport 443 -j ACCEPT
 # Allow Flask API (port 5000)
-iptables -A INPUT -p tcp --dport 5000 -j ACCEPT
-
+-A INPUT -p tcp --dport 5000 -j ACCEPT
 # Allow DNS
-iptables -A INPUT -p udp --dport 53 -j ACCEPT
-iptables -A INPUT -p tcp --dport 53 -j ACCEPT
-
+-A INPUT -p udp --dport 53 -j ACCEPT
+-A INPUT -p tcp --dport 53 -j ACCEPT
 # Allow DHCP
-iptables -A INPUT -p udp --dport 67 -j ACCEPT
-iptables -A INPUT -p udp --dport 68 -j ACCEPT
-
+-A INPUT -p udp --dport 67 -j ACCEPT
+-A INPUT -p udp --dport 68 -j ACCEPT
 # Allow LAN traffic
-iptables -A INPUT -i $LAN_INTERFACE -j ACCEPT
-
+-A INPUT -i $LAN_INTERFACE -j ACCEPT
 # Allow established connections
-iptables -A INPUT -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
+-A INPUT -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
+COMMIT
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+# NAT rules for every WAN interface
+$(printf '%s\n' "${NAT_RULES[@]}")
+COMMIT
+*mangle
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+COMMIT
+EOF
+
+if [ $? -ne 0 ]; then
+    echo "Error: iptables rules rejected, the failing table was left unchanged"
+    exit 1
+fi
 
 # Save iptables rules
 echo "Saving iptables rules..."
@@ -94,8 +146,4 @@ iptables -t nat -L -n
 echo "Current filter rules:"
 iptables -L -n
 
-echo "NAT setup complete!"
-echo "WAN1 Interface: $WAN1_INTERFACE"
-echo "WAN2 Interface: $WAN2_INTERFACE"
-echo "LAN Interface: $LAN_INTERFACE"
-echo "LAN Subnet: $LAN_SUBNET"
+print_summary
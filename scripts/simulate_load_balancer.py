@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+"""
+ByteBill Load Balancer Simulator
+Replays per-WAN latency, loss and outage traces through the load balancer's
+decision logic on a simulated clock, with the prober, routes and passive
+signals mocked, and reports route switches, traffic time on degraded links
+and the CPU time the decisions took. A trace is JSON lines of
+{"t": seconds, "wan1": {"carrier": true, "online": true, "latency": 20,
+"jitter": 2, "loss": 0}, "wan2": {...}} for the WANs in Config.WANS; fields
+left out keep their previous value. Exits 1 when a --max-* threshold is exceeded.
+
+Usage: python simulate_load_balancer.py [--scenario mixed | --trace FILE | --from-metrics HOURS]
+                                        [--set WAN_PREFERENCE_MARGIN=10] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+BACKEND_DIR = os.environ.get('BYTEBILL_BACKEND_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'backend'
+)
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+import dynamic_load_balance
+from config import Config
+from utils.netlink import RTM_NEWLINK
+from utils.prober import jitter, summarize
+
+DEFAULT_STATE = {'carrier': True, 'online': True, 'latency': 20.0, 'jitter': 2.0, 'loss': 0.0}
+
+class SimClock:
+    """Stands in for the `time` module of the load balancer"""
+
+    def __init__(self, epoch: float):
+        self.epoch = epoch
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.epoch + self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+class Trace:
+    """Step function of each WAN's condition over time"""
+
+    def __init__(self, lines: List[Dict], epoch: Optional[float] = None):
+        self.epoch = epoch or time.time()
+        self.times = []
+        self.states = []
+        wans = list(Config.WANS)
+        state = {wan: dict(DEFAULT_STATE) for wan in wans}
+        for line in sorted(lines, key=lambda line: line['t']):
+            state = {wan: dict(state[wan], **line.get(wan, {})) for wan in wans}
+            if self.times and self.times[-1] == line['t']:
+                self.states[-1] = state
+            else:
+                self.times.append(float(line['t']))
+                self.states.append(state)
+        if not self.times or self.times[0] > 0:
+            self.times.insert(0, 0.0)
+            self.states.insert(0, {wan: dict(DEFAULT_STATE) for wan in wans})
+        self.duration = self.times[-1]
+
+    def at(self, wan: str, t: float) -> Dict:
+        return self.states[max(0, bisect.bisect_right(self.times, t) - 1)][wan]
+
+    def changes(self, after: float, until: float) -> List[float]:
+        """Times in (after, until] at which the trace steps"""
+        return self.times[bisect.bisect_right(self.times, after):bisect.bisect_right(self.times, until)]
+
+    def lines(self) -> List[Dict]:
+        return [dict({'t': t}, **state) for t, state in zip(self.times, self.states)]
+
+def synthetic_trace(scenario: str, duration: float, rng: random.Random) -> List[Dict]:
+    lines = [{'t': 0, 'wan1': {'latency': 25.0, 'jitter': 3.0}, 'wan2': {'latency': 40.0, 'jitter': 6.0}}]
+    if scenario in ('outage', 'mixed'):
+        # Unplugged modem, then an upstream blackhole with the link still up
+        lines += [{'t': duration * 0.2, 'wan1': {'carrier': False}},
+                  {'t': duration * 0.2 + 180, 'wan1': {'carrier': True}},
+                  {'t': duration * 0.5, 'wan2': {'online': False}},
+                  {'t': duration * 0.5 + 240, 'wan2': {'online': True}}]
+    if scenario in ('degraded', 'mixed'):
+        # Congested evening on WAN1: slow and lossy but never down
+        lines += [{'t': duration * 0.65, 'wan1': {'latency': 180.0, 'jitter': 40.0, 'loss': 15.0}},
+                  {'t': duration * 0.85, 'wan1': {'latency': 25.0, 'jitter': 3.0, 'loss': 0.0}}]
+    if scenario in ('flaky', 'mixed'):
+        # Short drops on WAN2 that should not move traffic back and forth
+        t = rng.uniform(60, 300)
+        while t < duration:
+            lines += [{'t': t, 'wan2': {'online': False}},
+                      {'t': t + rng.uniform(5, 40), 'wan2': {'online': True}}]
+            t += rng.uniform(120, 600)
+    if scenario == 'noisy':
+        # Latency wandering around the baseline, occasionally swapping which WAN is faster
+        for t in range(0, int(duration), 30):
+            lines.append({'t': t, 'wan1': {'latency': max(5.0, rng.gauss(30, 15))},
+                          'wan2': {'latency': max(5.0, rng.gauss(35, 15))}})
+    return lines
+
+def metrics_trace(hours: float, directory: Optional[str]) -> Trace:
+    """A trace from what the ISP sampler recorded over the last `hours`"""
+    from utils.timeseries import TimeSeriesStore
+    store = TimeSeriesStore(directory)
+    end = time.time()
+    start = end - hours * 3600
+    points = {}
+    for wan in Config.WANS:
+        for metric, key, convert in (('online', 'online', bool), ('rtt_ms', 'latency', float),
+                                     ('jitter_ms', 'jitter', float), ('loss_pct', 'loss', float)):
+            series = store.query(f'{wan}.{metric}', start, end, tier='raw')
+            for timestamp, value in zip(series['t'], series['avg']):
+                points.setdefault(timestamp, {}).setdefault(wan, {})[key] = convert(value)
+    if not points:
+        raise SystemExit(f"No WAN metrics recorded in the last {hours} hours")
+    first = min(points)
+    return Trace([dict({'t': timestamp - first}, **wans) for timestamp, wans in points.items()], epoch=first)
+
+class FakeProber:
+    """Answers probe rounds from the trace; every echo is drawn on its own"""
+
+    def __init__(self, clock: SimClock, trace: Trace, interfaces: Dict[str, str], rng: random.Random,
+                 count: Optional[int] = None):
+        self.clock = clock
+        self.trace = trace
+        self.interfaces = interfaces
+        self.rng = rng
+        self.hosts = Config.PROBE_HOSTS
+        self.count = count or Config.PROBE_COUNT
+        self.rounds = 0
+        # CPU time of the simulation itself, taken out of the decision time
+        self.cpu = 0.0
+
+    def probe(self, state: Dict) -> Dict:
+        if not state['carrier'] or not state['online']:
+            return {'success': False, 'latency': None, 'jitter': None, 'packet_loss': 100.0, 'rtts': []}
+        rtts = [max(0.1, self.rng.gauss(state['latency'], state['jitter'])) for _ in range(self.count)
+                if self.rng.random() * 100 >= state['loss']]
+        return {'success': bool(rtts), 'latency': sum(rtts) / len(rtts) if rtts else None,
+                'jitter': jitter(rtts), 'packet_loss': (self.count - len(rtts)) / self.count * 100, 'rtts': rtts}
+
+    def run(self, interfaces: List[str]) -> Dict[str, Dict]:
+        started = time.process_time()
+        summaries = {}
+        duration = 0.0
+        for interface in interfaces:
+            state = self.trace.at(self.interfaces[interface], self.clock.now)
+            results = [self.probe(state) for _ in self.hosts]
+            summaries[interface] = summarize(interface, results)
+            # Like the real prober, a round lasts one RTT plus the echo spacing, or the timeout on loss
+            for result in results:
+                if len(result['rtts']) < self.count:
+                    duration = max(duration, Config.PROBE_TIMEOUT)
+                else:
+                    duration = max(duration, max(result['rtts']) / 1000 + 0.2 * (self.count - 1))
+        self.rounds += 1
+        self.cpu += time.process_time() - started
+        self.clock.sleep(duration)
+        return summaries
+
+class FakeRouting:
+    """Records the default route as each WAN's share of new connections"""
+
+    def __init__(self, clock: SimClock, trace: Trace, interfaces: Dict[str, str], initial: str):
+        self.clock = clock
+        self.trace = trace
+        self.interfaces = interfaces
+        self.shares = {initial: 1.0}
+        # (time, shares) after every change
+        self.changes = [(0.0, self.shares)]
+
+    def links(self) -> Dict[str, Dict]:
+        links = {}
+        for index, (interface, wan) in enumerate(self.interfaces.items(), start=2):
+            carrier = self.trace.at(wan, self.clock.now)['carrier']
+            links[interface] = {'index': index, 'up': True, 'lower_up': carrier}
+        return links
+
+    def link_index(self, interface: str) -> Optional[int]:
+        return self.links()[interface]['index']
+
+    def gateway(self, interface: str) -> Optional[str]:
+        return '192.0.2.1'
+
+    def add_listener(self, callback):
+        pass
+
+    def route(self, shares: Dict[str, float]) -> bool:
+        if shares != self.shares:
+            self.shares = shares
+            self.changes.append((self.clock.now, shares))
+        return True
+
+    def replace_default_route(self, interface: str, gateway: Optional[str] = None, table: int = 254) -> bool:
+        return self.route({interface: 1.0})
+
+    def replace_multipath_route(self, weights: Dict[str, int], table: int = 254) -> bool:
+        total = sum(weights.values())
+        return self.route({interface: weight / total for interface, weight in weights.items()})
+
+class FakeRouter:
+    def __init__(self, weights: Dict[str, int]):
+        self.weights = weights
+
+    def balance_weights(self) -> Dict[str, int]:
+        return dict(self.weights)
+
+    def set_balance_weights(self, weights: Dict[str, int]) -> bool:
+        return True
+
+    def forget_connections(self, interface: str) -> bool:
+        return True
+
+class FakePassive:
+    """A WAN carrying traffic into a blackhole shows up as an rx stall"""
+
+    def __init__(self, clock: SimClock, trace: Trace, interfaces: Dict[str, str], routing: FakeRouting,
+                 enabled: bool = True):
+        self.clock = clock
+        self.trace = trace
+        self.interfaces = interfaces
+        self.routing = routing
+        self.enabled = enabled
+
+    def read(self) -> Dict[str, str]:
+        suspects = {}
+        if not self.enabled:
+            return suspects
+        for interface, wan in self.interfaces.items():
+            state = self.trace.at(wan, self.clock.now)
+            if self.routing.shares.get(interface) and state['carrier'] and (not state['online'] or state['loss'] >= 50):
+                suspects[interface] = 'rx stall (simulated)'
+        return suspects
+
+class FakeRecord:
+    def publish(self, record: Dict) -> bool:
+        return True
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def set_config(assignments: List[str]):
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        if not hasattr(Config, name):
+            raise SystemExit(f"Unknown setting {name}")
+        try:
+            setattr(Config, name, json.loads(value))
+        except ValueError:
+            setattr(Config, name, value)
+
+def degraded(state: Dict, latency: float, loss: float) -> bool:
+    return not state['carrier'] or not state['online'] or state['latency'] >= latency or state['loss'] >= loss
+
+def simulate(trace: Trace, args) -> Dict:
+    rng = random.Random(args.seed)
+    clock = SimClock(trace.epoch)
+    dynamic_load_balance.time = clock
+
+    interfaces = {spec['interface']: wan for wan, spec in Config.WANS.items()}
+    routing = FakeRouting(clock, trace, interfaces, next(iter(interfaces)))
+    prober = FakeProber(clock, trace, interfaces, rng)
+    sparse_prober = FakeProber(clock, trace, interfaces, rng, count=Config.PROBE_SPARSE_COUNT)
+    passive = FakePassive(clock, trace, interfaces, routing, enabled=not args.no_passive)
+    weights = dict({interface: 1 for interface in interfaces}, **dict(zip(interfaces, args.weights)))
+    lb = dynamic_load_balance.LoadBalancer(routing=routing, router=FakeRouter(weights), prober=prober,
+                                           sparse_prober=sparse_prober, passive=passive)
+    lb.state_record = FakeRecord()
+    lb.watch_links()
+
+    decisions = []
+    while clock.now < trace.duration:
+        started = time.process_time()
+        probing = prober.cpu + sparse_prober.cpu
+        timeout = lb.run_once()
+        decisions.append(time.process_time() - started - (prober.cpu + sparse_prober.cpu - probing))
+
+        # Carrier changes before the next pass arrive as link events and may cut the wait short
+        wake = clock.now + timeout
+        for t in trace.changes(clock.now, min(wake, trace.duration)):
+            clock.now = t
+            for interface, wan in interfaces.items():
+                carrier = trace.at(wan, t)['carrier']
+                if carrier != lb.carrier[interface]:
+                    started = time.process_time()
+                    lb.on_netlink_event(RTM_NEWLINK, {'name': interface, 'up': True, 'lower_up': carrier})
+                    decisions.append(time.process_time() - started)
+            if lb.wakeup.is_set():
+                wake = t
+                break
+        clock.now = max(clock.now, wake)
+
+    # Traffic-weighted seconds on each kind of link, between trace steps and route changes
+    breaks = sorted(set(trace.times) | {t for t, _ in routing.changes} | {trace.duration})
+    change_times = [t for t, _ in routing.changes]
+    on_degraded = on_down = 0.0
+    for start, end in zip(breaks, breaks[1:]):
+        shares = routing.changes[bisect.bisect_right(change_times, start) - 1][1]
+        for interface, share in shares.items():
+            state = trace.at(interfaces[interface], start)
+            if degraded(state, args.degraded_latency, args.degraded_loss):
+                on_degraded += share * (end - start)
+            if not state['carrier'] or not state['online']:
+                on_down += share * (end - start)
+
+    schedule = lb.schedule.state(clock.now)
+    return {
+        'duration_seconds': trace.duration,
+        'route_switches': len(routing.changes) - 1,
+        'preference_switches': lb.scoreboard.switches,
+        'flaps': lb.scoreboard.flaps(),
+        'degraded_seconds': round(on_degraded, 1),
+        'down_seconds': round(on_down, 1),
+        'probe_rounds': prober.rounds + sparse_prober.rounds,
+        'echoes_per_hour': {interface: state['probes_per_hour'] for interface, state in schedule.items()},
+        'time_to_detect_max': {interface: state['time_to_detect_max'] for interface, state in schedule.items()},
+        'decisions': len(decisions),
+        'decision_cpu_ms': round(sum(decisions) * 1000, 3),
+        'decision_cpu_us_mean': round(sum(decisions) / len(decisions) * 1e6, 1),
+        'decision_cpu_us_p99': round(percentile(decisions, 99) * 1e6, 1),
+        'routes': [{'t': round(t, 1), 'shares': shares} for t, shares in routing.changes]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay WAN traces through the load balancer decisions')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--scenario', default='mixed', choices=['steady', 'outage', 'degraded', 'flaky', 'noisy', 'mixed'])
+    source.add_argument('--trace', help='JSON lines trace file')
+    source.add_argument('--from-metrics', type=float, metavar='HOURS', help='replay the last HOURS of ISP metrics')
+    parser.add_argument('--metrics-dir', default=None, help=f'metrics store (default: {Config.METRICS_DIR})')
+    parser.add_argument('--duration', type=float, default=3600, help='seconds of a synthetic scenario')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--weights', type=lambda value: [int(w) for w in value.split(',')], default=[],
+                        help='balancing weights of the WANs in order (default: equal)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='override a Config setting')
+    parser.add_argument('--no-passive', action='store_true', help='without passive failure signals')
+    parser.add_argument('--degraded-latency', type=float, default=150, help='ms from which a link counts as degraded')
+    parser.add_argument('--degraded-loss', type=float, default=5, help='percent loss from which a link counts as degraded')
+    parser.add_argument('--write-trace', help='save the replayed trace as JSON lines')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the load balancer log')
+    parser.add_argument('--max-switches', type=int)
+    parser.add_argument('--max-degraded-seconds', type=float)
+    parser.add_argument('--max-cpu-ms', type=float, help='total decision CPU time')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format='%(levelname)s - %(message)s', force=True)
+    set_config(args.set)
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = Trace([json.loads(line) for line in f if line.strip()])
+    elif args.from_metrics:
+        trace = metrics_trace(args.from_metrics, args.metrics_dir)
+    else:
+        lines = synthetic_trace(args.scenario, args.duration, random.Random(args.seed))
+        trace = Trace(lines + [{'t': args.duration}])
+    if args.write_trace:
+        with open(args.write_trace, 'w') as f:
+            for line in trace.lines():
+                f.write(json.dumps(line) + '\n')
+
+    report = simulate(trace, args)
+    failures = [f"{name} {report[key]} > {limit}" for name, key, limit in (
+        ('route switches', 'route_switches', args.max_switches),
+        ('degraded seconds', 'degraded_seconds', args.max_degraded_seconds),
+        ('decision CPU ms', 'decision_cpu_ms', args.max_cpu_ms)) if limit is not None and report[key] > limit]
+
+    if args.json:
+        print(json.dumps(dict(report, failures=failures), indent=2))
+    else:
+        print("=== Load Balancer Simulation ===")
+        print(f"Trace:              {args.trace or (f'{args.from_metrics}h of metrics' if args.from_metrics else args.scenario)}, "
+              f"{report['duration_seconds']:.0f}s")
+        print(f"Route switches:     {report['route_switches']} ({report['flaps']} flaps, "
+              f"{report['preference_switches']} preference switches)")
+        print(f"Traffic on degraded links: {report['degraded_seconds']:.1f}s ({report['down_seconds']:.1f}s on down links)")
+        print(f"Probe rounds:       {report['probe_rounds']}, echoes/h {report['echoes_per_hour']}")
+        print(f"Time to detect max: {report['time_to_detect_max']}")
+        print(f"Decision CPU:       {report['decision_cpu_ms']:.2f} ms over {report['decisions']} passes, "
+              f"mean {report['decision_cpu_us_mean']:.0f} us, p99 {report['decision_cpu_us_p99']:.0f} us")
+        for route in report['routes']:
+            print(f"  {route['t']:>8.1f}s  {', '.join(f'{i} {s:.0%}' for i, s in route['shares'].items())}")
+        for failure in failures:
+            print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()